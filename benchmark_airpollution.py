@@ -0,0 +1,696 @@
+# -*- coding: utf-8 -*-
+"""benchmark_airpollution.py
+
+Reproducible scaling benchmark for the Beijing air pollution app, without opening a browser.
+
+    # Write a synthetic dataset with the schema of analyzed_data1.csv (12 stations, 4 years of hourly rows)
+    python benchmark_airpollution.py generate bench_data/ --stations 12 --years 4
+
+    # Time and memory-profile every stage at several sizes (STATIONSxYEARS) and save the results as JSON
+    python benchmark_airpollution.py run --sizes 1x1,12x4,50x10 --output results.json
+
+    # Report stages that got slower (or hungrier) than in a baseline run; exits with 1 if any did
+    python benchmark_airpollution.py compare baseline.json results.json --tolerance 0.25
+
+    # Check that appending the last hours as raw readings gives exactly the rows a batch preprocessing of all readings gives
+    python benchmark_airpollution.py check-append --stations 12 --years 1 --hours 48
+
+Each size is measured in its own process against the app module itself, starting from an empty .app_cache.
+The stages cover loading (cold start, CSV hashing and parsing, columnar cache write and memory-mapped read),
+every Data Overview statistic, every EDA tab computation and fit/predict for every Modeling page model type.
+Each stage records wall and CPU time, the process RSS afterwards and, from one extra run under tracemalloc,
+the peak memory allocated while it ran (NumPy and pandas buffers included, memory-mapped files not).
+"""
+
+import argparse
+import gc
+import importlib
+import itertools
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+
+APP_MODULE = "new_airpollution_app_py" # Imported from this script's folder
+DATA_FILE_NAME = "analyzed_data1.csv" # DATA_FILE_NAME in the app
+CACHE_DIR_NAME = ".app_cache" # CACHE_DIR_NAME in the app
+RESULTS_FORMAT_VERSION = 1
+
+
+# --- SYNTHETIC DATA ---
+# Hourly readings for up to 50 stations (the 12 Beijing sites, then numbered ones) with the columns, dtypes,
+# row order (by Date, then station) and one-hot layout (pd.get_dummies(drop_first=True)) of analyzed_data1.csv.
+# Pollutants follow a per-station AR(1) process in log space with seasonal and daily cycles, weather follows
+# the seasons, and the lag/rolling columns are computed from the generated PM2.5 exactly as the app does.
+# The output only depends on (stations, years, seed).
+GENERATOR_VERSION = 1 # Bump when the generated values change so cached benchmark datasets are rebuilt
+BEIJING_STATIONS = ['Aotizhongxin', 'Changping', 'Dingling', 'Dongsi', 'Guanyuan', 'Gucheng',
+                    'Huairou', 'Nongzhanguan', 'Shunyi', 'Tiantan', 'Wanliu', 'Wanshouxigong']
+MAX_STATIONS = 50
+MAX_YEARS = 10
+START_DATE = "2013-03-01" # First hour of the Beijing multi-site recordings
+GENERATOR_CHUNK_HOURS = 24 * 28 # Hours generated and written per step; bounds generator memory at any size
+HISTORY_HOURS = 24 # Longest lag / rolling window; the file starts after one warm-up day so none of them is empty
+PM25_LAGS = {'PM2.5_lag_1h': 1, 'PM2.5_lag_24h': 24}
+PM25_ROLLING_WINDOWS = {'PM2.5_rolling_mean_6h': 6, 'PM2.5_rolling_mean_24h': 24}
+SEASON_BY_MONTH = {12: 'Winter', 1: 'Winter', 2: 'Winter', 3: 'Spring', 4: 'Spring', 5: 'Spring',
+                   6: 'Summer', 7: 'Summer', 8: 'Summer', 9: 'Autumn', 10: 'Autumn', 11: 'Autumn'}
+DAY_NAMES = ['Friday', 'Monday', 'Saturday', 'Sunday', 'Thursday', 'Tuesday', 'Wednesday'] # Sorted, as get_dummies orders them
+PM25_CATEGORIES = [(12.0, 'Good'), (35.4, 'Moderate'), (55.4, 'Unhealthy for Sensitive Groups'),
+                   (150.4, 'Unhealthy'), (250.4, 'Very Unhealthy'), (np.inf, 'Hazardous')] # US EPA PM2.5 breakpoints
+WIND_DIRECTION_WEIGHTS = np.array([6, 5, 5, 4, 4, 3, 3, 3, 3, 3, 4, 4, 5, 6, 7, 7], dtype='float64') # N ... NNW, north-westerlies prevail
+
+
+def station_names(n_stations):
+    numbered = [f"Site{i:02d}" for i in range(len(BEIJING_STATIONS) + 1, MAX_STATIONS + 1)]
+    return (BEIJING_STATIONS + numbered)[:n_stations]
+
+
+def check_size(n_stations, n_years):
+    if not 1 <= n_stations <= MAX_STATIONS:
+        raise ValueError(f"stations must be between 1 and {MAX_STATIONS}, got {n_stations}")
+    if not 1 <= n_years <= MAX_YEARS:
+        raise ValueError(f"years must be between 1 and {MAX_YEARS}, got {n_years}")
+
+
+def _ar1(rng, state, n_hours, phi, sigma):
+    # AR(1) noise of shape (n_hours, n_stations), continuing from each station's last value in 'state'
+    from scipy.signal import lfilter
+    shocks = rng.normal(0.0, sigma, (n_hours, state.size))
+    values, _ = lfilter([1.0], [1.0, -phi], shocks, axis=0, zi=phi * state[None, :])
+    return values
+
+
+def _generate_chunk(rng, dates, stations, levels, state):
+    # Returns the chunk's rows (hour-major, station-minor); updates the AR states and PM2.5 history in 'state'
+    n_hours, n_stations = len(dates), len(stations)
+    shape = (n_hours, n_stations)
+    day_of_year = dates.dayofyear.to_numpy()[:, None]
+    hour = dates.hour.to_numpy()[:, None]
+    winter = np.cos(2 * np.pi * (day_of_year - 15) / 365.25) # +1 in mid-January, -1 in mid-July
+    afternoon = np.sin(2 * np.pi * (hour - 9) / 24) # Peaks at 15:00
+
+    temp_noise = _ar1(rng, state['temp'], n_hours, 0.95, 0.6)
+    pres_noise = _ar1(rng, state['pres'], n_hours, 0.98, 0.4)
+    pm_noise = _ar1(rng, state['pm'], n_hours, 0.97, 0.18)
+    state['temp'], state['pres'], state['pm'] = temp_noise[-1], pres_noise[-1], pm_noise[-1]
+
+    temp = 13 - 15 * winter + 5 * afternoon + levels['temp'] + temp_noise
+    dewp = temp - 4 - 4 * (winter + 1) - rng.gamma(1.5, 2.0, shape)
+    pres = 1012 + 10 * winter - 0.2 * temp_noise + pres_noise
+    wspm = rng.gamma(2.0, 0.9, shape) * (1 + 0.2 * (winter > 0))
+    rain = np.where(rng.random(shape) < 0.02 + 0.06 * (winter < -0.5), rng.exponential(1.5, shape), 0.0)
+    wind_direction = rng.choice(16, size=shape, p=WIND_DIRECTION_WEIGHTS / WIND_DIRECTION_WEIGHTS.sum())
+
+    log_pm = levels['pm'] + 0.5 * winter + 0.15 * np.cos(2 * np.pi * (hour - 22) / 24) - 0.1 * wspm - 0.6 * (rain > 0) + pm_noise
+    pm25 = np.round(np.clip(np.exp(log_pm), 3, 999), 1)
+    pollutants = {
+        'PM2.5': pm25,
+        'PM10': pm25 * rng.uniform(1.1, 1.6, shape) + rng.gamma(2.0, 5.0, shape),
+        'SO2': np.clip(2 + 0.08 * pm25 * (1 + winter) + rng.gamma(1.5, 2.0, shape), 1, None),
+        'NO2': np.clip(15 + 0.3 * pm25 + rng.normal(0, 8, shape), 2, None),
+        'CO': np.clip(200 + 9 * pm25 + rng.normal(0, 100, shape), 100, None),
+        'O3': np.clip(55 - 30 * winter + 30 * afternoon - 0.15 * pm25 + rng.normal(0, 10, shape), 1, None),
+    }
+    weather = {'TEMP': temp, 'PRES': pres, 'DEWP': dewp, 'RAIN': rain, 'WSPM': wspm}
+
+    # Lags and rolling means over the previous chunk's last HISTORY_HOURS values + this chunk, per station
+    extended = np.vstack([state['history'], pm25])
+    state['history'] = extended[-HISTORY_HOURS:]
+    engineered = {}
+    for col, hours in PM25_LAGS.items():
+        engineered[col] = extended[HISTORY_HOURS - hours:len(extended) - hours]
+    for col, window in PM25_ROLLING_WINDOWS.items():
+        windows = np.lib.stride_tricks.sliding_window_view(extended, window, axis=0)
+        engineered[col] = windows[HISTORY_HOURS - window + 1:].mean(axis=-1)
+    wind_radians = np.deg2rad(wind_direction * 22.5)
+    engineered.update({
+        'hour_sin': np.sin(2 * np.pi * hour / 24) + np.zeros(shape),
+        'hour_cos': np.cos(2 * np.pi * hour / 24) + np.zeros(shape),
+        'wd_sin': np.sin(wind_radians),
+        'wd_cos': np.cos(wind_radians),
+    })
+
+    columns = {'Date': np.repeat(dates.to_numpy(), n_stations)}
+    columns.update({col: np.round(values, 1).ravel() for col, values in {**pollutants, **weather}.items()})
+    columns.update({col: values.ravel() for col, values in engineered.items()})
+    columns['is_weekend'] = np.repeat((dates.dayofweek >= 5).astype(int), n_stations)
+
+    station = np.tile(np.arange(n_stations), n_hours)
+    for i, name in enumerate(stations[1:], start=1): # drop_first: the first station is the reference category
+        columns[f'station_{name}'] = station == i
+    season = np.repeat(dates.month.map(SEASON_BY_MONTH).to_numpy(), n_stations)
+    for name in ['Spring', 'Summer', 'Winter']: # Autumn is dropped
+        columns[f'season_{name}'] = season == name
+    day_name = np.repeat(dates.day_name().to_numpy(), n_stations)
+    for name in DAY_NAMES[1:]:
+        columns[f'day_of_week_name_{name}'] = day_name == name
+
+    columns['year_month'] = np.repeat(dates.strftime('%Y-%m').to_numpy(), n_stations)
+    bounds = np.array([bound for bound, _ in PM25_CATEGORIES])
+    labels = np.array([label for _, label in PM25_CATEGORIES], dtype=object)
+    columns['pollution_category'] = labels[np.searchsorted(bounds, columns['PM2.5'])]
+    return pd.DataFrame(columns)
+
+
+def generate_dataset(output_dir, n_stations, n_years, seed=0):
+    # Writes <output_dir>/analyzed_data1.csv chunk by chunk; returns a summary of what was written
+    check_size(n_stations, n_years)
+    started = time.perf_counter()
+    rng = np.random.default_rng(seed)
+    stations = station_names(n_stations)
+    start = pd.Timestamp(START_DATE)
+    hours = pd.date_range(start - pd.Timedelta(hours=HISTORY_HOURS), start + pd.DateOffset(years=n_years), freq='h', inclusive='left')
+
+    levels = {'pm': rng.normal(np.log(60), 0.15, n_stations), 'temp': rng.normal(0.0, 1.5, n_stations)}
+    state = {'temp': np.zeros(n_stations), 'pres': np.zeros(n_stations), 'pm': np.zeros(n_stations),
+             'history': np.full((HISTORY_HOURS, n_stations), np.nan)}
+
+    os.makedirs(output_dir, exist_ok=True)
+    csv_path = os.path.join(output_dir, DATA_FILE_NAME)
+    tmp_path = f"{csv_path}.{os.getpid()}.tmp"
+    rows = 0
+    columns = None
+    try:
+        for chunk_start in range(0, len(hours), GENERATOR_CHUNK_HOURS):
+            frame = _generate_chunk(rng, hours[chunk_start:chunk_start + GENERATOR_CHUNK_HOURS], stations, levels, state)
+            if chunk_start < HISTORY_HOURS: # Warm-up day: only feeds the lag / rolling history
+                frame = frame.iloc[(HISTORY_HOURS - chunk_start) * n_stations:]
+            frame.to_csv(tmp_path, mode='w' if columns is None else 'a', header=columns is None, index=False,
+                         date_format='%Y-%m-%d %H:%M:%S')
+            columns = frame.shape[1]
+            rows += len(frame)
+        os.replace(tmp_path, csv_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    summary = {'path': csv_path, 'stations': n_stations, 'years': n_years, 'seed': seed, 'rows': rows, 'columns': columns,
+               'bytes': os.path.getsize(csv_path), 'generator_version': GENERATOR_VERSION,
+               'elapsed_s': round(time.perf_counter() - started, 3)}
+    with open(os.path.join(output_dir, "generator.json"), 'w') as f:
+        json.dump(summary, f)
+    return summary
+
+
+def ensure_dataset(output_dir, n_stations, n_years, seed):
+    # Reuses a dataset generated earlier with the same size, seed and generator version
+    try:
+        with open(os.path.join(output_dir, "generator.json")) as f:
+            summary = json.load(f)
+        if (summary['stations'], summary['years'], summary['seed'], summary['generator_version']) == (n_stations, n_years, seed, GENERATOR_VERSION) \
+                and os.path.getsize(summary['path']) == summary['bytes']:
+            return dict(summary, reused=True)
+    except (OSError, ValueError, KeyError):
+        pass
+    return dict(generate_dataset(output_dir, n_stations, n_years, seed), reused=False)
+
+
+# --- MEASUREMENT ---
+
+def _rss_bytes():
+    try:
+        import psutil # Optional; /proc is enough on Linux
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def _peak_rss_bytes():
+    try:
+        import resource
+    except ImportError: # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024 # Bytes on macOS, kilobytes elsewhere
+
+
+class StageRecorder:
+    # Times each stage 'repeat' times untraced (tracemalloc slows allocation-heavy code several-fold), then runs
+    # it once more under tracemalloc for its memory peak. One-off stages (imports) are timed once and untraced.
+
+    def __init__(self, repeat=1, trace_memory=True):
+        self.repeat = repeat
+        self.trace_memory = trace_memory
+        self.stages = []
+
+    def measure(self, name, func, once=False, note=None):
+        walls, cpus = [], []
+        rss_before = _rss_bytes()
+        for _ in range(1 if once else self.repeat):
+            gc.collect()
+            wall_start, cpu_start = time.perf_counter(), time.process_time()
+            result = func()
+            walls.append(time.perf_counter() - wall_start)
+            cpus.append(time.process_time() - cpu_start)
+        rss_after = _rss_bytes()
+
+        peak = None
+        if self.trace_memory and not once:
+            gc.collect()
+            tracemalloc.start()
+            try:
+                result = func()
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+
+        record = {
+            'stage': name,
+            'wall_s': round(statistics.median(walls), 6),
+            'wall_s_min': round(min(walls), 6),
+            'cpu_s': round(statistics.median(cpus), 6),
+            'peak_traced_bytes': peak,
+            'rss_bytes': rss_after,
+            'rss_delta_bytes': rss_after - rss_before if rss_before is not None and rss_after is not None else None,
+            'repeat': len(walls),
+        }
+        if note:
+            record['note'] = note
+        self.stages.append(record)
+        print(f"  {name:<56} {record['wall_s']:>10.3f} s", file=sys.stderr, flush=True)
+        return result
+
+
+def _slug(text):
+    return text.lower().replace('.', '').replace(' ', '_')
+
+
+def _uncached(func):
+    # The function behind an st.cache_* wrapper, so repeats measure the computation rather than a cache hit
+    return getattr(func, '__wrapped__', func)
+
+
+# Modeling page widget defaults
+TEST_SIZE = 0.2
+DEFAULT_HYPERPARAMS = {
+    "K-Nearest Neighbors": {'n_neighbors': 5},
+    "Random Forest Regressor": {'n_estimators': 100},
+    "Random Forest Classifier": {'n_estimators': 100},
+}
+EDA_COLUMNS = {'histogram': 'PM10', 'scatter': ('PM10', 'TEMP'), 'boxplot': 'PM10', 'time_series': 'PM10'}
+EDA_BINS = 30 # Histogram "Number of bins" default
+
+
+def measure_app(data_dir, models, recorder):
+    # Imports the app against data_dir (a cold start) and measures each page's work on the loaded frame
+    os.environ['AIRPOLLUTION_DATA_DIR'] = data_dir
+    os.environ['AIRPOLLUTION_STORAGE'] = "memory"
+    shutil.rmtree(os.path.join(data_dir, CACHE_DIR_NAME), ignore_errors=True) # Every run starts cold
+    import streamlit.logger
+    streamlit.logger.set_log_level('error') # Silences the "no runtime" warnings of bare mode
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    app = recorder.measure('load.cold_start', lambda: importlib.import_module(APP_MODULE), once=True,
+                           note="Module import: fingerprint, CSV parse, columnar cache, profile, moments and histogram sidecars")
+    csv_path = os.path.join(data_dir, app.DATA_FILE_NAME)
+    scratch_dir = tempfile.mkdtemp(prefix="aq-bench-")
+    try:
+        recorder.measure('load.fingerprint', lambda: app._source_fingerprint(csv_path, tempfile.mkdtemp(dir=scratch_dir)))
+        parsed = recorder.measure('load.csv_parse', lambda: app._parse_source_csv(csv_path))
+        fingerprint = app.app_data.attrs['fingerprint']
+        recorder.measure('load.columnar_write', lambda: app._write_columnar_cache(parsed, scratch_dir, fingerprint))
+        parsed = None # Only the memory-mapped frame is kept from here on
+        recorder.measure('load.columnar_read', lambda: app._read_columnar_cache(scratch_dir, fingerprint), note="Warm start")
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+    data = app.session_view(app.app_data)
+    recorder.measure('load.binary_columns', lambda: app.binary_columns(data))
+
+    # Data Overview
+    for name, compute in app.PROFILE_STATISTICS.items():
+        recorder.measure(f'overview.{name}', lambda: compute(data))
+
+    # EDA, one or two stages per tab
+    moments = recorder.measure('eda.heatmap.moments', lambda: app.compute_correlation_moments(data))
+    heatmap_columns = [col for col in app.KEY_FEATURES_FOR_HEATMAP if col in moments['columns']]
+    recorder.measure('eda.heatmap.correlation', lambda: app.correlation_from_moments(moments, heatmap_columns))
+    fine = recorder.measure('eda.histogram.fine_counts', lambda: app.compute_fine_histograms(data))
+    recorder.measure('eda.histogram.bins_kde', lambda: _uncached(app.histogram_with_kde)(fingerprint, EDA_COLUMNS['histogram'], EDA_BINS, fine))
+    gridsize = max(int(np.sqrt(app.DEFAULT_POINT_BUDGET)), 10)
+    recorder.measure('eda.scatter.density_grid', lambda: _uncached(app.density_grid)(fingerprint, *EDA_COLUMNS['scatter'], gridsize, data))
+
+    # seaborn computes the box statistics while drawing, so the box plot stage draws (and encodes) the chart
+    sns = recorder.measure('eda.boxplot.import_seaborn', lambda: importlib.import_module('seaborn'), once=True)
+    box_x = data.select_dtypes(include='bool').columns[0]
+    draws = itertools.count() # A new figure cache key per repeat
+    def draw_boxplot():
+        def draw(fig, ax):
+            sns.boxplot(x=data[box_x], y=data[EDA_COLUMNS['boxplot']], ax=ax)
+        return app.render_figure('benchmark_boxplot', {'x': box_x, 'y': EDA_COLUMNS['boxplot'], 'draw': next(draws)}, fingerprint, draw)
+    recorder.measure('eda.boxplot.draw', draw_boxplot)
+    recorder.measure('eda.time_series.resample', lambda: _uncached(app.resample_time_series)(fingerprint, EDA_COLUMNS['time_series'], app.DEFAULT_POINT_BUDGET, data))
+
+    # Modeling: the design matrix once per task, then fit / predict for each model type
+    from sklearn.preprocessing import StandardScaler
+    scaler_params = tuple(sorted(StandardScaler().get_params().items()))
+    features = tuple(col for col in app.DEFAULT_MODEL_FEATURES if col in data.columns)
+    split_point = int(len(data) * (1 - TEST_SIZE))
+    for task, model_types in app.MODEL_OPTIONS.items():
+        model_types = [model_type for model_type in model_types if models is None or model_type in models]
+        if not model_types:
+            continue
+        task_slug = 'regression' if task == "PM2.5 Regression" else 'classification'
+        y = data['PM2.5' if task == "PM2.5 Regression" else 'pollution_category']
+        y_train = y.iloc[:split_point]
+        design = recorder.measure(f'modeling.{task_slug}.design_matrix',
+                                  lambda: _uncached(app.build_design_matrix)(fingerprint, features, split_point, scaler_params, data))
+        X_train, X_test = design['X_train'], design['X_test']
+
+        for model_type in model_types:
+            prefix = f'modeling.{task_slug}.{_slug(model_type)}'
+            hyperparams = DEFAULT_HYPERPARAMS.get(model_type, {})
+            if model_type == "K-Nearest Neighbors":
+                # The page builds one neighbour index (tree + k_max query of the test rows), then averages k targets
+                keys = (f"benchmark-knn-{i}" for i in itertools.count())
+                index = recorder.measure(f'{prefix}.fit', lambda: app.knn_neighbor_index(next(keys), None, X_train, y_train, X_test),
+                                         note=f"Tree build and {app.KNN_MAX_NEIGHBORS}-neighbour query of the test rows")
+                recorder.measure(f'{prefix}.predict', lambda: app.knn_from_index(index, y_train, hyperparams['n_neighbors']))
+            else:
+                model = recorder.measure(f'{prefix}.fit', lambda: app.build_model(model_type, hyperparams).fit(X_train, y_train))
+                recorder.measure(f'{prefix}.predict', lambda: model.predict(X_test))
+
+    return {'rows': len(app.app_data), 'columns': app.app_data.shape[1]}
+
+
+def _measure_main(args):
+    # Child process for one size: writes its stages (and any error) to args.result_path
+    recorder = StageRecorder(repeat=args.repeat, trace_memory=not args.no_memory)
+    result = {}
+    try:
+        result.update(measure_app(os.path.abspath(args.data_dir), _parse_models(args.models), recorder))
+    except Exception as e:
+        result['error'] = f"{type(e).__name__}: {e}"
+    result['stages'] = recorder.stages
+    result['peak_rss_bytes'] = _peak_rss_bytes()
+    with open(args.result_path, 'w') as f:
+        json.dump(result, f)
+
+
+# --- APPEND CHECK ---
+# The generated rows are turned back into raw station readings. A batch preprocessing of all of them, written
+# independently of the app's incremental engine (groupby shift/rolling, get_dummies, pd.cut), gives the expected
+# dataset; the same preprocessing of all but the last hours, followed by the app appending those hours, must
+# reproduce it. A mistake in either set of formulas shows up as a difference.
+
+APPEND_CHECK_RTOL = 1e-6 # Float columns: rolling sums over different spans and float32 casts may differ in the last bits
+RAW_READING_COLUMNS = ['Date', 'station', 'PM2.5', 'PM10', 'SO2', 'NO2', 'CO', 'O3', 'TEMP', 'PRES', 'DEWP', 'RAIN', 'WSPM', 'wd']
+WIND_DIRECTIONS = ['N', 'NNE', 'NE', 'ENE', 'E', 'ESE', 'SE', 'SSE', 'S', 'SSW', 'SW', 'WSW', 'W', 'WNW', 'NW', 'NNW']
+
+
+def _raw_readings(rows, stations):
+    # Turns generated rows back into what a station reports: its name, measurements and a compass wind direction
+    one_hot = rows[[f'station_{name}' for name in stations[1:]]].to_numpy(dtype=bool)
+    station = np.where(one_hot.any(axis=1), one_hot.argmax(axis=1) + 1, 0)
+    readings = rows[[col for col in RAW_READING_COLUMNS if col not in ('station', 'wd')]].copy()
+    readings.insert(1, 'station', np.array(stations, dtype=object)[station])
+    degrees = np.rad2deg(np.arctan2(rows['wd_sin'], rows['wd_cos'])) % 360
+    readings['wd'] = np.array(WIND_DIRECTIONS, dtype=object)[np.round(degrees / 22.5).astype(int) % len(WIND_DIRECTIONS)]
+    return readings
+
+
+def preprocess_raw(raw, stations):
+    # Batch feature engineering over every reading at once, in the order the readings come in
+    frame = raw.copy()
+    pm25 = frame.groupby('station', sort=False)['PM2.5']
+    for col, hours in PM25_LAGS.items():
+        frame[col] = pm25.shift(hours)
+    for col, window in PM25_ROLLING_WINDOWS.items():
+        frame[col] = pm25.transform(lambda series: series.rolling(window).mean())
+    frame['hour_sin'] = np.sin(2 * np.pi * frame['Date'].dt.hour / 24)
+    frame['hour_cos'] = np.cos(2 * np.pi * frame['Date'].dt.hour / 24)
+    wind_radians = np.deg2rad(frame['wd'].map({label: i * 22.5 for i, label in enumerate(WIND_DIRECTIONS)}))
+    frame['wd_sin'], frame['wd_cos'] = np.sin(wind_radians), np.cos(wind_radians)
+    frame['is_weekend'] = (frame['Date'].dt.dayofweek >= 5).astype(int)
+    frame['station'] = pd.Categorical(frame['station'], categories=stations) # The first station is the dropped one
+    frame['season'] = frame['Date'].dt.month.map(SEASON_BY_MONTH)
+    frame['day_of_week_name'] = frame['Date'].dt.day_name()
+    frame = pd.get_dummies(frame.drop(columns='wd'), columns=['station', 'season', 'day_of_week_name'], drop_first=True)
+    frame['year_month'] = frame['Date'].dt.strftime('%Y-%m')
+    bounds = [-np.inf] + [bound for bound, _ in PM25_CATEGORIES]
+    frame['pollution_category'] = pd.cut(frame['PM2.5'], bounds, labels=[label for _, label in PM25_CATEGORIES]).astype(object)
+    return frame
+
+
+def _frame_differences(expected, actual):
+    # Returns one message per column whose dtype or values differ; floats are compared to APPEND_CHECK_RTOL
+    if list(expected.columns) != list(actual.columns):
+        return [f"columns differ: {list(expected.columns)} != {list(actual.columns)}"]
+    if len(expected) != len(actual):
+        return [f"{len(actual)} rows, expected {len(expected)}"]
+    differences = []
+    for col in expected.columns:
+        if expected[col].dtype != actual[col].dtype:
+            differences.append(f"{col}: dtype {actual[col].dtype}, expected {expected[col].dtype}")
+        elif pd.api.types.is_float_dtype(expected[col]):
+            if not np.allclose(expected[col], actual[col], rtol=APPEND_CHECK_RTOL, atol=0.0, equal_nan=True):
+                differences.append(f"{col}: values differ")
+        elif not expected[col].equals(actual[col]):
+            differences.append(f"{col}: values differ")
+    return differences
+
+
+def check_append(work_dir, n_stations, n_years, seed=0, hours=48):
+    # Appends the last 'hours' of raw readings through the app to a batch-preprocessed file without them, and
+    # compares the CSV and the rewritten columnar cache with the batch preprocessing of all readings
+    summary = ensure_dataset(os.path.join(work_dir, "generated"), n_stations, n_years, seed)
+    stations = station_names(n_stations)
+    raw = _raw_readings(pd.read_csv(summary['path'], parse_dates=['Date']), stations)
+    cut = len(raw) - hours * n_stations
+
+    expected_dir, append_dir = os.path.join(work_dir, "expected"), os.path.join(work_dir, "appended")
+    for path, readings in [(expected_dir, raw), (append_dir, raw.iloc[:cut])]:
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path)
+        preprocess_raw(readings, stations).to_csv(os.path.join(path, DATA_FILE_NAME), index=False, date_format='%Y-%m-%d %H:%M:%S')
+
+    os.environ['AIRPOLLUTION_DATA_DIR'] = append_dir # The import below loads (and caches) the truncated file
+    os.environ['AIRPOLLUTION_STORAGE'] = "memory"
+    import streamlit.logger
+    streamlit.logger.set_log_level('error')
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    app = importlib.import_module(APP_MODULE)
+
+    n_rows, fingerprint = app.append_readings(raw.iloc[cut:], append_dir, reference_station=stations[0])
+    expected = app._parse_source_csv(os.path.join(expected_dir, DATA_FILE_NAME))
+    differences = {'csv': _frame_differences(expected, app._parse_source_csv(os.path.join(append_dir, DATA_FILE_NAME)))}
+    cached = app._read_columnar_cache(os.path.join(append_dir, CACHE_DIR_NAME), fingerprint)
+    differences['columnar_cache'] = ["missing"] if cached is None else _frame_differences(expected, cached)
+    return {'stations': n_stations, 'years': n_years, 'seed': seed, 'appended_rows': n_rows,
+            'differences': differences, 'ok': not any(differences.values())}
+
+
+# --- RESULTS ---
+
+def environment_info():
+    from importlib import metadata
+    versions = {}
+    for package in ['numpy', 'pandas', 'pyarrow', 'scikit-learn', 'scipy', 'joblib', 'matplotlib', 'seaborn', 'streamlit']:
+        try:
+            versions[package] = metadata.version(package)
+        except metadata.PackageNotFoundError:
+            versions[package] = None
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'python': platform.python_version(), 'platform': platform.platform(), 'machine': platform.machine(),
+            'cpu_count': os.cpu_count(), 'git_commit': commit, 'packages': versions}
+
+
+def run_benchmarks(sizes, work_dir, seed=0, models=None, repeat=1, trace_memory=True):
+    results = {
+        'benchmark': 'airpollution',
+        'format_version': RESULTS_FORMAT_VERSION,
+        'created_utc': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'environment': environment_info(),
+        'settings': {'seed': seed, 'models': models, 'repeat': repeat, 'trace_memory': trace_memory},
+        'runs': [],
+    }
+    for n_stations, n_years in sizes:
+        data_dir = os.path.join(work_dir, f"s{n_stations}-y{n_years}-seed{seed}")
+        print(f"{n_stations} station(s) x {n_years} year(s):", file=sys.stderr, flush=True)
+        dataset = ensure_dataset(data_dir, n_stations, n_years, seed)
+
+        # A fresh process per size, so memory figures and the app's module-level caches start from scratch
+        fd, result_path = tempfile.mkstemp(suffix=".json")
+        os.close(fd)
+        command = [sys.executable, os.path.abspath(__file__), '_measure', data_dir, result_path, '--repeat', str(repeat)]
+        if models is not None:
+            command += ['--models', ",".join(models)]
+        if not trace_memory:
+            command.append('--no-memory')
+        completed = None
+        try:
+            completed = subprocess.run(command)
+            with open(result_path) as f:
+                run = json.load(f)
+        except (OSError, ValueError):
+            run = {'error': f"Measurement process failed (exit code {completed and completed.returncode})", 'stages': []}
+        finally:
+            os.remove(result_path)
+        run = {'stations': n_stations, 'years': n_years, 'seed': seed, 'dataset': dataset, **run}
+        results['runs'].append(run)
+    return results
+
+
+def compare_results(baseline, current, tolerance=0.25, min_seconds=0.05, min_bytes=1024 ** 2):
+    # Matches runs by (stations, years, seed) and stages by name. Stages under min_seconds (or min_bytes for
+    # memory) are too noisy to judge and are skipped.
+    baseline_runs = {(run['stations'], run['years'], run['seed']): run for run in baseline['runs']}
+    regressions, improvements = [], []
+    compared = 0
+    for run in current['runs']:
+        size = (run['stations'], run['years'], run['seed'])
+        if size not in baseline_runs:
+            continue
+        before_stages = {stage['stage']: stage for stage in baseline_runs[size]['stages']}
+        for stage in run['stages']:
+            before = before_stages.get(stage['stage'])
+            if before is None:
+                continue
+            compared += 1
+            for metric, floor in [('wall_s', min_seconds), ('peak_traced_bytes', min_bytes)]:
+                old, new = before.get(metric), stage.get(metric)
+                if not old or new is None or max(old, new) < floor:
+                    continue
+                change = {'stations': size[0], 'years': size[1], 'stage': stage['stage'], 'metric': metric,
+                          'baseline': old, 'current': new, 'ratio': round(new / old, 3)}
+                if new > old * (1 + tolerance):
+                    regressions.append(change)
+                elif new < old / (1 + tolerance):
+                    improvements.append(change)
+    # Timings only compare like with like: list what differs between the two runs' machines and settings
+    changes = {}
+    for section in ['environment', 'settings']:
+        before, after = baseline.get(section, {}), current.get(section, {})
+        for key in sorted(set(before) | set(after)):
+            if key != 'git_commit' and before.get(key) != after.get(key):
+                changes[f"{section}.{key}"] = [before.get(key), after.get(key)]
+    return {'tolerance': tolerance, 'stages_compared': compared, 'regressions': regressions, 'improvements': improvements,
+            'baseline_commit': baseline.get('environment', {}).get('git_commit'),
+            'current_commit': current.get('environment', {}).get('git_commit'), 'setup_changes': changes}
+
+
+def _parse_sizes(text):
+    sizes = []
+    for item in text.split(","):
+        try:
+            n_stations, n_years = (int(part) for part in item.lower().split("x"))
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"sizes look like STATIONSxYEARS (e.g. 12x4), got '{item}'")
+        try:
+            check_size(n_stations, n_years)
+        except ValueError as e:
+            raise argparse.ArgumentTypeError(str(e))
+        sizes.append((n_stations, n_years))
+    return sizes
+
+
+def _parse_models(text):
+    # Comma-separated model types, by name ("Random Forest Regressor") or slug ("random_forest_regressor")
+    if not text:
+        return None
+    known = {_slug(name): name for name in ["Linear Regression", "Decision Tree Regressor", "K-Nearest Neighbors",
+                                            "Random Forest Regressor", "Random Forest Classifier"]}
+    models = []
+    for item in text.split(","):
+        if _slug(item.strip()) not in known:
+            raise argparse.ArgumentTypeError(f"Unknown model '{item}'; choose from {sorted(known)}")
+        models.append(known[_slug(item.strip())])
+    return models
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate synthetic data and benchmark the air pollution app without a browser.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    generate_parser = commands.add_parser('generate', help="Write a synthetic analyzed_data1.csv.")
+    generate_parser.add_argument("output_dir")
+    generate_parser.add_argument("--stations", type=int, default=12, help=f"1 to {MAX_STATIONS}.")
+    generate_parser.add_argument("--years", type=int, default=1, help=f"1 to {MAX_YEARS} years of hourly readings.")
+    generate_parser.add_argument("--seed", type=int, default=0)
+
+    run_parser = commands.add_parser('run', help="Time and memory-profile every stage at one or more sizes.")
+    run_parser.add_argument("--sizes", type=_parse_sizes, default=[(12, 1)], help="Comma-separated STATIONSxYEARS, e.g. 1x1,12x4,50x10.")
+    run_parser.add_argument("--work-dir", default=os.path.join(tempfile.gettempdir(), "airpollution-benchmark"),
+                            help="Where generated datasets are kept (and reused) between runs.")
+    run_parser.add_argument("--seed", type=int, default=0)
+    run_parser.add_argument("--models", type=_parse_models, default=None, help="Comma-separated model types to fit (default: all).")
+    run_parser.add_argument("--repeat", type=int, default=1, help="Runs per stage; the median time is reported.")
+    run_parser.add_argument("--no-memory", action='store_true', help="Skip the extra tracemalloc run of every stage.")
+    run_parser.add_argument("--output", help="Results file (default: stdout).")
+
+    compare_parser = commands.add_parser('compare', help="Compare a results file against a baseline.")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed slowdown, as a fraction.")
+
+    append_parser = commands.add_parser('check-append', help="Check appended readings against the generated rows.")
+    append_parser.add_argument("--stations", type=int, default=12, help=f"1 to {MAX_STATIONS}.")
+    append_parser.add_argument("--years", type=int, default=1, help=f"1 to {MAX_YEARS} years of hourly readings.")
+    append_parser.add_argument("--hours", type=int, default=48, help="Hours cut from the end of the file and appended back.")
+    append_parser.add_argument("--work-dir", default=os.path.join(tempfile.gettempdir(), "airpollution-append-check"))
+    append_parser.add_argument("--seed", type=int, default=0)
+
+    measure_parser = commands.add_parser('_measure') # Internal: one size, in a fresh process
+    measure_parser.add_argument("data_dir")
+    measure_parser.add_argument("result_path")
+    measure_parser.add_argument("--models", default=None)
+    measure_parser.add_argument("--repeat", type=int, default=1)
+    measure_parser.add_argument("--no-memory", action='store_true')
+
+    args = parser.parse_args()
+
+    if args.command == 'generate':
+        try:
+            print(json.dumps(generate_dataset(args.output_dir, args.stations, args.years, args.seed)))
+        except ValueError as e:
+            parser.error(str(e))
+    elif args.command == 'run':
+        results = run_benchmarks(args.sizes, args.work_dir, args.seed, args.models, args.repeat, not args.no_memory)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2)
+        else:
+            print(json.dumps(results, indent=2))
+        sys.exit(1 if any('error' in run for run in results['runs']) else 0)
+    elif args.command == 'compare':
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.current) as f:
+            current = json.load(f)
+        report = compare_results(baseline, current, args.tolerance)
+        print(json.dumps(report, indent=2))
+        sys.exit(1 if report['regressions'] else 0)
+    elif args.command == 'check-append':
+        try:
+            check_size(args.stations, args.years)
+        except ValueError as e:
+            parser.error(str(e))
+        report = check_append(os.path.abspath(args.work_dir), args.stations, args.years, args.seed, args.hours)
+        print(json.dumps(report, indent=2))
+        sys.exit(0 if report['ok'] else 1)
+    else:
+        _measure_main(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -11,117 +11,1428 @@ Original file is located at
 
 import streamlit as st
 import pandas as pd
-import seaborn as sns
-import matplotlib.pyplot as plt
 import numpy as np
 import io # For in-memory file operations (downloading plots)
+import copy # Shallow model copies that share a fitted neighbour index
 import joblib # For saving/loading models and scalers
 import os # Import os for path joining
-
-# Scikit-learn imports for models and preprocessing
-from sklearn.ensemble import RandomForestRegressor, AdaBoostRegressor, RandomForestClassifier
-from sklearn.linear_model import LinearRegression
-from sklearn.model_selection import train_test_split
-from sklearn.neighbors import KNeighborsRegressor
-from sklearn.preprocessing import StandardScaler
-from sklearn.metrics import mean_squared_error, mean_absolute_error, r2_score, accuracy_score, classification_report, confusion_matrix
+import glob # For finding stale cache files
+import hashlib # For fingerprinting the source CSV
+import json # For the cache manifest
+import threading # Guards caches shared by all sessions
+import shutil # For cleaning up finished training job folders
+import tempfile # Scratch folders for background training jobs; spooled export files
+import gzip # Compressed CSV exports
+import time # Stage timings
+import tracemalloc # Optional per-stage allocation peaks
+import warnings
+from collections import OrderedDict, deque # LRU ordering for the in-memory model cache; bounded stage log
+from contextlib import contextmanager
+
+# Scikit-learn, matplotlib and seaborn take seconds to import, so they are imported inside the pages and
+# functions that use them: opening Data Overview never pays for scikit-learn.
+
+# Copy-on-write lets every session slice the one shared DataFrame without copying its buffers.
+# pandas 3 always copies on write (its option is deprecated); 1.5 and 2.x need the option; older versions lack it.
+PANDAS_VERSION = tuple(int(''.join(ch for ch in part if ch.isdigit()) or 0) for part in pd.__version__.split('.')[:2])
+COPY_ON_WRITE = PANDAS_VERSION >= (1, 5)
+if (1, 5) <= PANDAS_VERSION < (3, 0):
+    pd.set_option('mode.copy_on_write', True)
 
 
 # --- GLOBAL DATA AND MODEL LOADING ---
-# This section loads your fully preprocessed data and trained models/scalers once when the app starts.
+# This section loads your fully preprocessed data once when the app starts. Pre-trained models and scalers
+# are loaded lazily, on first use by the Modeling page (see load_pretrained_artifact()).
 
 # Define the base path for your data and models in Google Drive
 # IMPORTANT: MAKE SURE THIS PATH IS EXACTLY WHERE YOU SAVED YOUR FILES.
 # Using 'analyzed_data1.csv' as per your last provided path.
-GOOGLE_DRIVE_BASE_PATH = "/content/drive/MyDrive/data sets/Merged cities/"
+# AIRPOLLUTION_DATA_DIR overrides it (e.g. to run against a generated benchmark dataset).
+GOOGLE_DRIVE_BASE_PATH = os.environ.get("AIRPOLLUTION_DATA_DIR", "/content/drive/MyDrive/data sets/Merged cities/")
+DATA_FILE_NAME = "analyzed_data1.csv"
+
+# --- COLUMNAR DATA CACHE ---
+# Parsing the merged CSV is by far the slowest part of a cold start, so the typed DataFrame is
+# written once to an uncompressed Feather (Arrow) file next to the data and memory-mapped on later loads.
+# The cache is keyed by the CSV's size, mtime and content hash and is rebuilt when the CSV changes.
+CACHE_DIR_NAME = ".app_cache"
+CACHE_FORMAT_VERSION = 2 # Bump when the dtype plan or file layout changes so old caches are ignored
+
+# Dtype plan applied once after parsing the CSV (the cache stores the typed columns)
+POLLUTANT_COLUMNS = ['PM2.5', 'PM10', 'SO2', 'NO2', 'CO', 'O3']
+WEATHER_COLUMNS = ['TEMP', 'PRES', 'DEWP', 'RAIN', 'WSPM']
+ENGINEERED_FLOAT_COLUMNS = [
+    'PM2.5_lag_1h', 'PM2.5_lag_24h',
+    'PM2.5_rolling_mean_6h', 'PM2.5_rolling_mean_24h',
+    'hour_sin', 'hour_cos', 'wd_sin', 'wd_cos',
+]
+ONE_HOT_PREFIXES = ('station_', 'season_', 'day_of_week_name_') # One-hot columns, stored as bit-packed booleans
+
+
+def _source_fingerprint(csv_path, cache_dir):
+    # Size and mtime are cheap to check; the content hash is only recomputed when either changes
+    stat = os.stat(csv_path) # Raises FileNotFoundError if the CSV is missing
+    manifest_path = os.path.join(cache_dir, "source_manifest.json")
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = {}
+
+    if (manifest.get('path') == os.path.abspath(csv_path)
+            and manifest.get('size') == stat.st_size
+            and manifest.get('mtime_ns') == stat.st_mtime_ns):
+        return manifest['sha256']
+
+    digest = hashlib.sha256()
+    with open(csv_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(8 * 1024 * 1024), b''):
+            digest.update(chunk)
+
+    manifest = {'path': os.path.abspath(csv_path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': digest.hexdigest()}
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(manifest_path, 'w') as f:
+            json.dump(manifest, f)
+    except OSError:
+        pass # Read-only data folder: we just re-hash next time
+    return manifest['sha256']
+
+
+def _columnar_cache_path(cache_dir, fingerprint):
+    stem = os.path.splitext(DATA_FILE_NAME)[0]
+    return os.path.join(cache_dir, f"{stem}-{fingerprint[:16]}-v{CACHE_FORMAT_VERSION}.feather")
+
+
+def _apply_dtype_plan(df_app):
+    # Pollutant, weather and engineered float columns don't need float64 precision
+    float32_cols = [c for c in POLLUTANT_COLUMNS + WEATHER_COLUMNS + ENGINEERED_FLOAT_COLUMNS
+                    if c in df_app.columns and pd.api.types.is_numeric_dtype(df_app[c])]
+    if float32_cols:
+        df_app[float32_cols] = df_app[float32_cols].astype('float32')
+
+    # One-hot columns sometimes come back from CSV as 0/1 integers; make them real booleans
+    for col in df_app.columns:
+        if col.startswith(ONE_HOT_PREFIXES) and not pd.api.types.is_bool_dtype(df_app[col]):
+            if df_app[col].isin([0, 1]).all():
+                df_app[col] = df_app[col].astype(bool)
+    return df_app
+
+
+def binary_columns(frame):
+    # 0/1 columns (one-hots and flags such as is_weekend) that modeling leaves unscaled; found once per
+    # dataset version and carried in attrs so the Modeling page never rescans the features for them
+    binary = []
+    for col in frame.columns:
+        values = frame[col]
+        if pd.api.types.is_bool_dtype(values):
+            binary.append(col)
+        elif (pd.api.types.is_numeric_dtype(values) and len(values) and values.min() >= 0 and values.max() <= 1
+              and values.isin([0, 1]).all()):
+            binary.append(col)
+    return binary
+
+
+def _ensure_year_month_period(df_app):
+    # Older pyarrow versions don't round-trip pandas' Period extension type, so re-apply it if needed
+    if 'year_month' in df_app.columns and not isinstance(df_app['year_month'].dtype, pd.PeriodDtype):
+        if pd.api.types.is_datetime64_any_dtype(df_app['year_month']):
+            df_app['year_month'] = df_app['year_month'].dt.to_period('M')
+    return df_app
+
+
+def _parse_source_csv(csv_path):
+    # Load the saved, fully preprocessed DataFrame from the absolute path
+    df_app = _fix_csv_types(pd.read_csv(csv_path))
+    df_app.reset_index(drop=True, inplace=True) # Feather needs a default index
+    return df_app
+
+
+def _fix_csv_types(df_app):
+    # --- CRITICAL FIXES FOR DATA TYPES AFTER CSV LOAD ---
+    # Ensure 'Date' is datetime (often saved as string in CSV)
+    if 'Date' in df_app.columns:
+        df_app['Date'] = pd.to_datetime(df_app['Date'], errors='coerce')
+        df_app.dropna(subset=['Date'], inplace=True) # Drop rows where Date conversion failed
+
+    # Ensure 'year_month' is handled correctly if needed for plotting or other logic
+    if 'year_month' in df_app.columns:
+        try:
+            df_app['year_month'] = df_app['year_month'].astype(str).str.replace(r'(\d{4})-(\d{2})', r'\1-\2-01').astype('datetime64[ns]').dt.to_period('M')
+        except Exception as e:
+            st.warning(f"Could not convert 'year_month' to PeriodDtype. Keeping as string/object. Error: {e}")
+
+    return _apply_dtype_plan(df_app)
 
-@st.cache_data # Cache the DataFrame loading for performance
-def load_and_preprocess_data_for_app(): # Renamed to be more descriptive
+
+def _read_columnar_cache(cache_dir, fingerprint):
+    cache_path = _columnar_cache_path(cache_dir, fingerprint)
+    if not os.path.exists(cache_path):
+        return None
+    try:
+        import pyarrow.feather as feather # Optional dependency for the columnar cache
+    except ImportError:
+        return None # pyarrow not installed: fall back to the CSV
     try:
-        # Load the saved, fully preprocessed DataFrame from the absolute path
-        df_app = pd.read_csv(os.path.join(GOOGLE_DRIVE_BASE_PATH, "analyzed_data1.csv")) # CORRECTED FILE NAME AND PATH USAGE
+        # Memory-map the uncompressed Arrow file. Numeric columns without nulls come back as zero-copy,
+        # read-only views over the OS page cache, so every session (and every worker process) shares them.
+        table = feather.read_table(cache_path, memory_map=True)
+        return _ensure_year_month_period(table.to_pandas(split_blocks=True))
+    except Exception as e:
+        st.warning(f"Ignoring unreadable data cache {cache_path}. Error: {e}")
+        return None
 
-        # --- CRITICAL FIXES FOR DATA TYPES AFTER CSV LOAD ---
-        # Ensure 'Date' is datetime (often saved as string in CSV)
-        if 'Date' in df_app.columns:
-            df_app['Date'] = pd.to_datetime(df_app['Date'], errors='coerce')
-            df_app.dropna(subset=['Date'], inplace=True) # Drop rows where Date conversion failed
 
-        # Ensure 'year_month' is handled correctly if needed for plotting or other logic
-        if 'year_month' in df_app.columns:
+def _write_columnar_cache(df_app, cache_dir, fingerprint):
+    cache_path = _columnar_cache_path(cache_dir, fingerprint)
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        df_app.to_feather(tmp_path, compression='uncompressed') # Uncompressed so it can be memory-mapped
+        os.replace(tmp_path, cache_path) # Atomic, so concurrent sessions never read a half-written file
+    except ImportError:
+        return # pyarrow not installed: keep loading from CSV
+    except Exception as e:
+        st.warning(f"Could not write data cache to {cache_dir}. Loading will stay on the CSV. Error: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return
+
+    # Drop caches built from older versions of the CSV
+    stem = os.path.splitext(DATA_FILE_NAME)[0]
+    _remove_stale_cache_files(cache_dir, f"{stem}-*.feather", keep=cache_path)
+
+
+def _remove_stale_cache_files(cache_dir, pattern, keep):
+    for stale_path in glob.glob(os.path.join(cache_dir, pattern)):
+        if stale_path != keep:
             try:
-                df_app['year_month'] = df_app['year_month'].astype(str).str.replace(r'(\d{4})-(\d{2})', r'\1-\2-01').astype('datetime64[ns]').dt.to_period('M')
-            except Exception as e:
-                st.warning(f"Could not convert 'year_month' to PeriodDtype. Keeping as string/object. Error: {e}")
+                os.remove(stale_path)
+            except OSError:
+                pass
+
+
+# --- STAGE INSTRUMENTATION ---
+# Loading, profiling, scaling, fitting, predicting, metrics and chart rendering run inside stage() blocks that
+# record wall time, CPU time (of the calling thread and of the whole process) and, while tracemalloc is on,
+# the peak allocation above the stage's starting point. Records are tagged with the session and script run,
+# kept in a bounded log and summed per stage server-wide, and exported at the end of every script run as
+# JSON lines and as a Prometheus text file (node_exporter textfile-collector format).
+# tracemalloc is process-wide: while sessions overlap, their stages' peaks include each other's allocations.
+STAGE_LOG_ENTRIES = 5000 # Most recent stage records kept in memory
+DIAGNOSTICS_DIR = os.environ.get("AIRPOLLUTION_DIAGNOSTICS_DIR", os.path.join(GOOGLE_DRIVE_BASE_PATH, CACHE_DIR_NAME, "diagnostics"))
+DIAGNOSTICS_EXPORTS = [fmt for fmt in os.environ.get("AIRPOLLUTION_DIAGNOSTICS_EXPORT", "json,prometheus").split(",") if fmt in ('json', 'prometheus')]
+STAGE_LOG_FILE = "stages.jsonl"
+STAGE_LOG_MAX_BYTES = 16 * 1024 ** 2 # The JSON log is rotated to stages.jsonl.1 beyond this
+STAGE_METRICS_FILE = "airpollution_stages.prom"
+
+if os.environ.get("AIRPOLLUTION_TRACE_MEMORY") == "1" and not tracemalloc.is_tracing():
+    tracemalloc.start()
+
+
+@st.cache_resource
+def _stage_state():
+    return {'lock': threading.Lock(), 'export_lock': threading.Lock(), 'log': deque(maxlen=STAGE_LOG_ENTRIES),
+            'totals': {}, 'runs': 0, 'local': threading.local()}
+
+
+def _session_id():
+    from streamlit.runtime.scriptrunner import get_script_run_ctx
+    ctx = get_script_run_ctx(suppress_warning=True)
+    return ctx.session_id if ctx is not None else None # None outside a Streamlit session (imports, worker threads)
+
+
+def begin_stage_run():
+    # Called at the top of every script run; the run's stages are collected until finish_stage_run()
+    state = _stage_state()
+    with state['lock']:
+        state['runs'] += 1
+        run_id = state['runs']
+    state['local'].run = {'id': run_id, 'session': _session_id(), 'page': None, 'records': [], 'stack': [], 'seq': 0}
+
+
+def _current_run():
+    local = _stage_state()['local']
+    if getattr(local, 'run', None) is None: # A thread outside any script run
+        local.run = {'id': None, 'session': None, 'page': None, 'records': [], 'stack': [], 'seq': 0}
+    return local.run
+
+
+@contextmanager
+def stage(name, sink=None, **labels):
+    # Times the block; labels (and anything the block adds to the yielded dict) are stored with the record.
+    # With a sink list the record is only appended there (used by background training workers).
+    run = _current_run() if sink is None else {'id': None, 'session': None, 'page': None, 'stack': [], 'seq': 0}
+    parent = run['stack'][-1] if run['stack'] else None
+    tracing = tracemalloc.is_tracing()
+    start_traced = 0
+    if tracing:
+        start_traced, peak_so_far = tracemalloc.get_traced_memory()
+        if parent is not None:
+            parent['peak'] = max(parent['peak'], peak_so_far) # Keep the parent's peak before resetting it for this stage
+        tracemalloc.reset_peak()
+    frame = {'peak': 0, 'seq': run['seq']}
+    run['seq'] += 1
+    run['stack'].append(frame)
+    wall_start, cpu_start, process_start = time.perf_counter(), time.thread_time(), time.process_time()
+    try:
+        yield labels
+    except Exception as e:
+        labels['error'] = type(e).__name__
+        raise
+    finally:
+        wall, cpu, process_cpu = time.perf_counter() - wall_start, time.thread_time() - cpu_start, time.process_time() - process_start
+        run['stack'].pop()
+        peak_alloc = None
+        if tracing and tracemalloc.is_tracing():
+            frame['peak'] = max(frame['peak'], tracemalloc.get_traced_memory()[1])
+            peak_alloc = max(frame['peak'] - start_traced, 0)
+            if parent is not None:
+                parent['peak'] = max(parent['peak'], frame['peak'])
+        record = {'time': round(time.time(), 3), 'session': run['session'], 'run': run['id'], 'page': run['page'],
+                  'seq': frame['seq'], 'depth': len(run['stack']), 'stage': name, 'wall_s': round(wall, 6),
+                  'cpu_s': round(cpu, 6), 'process_cpu_s': round(process_cpu, 6), 'peak_alloc_bytes': peak_alloc, **labels}
+        if sink is not None:
+            sink.append(record)
+        else:
+            record_stages([record])
+
+
+def record_stages(records):
+    # Adds finished stage records to the current run, the server-wide log and the per-stage totals.
+    # Records made elsewhere (e.g. in a training worker) are attributed to the current session and run.
+    run = _current_run()
+    with _stage_state()['lock']:
+        for record in records:
+            if record.get('session') is None:
+                record.update(session=run['session'], run=run['id'], page=run['page'], seq=run['seq'], depth=len(run['stack']))
+                run['seq'] += 1
+    log_stage_records(records)
+    run['records'].extend(records)
+
+
+def log_stage_records(records):
+    # Server-wide log and totals only; for records already attributed to a session, collected outside its script run
+    state = _stage_state()
+    with state['lock']:
+        for record in records:
+            state['log'].append(record)
+            totals = state['totals'].setdefault(record['stage'], {'count': 0, 'errors': 0, 'wall_s': 0.0, 'cpu_s': 0.0,
+                                                                  'process_cpu_s': 0.0, 'peak_alloc_bytes': None})
+            totals['count'] += 1
+            totals['errors'] += 'error' in record
+            for key in ('wall_s', 'cpu_s', 'process_cpu_s'):
+                totals[key] += record[key]
+            if record['peak_alloc_bytes'] is not None:
+                totals['peak_alloc_bytes'] = max(totals['peak_alloc_bytes'] or 0, record['peak_alloc_bytes'])
+
+
+def prometheus_stage_metrics():
+    with _stage_state()['lock']:
+        totals = {name: dict(values) for name, values in _stage_state()['totals'].items()}
+    metrics = [
+        ('airpollution_stage_runs_total', 'count', 'counter', "Completed runs of each app stage."),
+        ('airpollution_stage_errors_total', 'errors', 'counter', "Stage runs that raised an exception."),
+        ('airpollution_stage_wall_seconds_total', 'wall_s', 'counter', "Wall time spent in each app stage."),
+        ('airpollution_stage_cpu_seconds_total', 'cpu_s', 'counter', "CPU time of the thread running each app stage."),
+        ('airpollution_stage_process_cpu_seconds_total', 'process_cpu_s', 'counter', "Process-wide CPU time during each app stage."),
+        ('airpollution_stage_peak_alloc_bytes', 'peak_alloc_bytes', 'gauge', "Largest traced allocation peak of each app stage."),
+    ]
+    lines = []
+    for metric, key, kind, description in metrics:
+        lines += [f"# HELP {metric} {description}", f"# TYPE {metric} {kind}"]
+        for name, values in sorted(totals.items()):
+            if values[key] is not None:
+                escaped = name.replace("\\", "\\\\").replace('"', '\\"')
+                lines.append(f'{metric}{{stage="{escaped}"}} {values[key]}')
+    return "\n".join(lines) + "\n"
+
+
+def finish_stage_run():
+    # Appends this run's records to the JSON log and rewrites the Prometheus file
+    run = _current_run()
+    if not DIAGNOSTICS_EXPORTS or not run['records']:
+        return
+    try:
+        os.makedirs(DIAGNOSTICS_DIR, exist_ok=True)
+        with _stage_state()['export_lock']:
+            if 'json' in DIAGNOSTICS_EXPORTS:
+                log_path = os.path.join(DIAGNOSTICS_DIR, STAGE_LOG_FILE)
+                if os.path.exists(log_path) and os.path.getsize(log_path) > STAGE_LOG_MAX_BYTES:
+                    os.replace(log_path, f"{log_path}.1")
+                with open(log_path, 'a') as f:
+                    f.writelines(json.dumps(record, default=str) + "\n" for record in run['records'])
+            if 'prometheus' in DIAGNOSTICS_EXPORTS:
+                metrics_path = os.path.join(DIAGNOSTICS_DIR, STAGE_METRICS_FILE)
+                tmp_path = f"{metrics_path}.{os.getpid()}.tmp"
+                with open(tmp_path, 'w') as f:
+                    f.write(prometheus_stage_metrics())
+                os.replace(tmp_path, metrics_path) # Atomic, so the collector never reads a half-written file
+    except OSError:
+        pass # Read-only data folder: the in-memory log and the diagnostics panel still work
+
+
+STAGE_RECORD_FIELDS = {'time', 'session', 'run', 'page', 'seq', 'depth', 'stage', 'wall_s', 'cpu_s', 'process_cpu_s', 'peak_alloc_bytes'}
+
+
+def _stage_table(records):
+    # One row per stage in the order they started; nested stages are indented under their parent
+    rows = []
+    for record in sorted(records, key=lambda r: (r['run'] or 0, r['seq'])):
+        rows.append({
+            'Stage': "\u2003" * record['depth'] + record['stage'],
+            'Wall (ms)': round(record['wall_s'] * 1000, 1),
+            'CPU (ms)': round(record['cpu_s'] * 1000, 1),
+            'Peak (MiB)': round(record['peak_alloc_bytes'] / 1024 ** 2, 2) if record['peak_alloc_bytes'] is not None else None,
+            'Details': ", ".join(f"{key}={value}" for key, value in record.items() if key not in STAGE_RECORD_FIELDS),
+        })
+    return pd.DataFrame(rows)
+
+
+def _stage_summary(records):
+    if not records:
+        return pd.DataFrame()
+    frame = pd.DataFrame([{key: record[key] for key in ('stage', 'wall_s', 'cpu_s', 'peak_alloc_bytes')} for record in records])
+    summary = frame.groupby('stage').agg(runs=('wall_s', 'size'), wall_s=('wall_s', 'sum'), mean_wall_ms=('wall_s', 'mean'),
+                                         cpu_s=('cpu_s', 'sum'), peak_mib=('peak_alloc_bytes', 'max'))
+    summary['mean_wall_ms'] *= 1000
+    summary['peak_mib'] /= 1024 ** 2
+    return summary.sort_values('wall_s', ascending=False).round(3)
+
+
+def show_diagnostics_panel():
+    # Optional sidebar panel with this run's stages, this session's totals and the server-wide totals
+    if not st.sidebar.checkbox("🩺 Show stage diagnostics", key="show_diagnostics"):
+        return
+    run = _current_run()
+    state = _stage_state()
+    with st.sidebar.expander("🩺 Stage Diagnostics", expanded=True):
+        trace = st.checkbox("Trace memory allocations (server-wide; slows every session)", value=tracemalloc.is_tracing(),
+                            key="trace_memory", help="Takes effect from the next run. Peaks are blank while this is off.")
+        if trace and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        elif not trace and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+        st.caption("This run")
+        st.dataframe(_stage_table(run['records']), hide_index=True)
+        with state['lock']:
+            session_records = [record for record in state['log'] if record['session'] == run['session']]
+            totals = {name: dict(values) for name, values in state['totals'].items()}
+        st.caption(f"This session ({len(session_records)} most recent stage records)")
+        st.dataframe(_stage_summary(session_records))
+        st.caption("All sessions since the server started")
+        st.dataframe(pd.DataFrame.from_dict(totals, orient='index').sort_values('wall_s', ascending=False) if totals else pd.DataFrame())
+
+        session_log = "".join(json.dumps(record, default=str) + "\n" for record in session_records)
+        st.download_button("📥 Session stage log (JSON lines)", session_log, file_name=STAGE_LOG_FILE, mime="application/json")
+        st.download_button("📥 Stage metrics (Prometheus)", prometheus_stage_metrics(), file_name=STAGE_METRICS_FILE, mime="text/plain")
+        if DIAGNOSTICS_EXPORTS:
+            st.caption(f"Both are also written to {DIAGNOSTICS_DIR} after every run.")
+
+
+# cache_resource (not cache_data) hands every session the same object instead of an unpickled copy,
+# so the dataset is held once per server no matter how many analysts are connected.
+# Pages must only ever see it through session_view() below.
+@st.cache_resource
+def load_and_preprocess_data_for_app(base_path=GOOGLE_DRIVE_BASE_PATH): # Renamed to be more descriptive
+    csv_path = os.path.join(base_path, DATA_FILE_NAME)
+    cache_dir = os.path.join(base_path, CACHE_DIR_NAME)
+    try:
+        with stage('load.fingerprint'):
+            fingerprint = _source_fingerprint(csv_path, cache_dir)
+
+        # Fast path: typed columns from the columnar cache; slow path: parse the CSV and build the cache
+        with stage('load.columnar_read'):
+            df_app = _read_columnar_cache(cache_dir, fingerprint)
+        if df_app is None:
+            with stage('load.csv_parse'):
+                df_app = _parse_source_csv(csv_path)
+            with stage('load.columnar_write'):
+                _write_columnar_cache(df_app, cache_dir, fingerprint)
+            # Serve the memory-mapped copy rather than the freshly parsed one so that the first load
+            # shares the page cache too (falls back to the parsed frame if the cache couldn't be written)
+            with stage('load.columnar_read'):
+                mapped = _read_columnar_cache(cache_dir, fingerprint)
+            if mapped is not None:
+                df_app = mapped
+
+        df_app.attrs['fingerprint'] = fingerprint
+        df_app.attrs['cache_dir'] = cache_dir # Where per-dataset sidecars (profile, ...) live
+        with stage('load.binary_columns'):
+            df_app.attrs['binary_columns'] = binary_columns(df_app)
 
     except FileNotFoundError:
-        st.error(f"Error: 'analyzed_data1.csv' not found at {os.path.join(GOOGLE_DRIVE_BASE_PATH, 'analyzed_data1.csv')}. Please ensure the file exists there.")
+        st.error(f"Error: '{DATA_FILE_NAME}' not found at {csv_path}. Please ensure the file exists there.")
         st.stop() # Stop the app if data can't be loaded
     return df_app
 
-@st.cache_resource # Use cache_resource for models/scalers as they are objects (loaded once)
-def load_trained_models_and_scaler(): # Renamed to load_trained_models_and_scaler
-    trained_model_reg = None
-    trained_scaler = None
-    trained_model_clf = None
 
+def session_view(data):
+    # Pages get a shallow, copy-on-write view of the shared frame: no data is copied, and anything a page
+    # writes lands in its own copy instead of the buffers every session shares.
+    # Without copy-on-write a shallow copy would alias the shared buffers, so fall back to a real copy.
+    view = data.copy(deep=not COPY_ON_WRITE)
+    view.attrs = dict(data.attrs)
+    return view
+
+
+# --- PER-DATASET SIDECARS ---
+# Small derived results (profile, correlation moments, ...) are saved next to the columnar cache,
+# keyed by the dataset fingerprint, so reruns and restarts never rescan the frame to rebuild them.
+PROFILE_FORMAT_VERSION = 1
+MOMENTS_FORMAT_VERSION = 1
+FINE_HISTOGRAM_FORMAT_VERSION = 2
+
+
+def _sidecar_path(cache_dir, kind, version, fingerprint):
+    return os.path.join(cache_dir, f"{kind}-{fingerprint[:16]}-v{version}.joblib")
+
+
+def save_sidecar(cache_dir, kind, version, fingerprint, obj):
+    sidecar_path = _sidecar_path(cache_dir, kind, version, fingerprint)
+    tmp_path = f"{sidecar_path}.{os.getpid()}.tmp"
     try:
-        trained_model_reg = joblib.load(os.path.join(GOOGLE_DRIVE_BASE_PATH, 'linear_regression_model.pkl'))
-    except FileNotFoundError:
-        st.warning(f"Warning: 'linear_regression_model.pkl' not found at {os.path.join(GOOGLE_DRIVE_BASE_PATH, 'linear_regression_model.pkl')}. Regression model functionality will be limited.")
-    except Exception as e:
-        st.error(f"Error loading regression model: {e}")
+        os.makedirs(cache_dir, exist_ok=True)
+        joblib.dump(obj, tmp_path)
+        os.replace(tmp_path, sidecar_path)
+        _remove_stale_cache_files(cache_dir, f"{kind}-*.joblib", keep=sidecar_path)
+    except OSError:
+        pass # Read-only data folder: the in-memory copy still serves this process
+
+
+def _load_or_build_sidecar(kind, version, fingerprint, data, build):
+    cache_dir = data.attrs.get('cache_dir')
+    sidecar_path = _sidecar_path(cache_dir, kind, version, fingerprint) if cache_dir else None
+
+    with stage(f'sidecar.{kind}') as labels:
+        if sidecar_path and os.path.exists(sidecar_path):
+            try:
+                obj = joblib.load(sidecar_path)
+                labels['source'] = 'disk'
+                return obj
+            except Exception:
+                pass # Unreadable (e.g. written by another pandas version): rebuild it below
+
+        labels['source'] = 'built'
+        obj = build(data)
+        if cache_dir and data.attrs.get('persist_sidecars', True): # Filtered slices are kept in memory only
+            save_sidecar(cache_dir, kind, version, fingerprint, obj)
+    return obj
 
+
+def _profile_info(data):
+    buffer = io.StringIO()
+    data.info(buf=buffer)
+    return buffer.getvalue()
+
+
+def _profile_bool_counts(data):
+    # Booleans can't hold nulls, so one column sum gives both the True and False counts of every one-hot column
+    boolean_cols = data.select_dtypes(include='bool').columns.tolist()
+    true_counts = data[boolean_cols].sum() if boolean_cols else pd.Series(dtype='int64')
+    bool_counts = {}
+    for col in boolean_cols:
+        counts = pd.Series({True: int(true_counts[col]), False: len(data) - int(true_counts[col])}, name='count')
+        bool_counts[col] = counts[counts > 0].sort_values(ascending=False) # Same shape as value_counts()
+    return bool_counts
+
+
+# The Data Overview statistics, one profiling step each (benchmark_airpollution.py times them separately)
+PROFILE_STATISTICS = {
+    'shape': lambda data: data.shape,
+    'info': _profile_info,
+    'describe': lambda data: data.describe(include='all'),
+    'missing': lambda data: data.isnull().sum(),
+    'bool_counts': _profile_bool_counts,
+}
+
+
+def compute_dataset_profile(data):
+    profile = {}
+    for name, compute in PROFILE_STATISTICS.items():
+        with stage(f'profile.{name}'):
+            profile[name] = compute(data)
+    return profile
+
+
+@st.cache_resource(max_entries=8) # One profile per dataset version, shared by every session
+def _dataset_profile(fingerprint, _data):
+    return _load_or_build_sidecar('profile', PROFILE_FORMAT_VERSION, fingerprint, _data, compute_dataset_profile)
+
+
+def load_dataset_profile(fingerprint, data):
+    if 'slice_key' in data.attrs: # A slice's profile is cached with the slice and evicted with it
+        return slice_sidecar('profile', PROFILE_FORMAT_VERSION, fingerprint, data, compute_dataset_profile)
+    return _dataset_profile(fingerprint, data)
+
+
+# --- CORRELATION MOMENT ACCUMULATORS ---
+# Pairwise-complete running sums for every numeric column: counts n[i, j], sums s[i, j] and sums of squares
+# ss[i, j] of column i over the rows where both i and j are present, and cross-products c[i, j].
+# Any subset of the correlation matrix (matching DataFrame.corr()) is answered from these k x k arrays,
+# and appended rows are folded in with update_moments() without rescanning the history.
+MOMENTS_CHUNK_ROWS = 500_000 # Rows per matrix product; bounds the float64 scratch copy
+
+
+def init_moments(columns, shift):
+    k = len(columns)
+    # Values are accumulated relative to 'shift' (roughly the column means) to keep the raw sums well conditioned
+    return {
+        'columns': list(columns),
+        'shift': np.asarray(shift, dtype='float64'),
+        'n': np.zeros((k, k)),
+        's': np.zeros((k, k)),
+        'ss': np.zeros((k, k)),
+        'c': np.zeros((k, k)),
+    }
+
+
+def update_moments(moments, frame):
+    # Folds the rows of 'frame' into a copy of the accumulators; the input moments are left untouched
+    updated = {key: (value.copy() if isinstance(value, np.ndarray) else value) for key, value in moments.items()}
+    for start in range(0, len(frame), MOMENTS_CHUNK_ROWS):
+        chunk = frame.iloc[start:start + MOMENTS_CHUNK_ROWS]
+        X = chunk[updated['columns']].to_numpy(dtype='float64', na_value=np.nan) - updated['shift']
+        present = np.isfinite(X)
+        mask = present.astype('float64')
+        X = np.where(present, X, 0.0)
+        updated['n'] += mask.T @ mask
+        updated['s'] += X.T @ mask
+        updated['ss'] += (X * X).T @ mask
+        updated['c'] += X.T @ X
+    return updated
+
+
+def compute_correlation_moments(data):
+    numeric_cols = [col for col in data.columns if pd.api.types.is_numeric_dtype(data[col])]
+    shift = data[numeric_cols].head(10_000).mean().fillna(0.0).to_numpy(dtype='float64')
+    return update_moments(init_moments(numeric_cols, shift), data)
+
+
+def correlation_from_moments(moments, columns):
+    idx = [moments['columns'].index(col) for col in columns]
+    grid = np.ix_(idx, idx)
+    n, s, ss, c = (moments[key][grid] for key in ('n', 's', 'ss', 'c'))
+    # Pearson r over the rows where both columns are present; s.T[i, j] is column j's sum over those rows
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cov = n * c - s * s.T
+        var = n * ss - s * s
+        corr = cov / np.sqrt(var * var.T)
+    np.fill_diagonal(corr, np.where(np.diag(var) > 0, 1.0, np.nan))
+    return pd.DataFrame(np.clip(corr, -1.0, 1.0), index=columns, columns=columns)
+
+
+@st.cache_resource(max_entries=8) # One set of accumulators per dataset version, shared by every session
+def _dataset_correlation_moments(fingerprint, _data):
+    return _load_or_build_sidecar('moments', MOMENTS_FORMAT_VERSION, fingerprint, _data, compute_correlation_moments)
+
+
+def load_correlation_moments(fingerprint, data):
+    if 'slice_key' in data.attrs:
+        return slice_sidecar('moments', MOMENTS_FORMAT_VERSION, fingerprint, data, compute_correlation_moments)
+    return _dataset_correlation_moments(fingerprint, data)
+
+
+# --- HISTOGRAM / KDE SERVICE ---
+# Every numeric column is summarized once as its sorted distinct values with cumulative counts, so any
+# requested bin count is exact: each edge is located with np.searchsorted, matching np.histogram bin for bin
+# (repeated values, e.g. integer PM2.5 readings, land in the same bar as they would there). The KDE curve is
+# a Gaussian convolution of FINE_HISTOGRAM_BINS equal-width fine counts done with an FFT (a binned KDE), so
+# neither the bins slider nor the KDE ever touches the raw values again.
+FINE_HISTOGRAM_BINS = 4096
+HISTOGRAM_CACHE_ENTRIES = 256 # (column, bins) results kept in the LRU cache
+
+
+def compute_fine_histograms(data):
+    fine = {}
+    for col in data.columns:
+        if not pd.api.types.is_numeric_dtype(data[col]):
+            continue
+        values = data[col].to_numpy(dtype='float64', na_value=np.nan)
+        values = values[np.isfinite(values)]
+        if values.size == 0:
+            continue
+        lo, hi = float(values.min()), float(values.max())
+        if lo == hi: # Constant column: give it a unit-wide range so the bins are well defined
+            lo, hi = lo - 0.5, hi + 0.5
+        counts, _ = np.histogram(values, bins=FINE_HISTOGRAM_BINS, range=(lo, hi))
+        distinct, distinct_counts = np.unique(values, return_counts=True)
+        fine[col] = {'lo': lo, 'hi': hi, 'counts': counts, 'n': int(values.size), 'std': float(values.std(ddof=1)) if values.size > 1 else 0.0,
+                     'values': distinct, 'cumulative': np.cumsum(distinct_counts, dtype='int32' if values.size < 2 ** 31 else 'int64')}
+    return fine
+
+
+@st.cache_resource(max_entries=8) # Fine counts for every numeric column, once per dataset version
+def _dataset_fine_histograms(fingerprint, _data):
+    return _load_or_build_sidecar('histograms', FINE_HISTOGRAM_FORMAT_VERSION, fingerprint, _data, compute_fine_histograms)
+
+
+def load_fine_histograms(fingerprint, data):
+    if 'slice_key' in data.attrs:
+        return slice_sidecar('histograms', FINE_HISTOGRAM_FORMAT_VERSION, fingerprint, data, compute_fine_histograms)
+    return _dataset_fine_histograms(fingerprint, data)
+
+
+def _binned_gaussian_kde(fine):
+    # Scott's rule bandwidth, as used by seaborn's default KDE
+    counts = fine['counts'].astype('float64')
+    dx = (fine['hi'] - fine['lo']) / counts.size
+    centers = fine['lo'] + dx * (np.arange(counts.size) + 0.5)
+    bandwidth = fine['std'] * fine['n'] ** (-1 / 5)
+    if bandwidth <= 0 or fine['n'] < 2:
+        return centers, np.zeros_like(counts)
+
+    sigma = bandwidth / dx # Kernel width in fine bins
+    half = int(min(np.ceil(4 * sigma), 4 * counts.size))
+    offsets = np.arange(-half, half + 1)
+    kernel = np.exp(-0.5 * (offsets / sigma) ** 2)
+    kernel /= kernel.sum()
+
+    # Linear (zero-padded) convolution through the FFT, then keep the part aligned with the fine bins
+    size = counts.size + kernel.size - 1
+    n_fft = 1 << (size - 1).bit_length()
+    smoothed = np.fft.irfft(np.fft.rfft(counts, n_fft) * np.fft.rfft(kernel, n_fft), n_fft)[half:half + counts.size]
+    return centers, np.clip(smoothed, 0, None) / (fine['n'] * dx)
+
+
+@st.cache_data(max_entries=HISTOGRAM_CACHE_ENTRIES, show_spinner=False) # LRU eviction beyond max_entries
+def histogram_with_kde(fingerprint, column, bins, _fine_histograms):
+    fine = _fine_histograms[column]
+    cumulative = np.r_[0, fine['cumulative']] # cumulative[i] = rows below the i-th distinct value
+
+    # Bins are half-open [left, right) except the last, which also takes the maximum, as in np.histogram
+    edges = np.linspace(fine['lo'], fine['hi'], bins + 1)
+    below = np.searchsorted(fine['values'], edges, side='left')
+    below[-1] = fine['values'].size
+    counts = np.diff(cumulative[below])
+
+    kde_x, kde_density = _binned_gaussian_kde(fine)
+    kde_counts = kde_density * fine['n'] * (edges[1] - edges[0]) # Scale the density to the bar heights
+    return edges, counts, kde_x, kde_counts
+
+# --- PRE-TRAINED ARTIFACTS ---
+# Each artifact is loaded on first use by the Modeling page, not at startup. The first load re-saves it as an
+# uncompressed joblib file under .app_cache/artifacts; later loads memory-map that copy (mmap_mode='r'),
+# so its arrays are read from the shared page cache instead of being unpickled into every process.
+PRETRAINED_REGRESSION_FILE = 'linear_regression_model.pkl'
+PRETRAINED_SCALER_FILE = 'standard_scaler.pkl'
+PRETRAINED_CLASSIFICATION_FILE = 'random_forest_clf_model.pkl'
+ARTIFACT_CACHE_DIR_NAME = "artifacts"
+
+
+def pretrained_artifact_available(file_name, base_path=GOOGLE_DRIVE_BASE_PATH):
+    return os.path.exists(os.path.join(base_path, file_name))
+
+
+@st.cache_resource(show_spinner="Loading pre-trained artifact...") # One entry per artifact, shared by every session
+def load_pretrained_artifact(file_name, functionality, base_path=GOOGLE_DRIVE_BASE_PATH):
+    artifact_path = os.path.join(base_path, file_name)
     try:
-        trained_scaler = joblib.load(os.path.join(GOOGLE_DRIVE_BASE_PATH, 'standard_scaler.pkl'))
+        stat = os.stat(artifact_path)
+        stem = os.path.splitext(file_name)[0]
+        mapped_dir = os.path.join(base_path, CACHE_DIR_NAME, ARTIFACT_CACHE_DIR_NAME)
+        mapped_path = os.path.join(mapped_dir, f"{stem}-{stat.st_size}-{stat.st_mtime_ns}.joblib")
+        if not os.path.exists(mapped_path):
+            artifact = joblib.load(artifact_path)
+            tmp_path = f"{mapped_path}.{os.getpid()}.tmp"
+            try:
+                os.makedirs(mapped_dir, exist_ok=True)
+                joblib.dump(artifact, tmp_path) # Uncompressed, so its arrays can be memory-mapped
+                os.replace(tmp_path, mapped_path)
+            except OSError:
+                return artifact # Read-only data folder: use the unpickled copy
+            _remove_stale_cache_files(mapped_dir, f"{stem}-*.joblib", keep=mapped_path)
+        return joblib.load(mapped_path, mmap_mode='r')
     except FileNotFoundError:
-        st.warning(f"Warning: 'standard_scaler.pkl' not found at {os.path.join(GOOGLE_DRIVE_BASE_PATH, 'standard_scaler.pkl')}. Scaling functionality will be limited.")
+        st.warning(f"Warning: '{file_name}' not found at {artifact_path}. {functionality} functionality will be limited.")
     except Exception as e:
-        st.error(f"Error loading scaler: {e}")
+        st.error(f"Error loading {file_name}: {e}")
+    return None
+
+
+# --- DATA SLICES AND PARTITIONED STORAGE ---
+# Pages can work on a slice of the data picked in the sidebar (stations and a date range).
+# With AIRPOLLUTION_STORAGE=partitioned the full dataset is never loaded: the CSV is streamed once into a
+# Parquet dataset partitioned by station and year, and each page reads only the partitions, rows (Date
+# predicate pushed down to row-group statistics) and columns it needs. It opens on one station's latest
+# year, so nothing reads the whole store unless the user widens the slice to all of it.
+# Slices of both storage modes are shared by all sessions through one LRU bounded by SLICE_CACHE_BYTES, which
+# also holds the profile, moments and histogram sidecars computed for each slice, so they are evicted together.
+STORAGE_MODE = os.environ.get("AIRPOLLUTION_STORAGE", "memory") # "memory" or "partitioned"
+PARTITION_FORMAT_VERSION = 1
+PARTITION_CHUNK_ROWS = 1_000_000 # CSV rows parsed at a time while building the partitioned store
+PARTITION_COLUMNS = ['station', 'year']
+PARTITION_DEFAULT_DAYS = 365 # Length of the slice partitioned mode opens on (one station)
+SLICE_CACHE_BYTES = 1024 ** 3 # Slices of either storage mode, and their sidecars, kept in memory for all sessions
+OTHER_STATION_LABEL = "(other)" # Rows with no station one-hot set (the dropped reference category)
+
+
+def station_labels(frame):
+    # Station name per row, recovered from the station_* one-hot columns
+    if 'station' in frame.columns:
+        return frame['station'].astype(str)
+    station_cols = [col for col in frame.columns if col.startswith('station_')]
+    if not station_cols:
+        return pd.Series(OTHER_STATION_LABEL, index=frame.index)
+    one_hot = frame[station_cols].to_numpy(dtype=bool)
+    names = np.array([col[len('station_'):] for col in station_cols] + [OTHER_STATION_LABEL], dtype=object)
+    picked = np.where(one_hot.any(axis=1), one_hot.argmax(axis=1), len(station_cols))
+    return pd.Series(names[picked], index=frame.index)
+
+
+@st.cache_resource(max_entries=8)
+def in_memory_stations(fingerprint, _data):
+    return tuple(sorted(station_labels(_data).unique()))
+
+
+@st.cache_resource(max_entries=8)
+def in_memory_date_range(fingerprint, _data):
+    # A full scan of the Date column, so it runs once per dataset rather than on every rerun
+    return (_data['Date'].min().date(), _data['Date'].max().date())
+
+
+def slice_fingerprint(fingerprint, stations, date_range):
+    spec = json.dumps([fingerprint, sorted(stations), [str(d) for d in date_range]])
+    return hashlib.sha256(spec.encode("utf-8")).hexdigest()
+
+
+def filter_in_memory(fingerprint, stations, date_range, data):
+    key = ('memory', fingerprint, tuple(sorted(stations)), tuple(str(d) for d in date_range))
+    return cached_slice(key, lambda: _filter_in_memory(fingerprint, stations, date_range, data),
+                        "Filtering the selected stations and dates...")
+
+
+def _filter_in_memory(fingerprint, stations, date_range, data):
+    start, end = pd.Timestamp(date_range[0]), pd.Timestamp(date_range[1]) + pd.Timedelta(days=1)
+    mask = station_labels(data).isin(stations).to_numpy()
+    if 'Date' in data.columns:
+        mask = mask & ((data['Date'] >= start) & (data['Date'] < end)).to_numpy() # to_numpy() views are read-only under copy-on-write
+    sliced = data.loc[mask].reset_index(drop=True)
+    sliced.attrs = dict(data.attrs, fingerprint=slice_fingerprint(fingerprint, stations, date_range), persist_sidecars=False)
+    return sliced
+
+
+def _build_partitioned_store(csv_path, store_path):
+    # Streams the CSV in chunks, so building the store never needs the whole dataset in memory
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    tmp_path = f"{store_path}.{os.getpid()}.tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    partitioning = ds.partitioning(pa.schema([('station', pa.string()), ('year', pa.int32())]), flavor='hive')
+    schema = None
+    stations = set()
+    binary = None
+    date_min, date_max = None, None
+
+    for chunk_no, chunk in enumerate(pd.read_csv(csv_path, chunksize=PARTITION_CHUNK_ROWS)):
+        chunk = _fix_csv_types(chunk)
+        chunk['station'] = station_labels(chunk)
+        chunk['year'] = chunk['Date'].dt.year.astype('int32')
+        stations.update(chunk['station'].unique())
+        chunk_binary = binary_columns(chunk.drop(columns=PARTITION_COLUMNS))
+        binary = chunk_binary if binary is None else [col for col in binary if col in chunk_binary]
+        date_min = min(date_min, chunk['Date'].min()) if date_min is not None else chunk['Date'].min()
+        date_max = max(date_max, chunk['Date'].max()) if date_max is not None else chunk['Date'].max()
+
+        table = pa.Table.from_pandas(chunk, preserve_index=False)
+        if schema is None:
+            schema = table.schema # Later chunks are cast to the first chunk's types so every file agrees
+        else:
+            table = table.cast(schema)
+        ds.write_dataset(table, tmp_path, format='parquet', partitioning=partitioning,
+                         basename_template=f"part-{chunk_no}-{{i}}.parquet", existing_data_behavior='overwrite_or_ignore')
+
+    with open(os.path.join(tmp_path, "_store.json"), 'w') as f:
+        json.dump({'stations': sorted(stations), 'binary_columns': binary or [], 'date_min': str(date_min), 'date_max': str(date_max)}, f)
+    os.replace(tmp_path, store_path)
+
+
+@st.cache_resource(show_spinner="Preparing the partitioned dataset...")
+def load_partitioned_store(base_path=GOOGLE_DRIVE_BASE_PATH):
+    import pyarrow.dataset as ds
 
+    csv_path = os.path.join(base_path, DATA_FILE_NAME)
+    cache_dir = os.path.join(base_path, CACHE_DIR_NAME)
     try:
-        trained_model_clf = joblib.load(os.path.join(GOOGLE_DRIVE_BASE_PATH, 'random_forest_clf_model.pkl'))
+        fingerprint = _source_fingerprint(csv_path, cache_dir)
     except FileNotFoundError:
-        st.warning(f"Warning: 'random_forest_clf_model.pkl' not found at {os.path.join(GOOGLE_DRIVE_BASE_PATH, 'random_forest_clf_model.pkl')}. Classification model functionality will be limited.")
-    except Exception as e:
-        st.error(f"Error loading classification model: {e}")
+        st.error(f"Error: '{DATA_FILE_NAME}' not found at {csv_path}. Please ensure the file exists there.")
+        st.stop()
+
+    store_path = os.path.join(cache_dir, f"partitioned-{fingerprint[:16]}-v{PARTITION_FORMAT_VERSION}")
+    if not os.path.exists(os.path.join(store_path, "_store.json")):
+        os.makedirs(cache_dir, exist_ok=True)
+        _build_partitioned_store(csv_path, store_path)
+        for stale_path in glob.glob(os.path.join(cache_dir, "partitioned-*")):
+            if stale_path != store_path:
+                shutil.rmtree(stale_path, ignore_errors=True)
+
+    with open(os.path.join(store_path, "_store.json")) as f:
+        manifest = json.load(f)
+    dataset = ds.dataset(store_path, format='parquet', partitioning='hive')
+    schema = _ensure_year_month_period(dataset.schema.empty_table().to_pandas()).drop(columns=PARTITION_COLUMNS)
+    return {
+        'path': store_path,
+        'fingerprint': fingerprint,
+        'cache_dir': cache_dir,
+        'schema': schema, # Zero-row frame with the dataset's columns and dtypes
+        'stations': manifest['stations'],
+        'binary_columns': manifest.get('binary_columns'),
+        'date_range': (pd.Timestamp(manifest['date_min']).date(), pd.Timestamp(manifest['date_max']).date()),
+    }
+
+
+@st.cache_resource
+def _slice_cache_state():
+    return {'lock': threading.Lock(), 'entries': OrderedDict(), 'bytes': 0}
+
+
+def _approx_nbytes(obj):
+    # Buffer sizes of the frames and arrays in a (nested) sidecar; small scalars and strings are not counted
+    if isinstance(obj, (pd.DataFrame, pd.Series)):
+        return int(np.sum(obj.memory_usage(index=True)))
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, dict):
+        return sum(_approx_nbytes(value) for value in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sum(_approx_nbytes(value) for value in obj)
+    return 0
+
+
+def _evict_slices(state):
+    # Called with the lock held
+    while state['bytes'] > SLICE_CACHE_BYTES and state['entries']:
+        _, evicted = state['entries'].popitem(last=False)
+        state['bytes'] -= evicted['bytes']
+
+
+def cached_slice(key, build, spinner_text):
+    # Returns the slice for 'key', building it with build() on a miss. A slice larger than the whole budget is
+    # not kept and lives only as long as the session using it (its sidecars are then not kept either).
+    state = _slice_cache_state()
+    with state['lock']:
+        entry = state['entries'].get(key)
+        if entry is not None:
+            state['entries'].move_to_end(key)
+            return entry['frame']
+
+    with st.spinner(spinner_text):
+        sliced = build()
+    sliced.attrs['slice_key'] = key
+    with state['lock']:
+        if key not in state['entries']:
+            state['entries'][key] = {'frame': sliced, 'bytes': int(sliced.memory_usage(index=True).sum()), 'sidecars': {}}
+            state['bytes'] += state['entries'][key]['bytes']
+            _evict_slices(state)
+    return sliced
+
+
+def slice_sidecar(kind, version, fingerprint, data, build):
+    # Sidecars of a cached slice live in its LRU entry: they count towards SLICE_CACHE_BYTES and go with the slice
+    state = _slice_cache_state()
+    key = data.attrs['slice_key']
+    with state['lock']:
+        entry = state['entries'].get(key)
+        if entry is not None and (kind, fingerprint) in entry['sidecars']:
+            state['entries'].move_to_end(key)
+            return entry['sidecars'][(kind, fingerprint)]
+
+    obj = _load_or_build_sidecar(kind, version, fingerprint, data, build)
+    size = _approx_nbytes(obj)
+    with state['lock']:
+        entry = state['entries'].get(key)
+        if entry is not None and (kind, fingerprint) not in entry['sidecars']:
+            entry['sidecars'][(kind, fingerprint)] = obj
+            entry['bytes'] += size
+            state['bytes'] += size
+            _evict_slices(state)
+    return obj
+
+
+def read_partitioned_slice(store_path, stations, date_range, columns):
+    key = ('partitioned', store_path, tuple(sorted(stations)), tuple(str(d) for d in date_range), columns)
+    return cached_slice(key, lambda: _read_partitioned_slice(store_path, stations, date_range, columns),
+                        "Reading the selected slice...")
+
+
+def _read_partitioned_slice(store_path, stations, date_range, columns):
+    import pyarrow.dataset as ds
+
+    dataset = ds.dataset(store_path, format='parquet', partitioning='hive')
+    start, end = pd.Timestamp(date_range[0]), pd.Timestamp(date_range[1]) + pd.Timedelta(days=1)
+    # station and year prune whole partition folders; the Date bounds skip row groups by their statistics
+    predicate = (ds.field('station').isin(list(stations))
+                 & (ds.field('year') >= start.year) & (ds.field('year') <= end.year)
+                 & (ds.field('Date') >= start) & (ds.field('Date') < end))
+    if columns is None:
+        columns = [name for name in dataset.schema.names if name not in PARTITION_COLUMNS]
+    elif 'Date' not in columns:
+        columns = ['Date'] + list(columns) # Needed to restore chronological order
+
+    sliced = _ensure_year_month_period(dataset.to_table(columns=list(columns), filter=predicate).to_pandas())
+    # Partitions come back grouped by station; the chronological train/test split expects time order
+    return sliced.sort_values('Date', kind='stable').reset_index(drop=True)
+
+
+class PartitionedSlice:
+    # Stands in for the DataFrame on partitioned storage: pages see the schema (columns, dtypes, attrs) for free
+    # and call materialize() with the columns they actually use
+
+    def __init__(self, store, stations, date_range):
+        self.store = store
+        self.stations = tuple(stations)
+        self.date_range = tuple(date_range)
+        self.columns = store['schema'].columns
+        self.dtypes = store['schema'].dtypes
+        self.attrs = {
+            'fingerprint': slice_fingerprint(store['fingerprint'], self.stations, self.date_range),
+            'cache_dir': store['cache_dir'],
+            'persist_sidecars': False,
+            'binary_columns': store['binary_columns'],
+        }
+
+    def load(self, columns=None):
+        columns = tuple(dict.fromkeys(columns)) if columns is not None else None
+        with stage('load.partitioned_slice', columns=len(columns) if columns is not None else 'all'):
+            sliced = read_partitioned_slice(self.store['path'], self.stations, self.date_range, columns)
+        view = session_view(sliced) # The cached frame itself is shared with other sessions
+        view.attrs = dict(self.attrs, slice_key=sliced.attrs['slice_key'])
+        if columns is not None: # Caches keyed by fingerprint must not mix up frames holding different columns
+            spec = json.dumps([self.attrs['fingerprint'], sorted(columns)])
+            view.attrs['fingerprint'] = hashlib.sha256(spec.encode("utf-8")).hexdigest()
+        return view
+
+
+def materialize(data, columns=None):
+    # Pages call this before touching rows: a no-op for in-memory frames, a projected read for partitioned slices
+    if isinstance(data, pd.DataFrame):
+        return data
+    return data.load(columns)
+
+
+def schema_of(data):
+    # Zero-row frame with the data's columns and dtypes, without reading any rows
+    return data.head(0) if isinstance(data, pd.DataFrame) else data.store['schema']
+
+
+def default_partitioned_slice(store):
+    # Partitioned mode opens on one station's latest PARTITION_DEFAULT_DAYS rather than the whole store
+    stations = [station for station in store['stations'] if station != OTHER_STATION_LABEL][:1] or store['stations'][:1]
+    first, last = store['date_range']
+    return stations, (max(first, (pd.Timestamp(last) - pd.Timedelta(days=PARTITION_DEFAULT_DAYS - 1)).date()), last)
+
+
+def select_data_slice(all_stations, full_date_range, default_stations=None, default_date_range=None):
+    # Sidebar filter shared by every page; returns (stations, (start, end)). Empty choices fall back to the defaults,
+    # which are everything unless given.
+    default_stations = list(default_stations or all_stations)
+    default_date_range = tuple(default_date_range or full_date_range)
+    with st.sidebar.expander("🗂️ Data Slice", expanded=STORAGE_MODE == "partitioned"):
+        stations = st.multiselect("Stations", all_stations, default=default_stations, key="slice_stations")
+        picked = st.date_input("Date range", value=default_date_range, min_value=full_date_range[0],
+                               max_value=full_date_range[1], key="slice_dates")
+    date_range = tuple(picked) if isinstance(picked, (list, tuple)) and len(picked) == 2 else default_date_range
+    return tuple(stations or default_stations), date_range
+
+
+# --- INCREMENTAL FEATURE ENGINE ---
+# New hourly readings get their engineered columns from a small per-station state (the last
+# FEATURE_HISTORY_HOURS PM2.5 values) instead of a recompute over the full history. They are appended to the
+# CSV, the correlation moments and the partitioned store in O(new rows); the columnar cache, when there is
+# one, is rewritten in full (one sequential Feather write) so that it stays a single memory-mappable file.
+# Lags and rolling means run the same pandas shift()/rolling() as the offline batch over history + new rows,
+# so appended values are identical to what a full recompute would give.
+FEATURE_STATE_FORMAT_VERSION = 2
+PM25_LAGS = {'PM2.5_lag_1h': 1, 'PM2.5_lag_24h': 24}
+PM25_ROLLING_WINDOWS = {'PM2.5_rolling_mean_6h': 6, 'PM2.5_rolling_mean_24h': 24}
+FEATURE_HISTORY_HOURS = max(list(PM25_LAGS.values()) + list(PM25_ROLLING_WINDOWS.values()))
+WIND_DIRECTIONS = ['N', 'NNE', 'NE', 'ENE', 'E', 'ESE', 'SE', 'SSE', 'S', 'SSW', 'SW', 'WSW', 'W', 'WNW', 'NW', 'NNW'] # 22.5° apart
+SEASON_BY_MONTH = {12: 'Winter', 1: 'Winter', 2: 'Winter', 3: 'Spring', 4: 'Spring', 5: 'Spring',
+                   6: 'Summer', 7: 'Summer', 8: 'Summer', 9: 'Autumn', 10: 'Autumn', 11: 'Autumn'}
+DERIVED_COLUMNS = set(PM25_LAGS) | set(PM25_ROLLING_WINDOWS) | {'hour_sin', 'hour_cos', 'wd_sin', 'wd_cos', 'is_weekend', 'year_month',
+                                                                'pollution_category', 'year', 'month', 'day', 'hour'}
+DERIVED_COLUMN_PREFIXES = ('station_', 'season_', 'day_of_week_name_')
+PM25_CATEGORY_BREAKPOINTS = [(12.0, 'Good'), (35.4, 'Moderate'), (55.4, 'Unhealthy for Sensitive Groups'), (150.4, 'Unhealthy'),
+                             (250.4, 'Very Unhealthy'), (np.inf, 'Hazardous')] # US EPA PM2.5 bands (µg/m³), upper bounds inclusive
+
+
+def pm25_category(pm25):
+    # US EPA category of each PM2.5 value (None where it is missing); values are truncated to 0.1 µg/m³ first, as the EPA does
+    values = np.asarray(pm25, dtype='float64')
+    bounds = np.array([bound for bound, _ in PM25_CATEGORY_BREAKPOINTS])
+    labels = np.array([label for _, label in PM25_CATEGORY_BREAKPOINTS], dtype=object)
+    truncated = np.floor(values * 10 + 1e-9) / 10 # The epsilon keeps e.g. 12.1 (stored as 12.0999...) at 12.1
+    picked = labels[np.minimum(np.searchsorted(bounds, truncated, side='left'), len(labels) - 1)]
+    return np.where(np.isnan(values), None, picked)
+
+
+def _update_category_range(category_range, categories, pm25):
+    # PM2.5 (min, max) seen under each stored category label; returns an updated copy
+    updated = dict(category_range)
+    frame = pd.DataFrame({'category': categories, 'pm25': pm25}).dropna()
+    for label, values in frame.groupby('category')['pm25']:
+        lo, hi = updated.get(label, (np.inf, -np.inf))
+        updated[label] = (min(lo, float(values.min())), max(hi, float(values.max())))
+    return updated
+
+
+def _categories_follow_breakpoints(category_range):
+    # True when every stored category label is an EPA label whose band covers all its stored PM2.5 values
+    return all(list(pm25_category([lo, hi])) == [label, label] for label, (lo, hi) in category_range.items())
+
+
+def build_feature_state(csv_path):
+    # One pass over the CSV (only Date, PM2.5, the station one-hots and the category) keeping each station's tail
+    header = pd.read_csv(csv_path, nrows=0).columns
+    usecols = ['Date', 'PM2.5'] + [col for col in header if col.startswith('station_') or col == 'pollution_category']
+    tails = []
+    category_range = {}
+    for chunk in pd.read_csv(csv_path, usecols=usecols, chunksize=PARTITION_CHUNK_ROWS):
+        chunk['Date'] = pd.to_datetime(chunk['Date'], errors='coerce')
+        chunk = chunk.dropna(subset=['Date'])
+        chunk['station'] = station_labels(chunk)
+        tails = [pd.concat(tails + [chunk[['station', 'Date', 'PM2.5']]]).groupby('station', sort=False).tail(FEATURE_HISTORY_HOURS)]
+        if 'pollution_category' in chunk.columns:
+            category_range = _update_category_range(category_range, chunk['pollution_category'], chunk['PM2.5'])
+
+    stations = {}
+    for station, rows in (tails[0].groupby('station', sort=False) if tails else []):
+        stations[station] = {'last_date': rows['Date'].iloc[-1], 'history': rows['PM2.5'].to_numpy(dtype='float64')}
+    # The reference station (the category dropped by the one-hot encoding) has no column to take its name from;
+    # it is filled in by the first append that names it
+    return {'stations': stations, 'category_range': category_range, 'reference_station': None}
+
+
+def load_feature_state(csv_path, cache_dir, fingerprint):
+    sidecar_path = _sidecar_path(cache_dir, 'features', FEATURE_STATE_FORMAT_VERSION, fingerprint)
+    if os.path.exists(sidecar_path):
+        try:
+            return joblib.load(sidecar_path)
+        except Exception:
+            pass # Unreadable: rebuild it below
+    state = build_feature_state(csv_path)
+    save_sidecar(cache_dir, 'features', FEATURE_STATE_FORMAT_VERSION, fingerprint, state)
+    return state
+
+
+def _wind_direction_degrees(wd):
+    # Raw readings carry a compass label ('NNE'); numeric values are taken as degrees already
+    as_number = pd.to_numeric(wd, errors='coerce')
+    from_label = wd.map({label: i * 22.5 for i, label in enumerate(WIND_DIRECTIONS)})
+    degrees = as_number.fillna(from_label)
+    if degrees.isna().any():
+        raise ValueError(f"Unknown wind directions: {sorted(wd[degrees.isna()].astype(str).unique())}")
+    return degrees.astype('float64')
+
+
+def engineer_features(state, readings, columns, reference_station=None):
+    # Returns (rows with every dataset column, updated state); 'state' itself is left untouched.
+    # reference_station names the station without a station_ column, unless the state already knows it.
+    readings = readings.copy()
+    if 'Date' not in readings.columns and {'year', 'month', 'day', 'hour'} <= set(readings.columns):
+        readings['Date'] = pd.to_datetime(readings[['year', 'month', 'day', 'hour']])
+    # Every dataset column that is not computed here must be uploaded, so no row is stored with a silently
+    # missing measurement; wd_sin / wd_cos need the raw wind direction
+    required = ['Date', 'station'] + [col for col in columns if col != 'Date' and col not in DERIVED_COLUMNS
+                                      and not col.startswith(DERIVED_COLUMN_PREFIXES)]
+    if 'wd_sin' in columns or 'wd_cos' in columns:
+        required.append('wd')
+    missing = [col for col in required if col not in readings.columns]
+    if missing:
+        raise ValueError(f"New readings are missing required columns: {', '.join(missing)}")
+    readings['Date'] = pd.to_datetime(readings['Date'])
+    readings['PM2.5'] = readings['PM2.5'].astype('float64')
+    readings = readings.sort_values('Date', kind='stable').reset_index(drop=True)
+
+    # Only stations with a one-hot column and the named reference station (stored as OTHER_STATION_LABEL) are
+    # accepted, so a misspelt name can't pick up another station's history
+    one_hot_stations = {col[len('station_'):] for col in columns if col.startswith('station_')}
+    known_reference = state.get('reference_station')
+    if reference_station and known_reference and reference_station != known_reference:
+        raise ValueError(f"The reference station is {known_reference}, not {reference_station}.")
+    reference = reference_station or known_reference
+    if reference in one_hot_stations:
+        raise ValueError(f"{reference} has its own station_ column, so it is not the reference station.")
+    readings['station'] = readings['station'].astype(str)
+    unknown = set(readings['station']) - one_hot_stations - {reference}
+    if unknown:
+        hint = ""
+        if reference is None and OTHER_STATION_LABEL in state['stations']:
+            hint = " If they are for the station without a station_ column, give its name as the reference station."
+        raise ValueError(f"Unknown stations: {sorted(unknown)}.{hint}")
+    station_key = readings['station'].where(readings['station'] != reference, OTHER_STATION_LABEL)
+
+    stations = dict(state['stations'])
+    for station, rows in readings.groupby(station_key, sort=False):
+        previous = stations.get(station, {'last_date': None, 'history': np.empty(0)})
+        if previous['last_date'] is not None and rows['Date'].iloc[0] <= previous['last_date']:
+            raise ValueError(f"Readings for {station} must be newer than {previous['last_date']}, the last stored hour.")
+        history = previous['history']
+        series = pd.Series(np.concatenate([history, rows['PM2.5'].to_numpy()]))
+        for col, hours in PM25_LAGS.items():
+            readings.loc[rows.index, col] = series.shift(hours).to_numpy()[len(history):]
+        for col, window in PM25_ROLLING_WINDOWS.items():
+            readings.loc[rows.index, col] = series.rolling(window).mean().to_numpy()[len(history):]
+        stations[station] = {'last_date': rows['Date'].iloc[-1], 'history': series.to_numpy()[-FEATURE_HISTORY_HOURS:]}
+
+    for part in ['year', 'month', 'day', 'hour']:
+        if part in columns and part not in readings.columns:
+            readings[part] = getattr(readings['Date'].dt, part)
+    hour = readings['Date'].dt.hour
+    readings['hour_sin'] = np.sin(2 * np.pi * hour / 24)
+    readings['hour_cos'] = np.cos(2 * np.pi * hour / 24)
+    if 'wd' in readings.columns:
+        radians = np.deg2rad(_wind_direction_degrees(readings['wd']))
+        readings['wd_sin'] = np.sin(radians)
+        readings['wd_cos'] = np.cos(radians)
+    readings['is_weekend'] = (readings['Date'].dt.dayofweek >= 5).astype(int)
+    readings['year_month'] = readings['Date'].dt.to_period('M')
+
+    categories = {
+        'station_': readings['station'],
+        'season_': readings['Date'].dt.month.map(SEASON_BY_MONTH),
+        'day_of_week_name_': readings['Date'].dt.day_name(),
+    }
+    for col in columns:
+        for prefix, values in categories.items():
+            if col.startswith(prefix):
+                readings[col] = values == col[len(prefix):]
+
+    category_range = state['category_range']
+    if 'pollution_category' in columns:
+        if 'pollution_category' not in readings.columns:
+            # Derived only when the stored labels are the EPA bands, so appended rows are labelled like the rest
+            if not _categories_follow_breakpoints(category_range):
+                raise ValueError("New readings need a pollution_category column: the stored categories don't follow "
+                                 "the US EPA PM2.5 breakpoints, so it can't be derived from PM2.5.")
+            readings['pollution_category'] = pm25_category(readings['PM2.5'])
+        category_range = _update_category_range(category_range, readings['pollution_category'], readings['PM2.5'])
+
+    new_state = {'stations': stations, 'category_range': category_range,
+                 'reference_station': reference if (readings['station'] == reference).any() else known_reference}
+    return readings.reindex(columns=columns), new_state
+
+
+@st.cache_resource
+def _append_lock():
+    return threading.Lock() # One append at a time per server
+
+
+def _link_or_copy(src, dst):
+    # Parquet files are never modified once written, so two store versions can share them
+    try:
+        os.link(src, dst)
+    except OSError: # No hard links here (or across devices): copy instead
+        shutil.copy2(src, dst)
+
+
+def _append_to_partitioned_store(cache_dir, old_fingerprint, new_fingerprint, new_rows):
+    # The new version is built in a temporary directory (the old version's files hard-linked, the new rows and
+    # a new manifest written) and swapped in with os.replace, like every other cache write. The old directory is
+    # left intact for sessions still reading it and removed by the next append, once they have moved over.
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    old_path = os.path.join(cache_dir, f"partitioned-{old_fingerprint[:16]}-v{PARTITION_FORMAT_VERSION}")
+    if not os.path.exists(os.path.join(old_path, "_store.json")):
+        return # No store yet; it is built from the updated CSV on first use
+    new_path = os.path.join(cache_dir, f"partitioned-{new_fingerprint[:16]}-v{PARTITION_FORMAT_VERSION}")
+
+    new_rows = new_rows.copy()
+    new_rows['station'] = station_labels(new_rows)
+    new_rows['year'] = new_rows['Date'].dt.year.astype('int32')
+    schema = ds.dataset(old_path, format='parquet', partitioning='hive').schema
+    file_schema = pa.schema([field for field in schema if field.name not in PARTITION_COLUMNS] +
+                            [pa.field('station', pa.string()), pa.field('year', pa.int32())])
+    table = pa.Table.from_pandas(new_rows, preserve_index=False).select(file_schema.names).cast(file_schema)
+    partitioning = ds.partitioning(pa.schema([('station', pa.string()), ('year', pa.int32())]), flavor='hive')
+    tmp_path = f"{new_path}.{os.getpid()}.tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    shutil.copytree(old_path, tmp_path, copy_function=_link_or_copy, ignore=shutil.ignore_patterns("_store.json"))
+    ds.write_dataset(table, tmp_path, format='parquet', partitioning=partitioning,
+                     basename_template=f"append-{new_fingerprint[:16]}-{{i}}.parquet", existing_data_behavior='overwrite_or_ignore')
+
+    with open(os.path.join(old_path, "_store.json")) as f:
+        manifest = json.load(f)
+    manifest['stations'] = sorted(set(manifest['stations']) | set(new_rows['station']))
+    if manifest.get('binary_columns') is not None:
+        still_binary = binary_columns(new_rows[manifest['binary_columns']])
+        manifest['binary_columns'] = [col for col in manifest['binary_columns'] if col in still_binary]
+    manifest['date_max'] = str(max(pd.Timestamp(manifest['date_max']), new_rows['Date'].max()))
+    with open(os.path.join(tmp_path, "_store.json"), 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, new_path)
+    for stale_path in glob.glob(os.path.join(cache_dir, "partitioned-*")):
+        if stale_path not in (old_path, new_path) and not stale_path.endswith(".tmp"): # .tmp: a build in progress
+            shutil.rmtree(stale_path, ignore_errors=True)
+
+
+def append_readings(readings, base_path=GOOGLE_DRIVE_BASE_PATH, reference_station=None):
+    # Engineers and appends new hourly readings; returns (rows appended, new dataset fingerprint)
+    csv_path = os.path.join(base_path, DATA_FILE_NAME)
+    cache_dir = os.path.join(base_path, CACHE_DIR_NAME)
+    with _append_lock():
+        old_fingerprint = _source_fingerprint(csv_path, cache_dir)
+        state = load_feature_state(csv_path, cache_dir, old_fingerprint)
+        header = pd.read_csv(csv_path, nrows=0).columns.tolist()
+        new_rows, new_state = engineer_features(state, readings, header, reference_station)
+
+        # Typed rows are parsed back from the exact bytes we append, so they match what a full reload would give
+        payload = new_rows.to_csv(header=False, index=False).encode("utf-8")
+        typed_rows = _fix_csv_types(pd.read_csv(io.BytesIO(payload), names=header))
+        with open(csv_path, 'rb+') as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell() > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    f.write(b"\n")
+            f.write(payload)
+
+        # The new version's fingerprint chains the old one with the appended bytes, so the CSV is not re-hashed
+        new_fingerprint = hashlib.sha256(old_fingerprint.encode("utf-8") + payload).hexdigest()
+        stat = os.stat(csv_path)
+        with open(os.path.join(cache_dir, "source_manifest.json"), 'w') as f:
+            json.dump({'path': os.path.abspath(csv_path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': new_fingerprint}, f)
+        save_sidecar(cache_dir, 'features', FEATURE_STATE_FORMAT_VERSION, new_fingerprint, new_state)
+
+        cached = _read_columnar_cache(cache_dir, old_fingerprint)
+        if cached is not None: # Rewritten whole: the memory-mapped cache is one Feather file
+            _write_columnar_cache(pd.concat([cached, typed_rows], ignore_index=True), cache_dir, new_fingerprint)
+
+        moments_path = _sidecar_path(cache_dir, 'moments', MOMENTS_FORMAT_VERSION, old_fingerprint)
+        if os.path.exists(moments_path):
+            moments = joblib.load(moments_path)
+            save_sidecar(cache_dir, 'moments', MOMENTS_FORMAT_VERSION, new_fingerprint, update_moments(moments, typed_rows))
+
+        _append_to_partitioned_store(cache_dir, old_fingerprint, new_fingerprint, typed_rows)
+    # Profile and histogram sidecars are rebuilt for the new version on first use
+    return len(typed_rows), new_fingerprint
+
+
+def show_append_readings():
+    with st.expander("➕ Append New Hourly Readings"):
+        st.write("Upload raw readings (`Date` or `year`/`month`/`day`/`hour`, `station`, every pollutant and weather column "
+                 "of the dataset and `wd`). "
+                 "Lag, rolling, cyclical and one-hot columns are computed from each station's latest stored hours.")
+        uploaded = st.file_uploader("New readings (CSV)", type=['csv'], key="append_readings_file")
+        if uploaded is None:
+            return
+        readings = pd.read_csv(uploaded)
+        reference_station = st.text_input("Reference station", key="append_reference_station",
+                                          help="The station without a station_ column (the category dropped by the one-hot "
+                                               "encoding). Only needed the first time it gets new readings; it is remembered.")
+        if st.button(f"Append {len(readings)} readings to the dataset", key="append_readings_button"):
+            try:
+                with st.spinner("Appending readings..."):
+                    n_rows, _ = append_readings(readings, reference_station=reference_station.strip() or None)
+            except ValueError as e:
+                st.error(f"Could not append these readings: {e}")
+                return
+            load_and_preprocess_data_for_app.clear()
+            load_partitioned_store.clear()
+            st.toast(f"✅ Appended {n_rows} rows.") # Toasts survive the rerun below
+            st.rerun()
 
-    return trained_model_reg, trained_scaler, trained_model_clf
 
 # Global variables for loaded data, models, scaler
-app_data = load_and_preprocess_data_for_app() # Corrected function call
-trained_reg_model, trained_scaler, trained_clf_model = load_trained_models_and_scaler() # Corrected function call
+begin_stage_run() # Stages from here to the end of main() belong to this script run
+if STORAGE_MODE == "partitioned":
+    app_data = None # Never materialized; pages read slices from app_store
+    with stage('load.partitioned_store'):
+        app_store = load_partitioned_store()
+else:
+    with stage('load.dataset'):
+        app_data = load_and_preprocess_data_for_app() # Shared read-only frame; pages get session_view(app_data)
+    load_dataset_profile(app_data.attrs['fingerprint'], app_data) # Profile at load time rather than on first visit
+    load_correlation_moments(app_data.attrs['fingerprint'], app_data)
+    load_fine_histograms(app_data.attrs['fingerprint'], app_data)
+
+# --- RENDERED FIGURE CACHE ---
+# Charts are drawn on their own matplotlib Figure (never through pyplot's global current-figure state, so
+# concurrent sessions can't draw into each other's plots and nothing is left open), encoded to PNG once and
+# kept in an LRU shared by all sessions, bounded by total bytes. The key is the plot kind, its columns and
+# parameters, and a fingerprint of the data drawn (dataset fingerprint, or the model cache key for model
+# plots), so reruns and other sessions showing the same chart skip drawing entirely.
+FIGURE_CACHE_BYTES = 64 * 1024 ** 2
+FIGURE_DPI = 100
+
+
+@st.cache_resource
+def _figure_cache_state():
+    return {'lock': threading.Lock(), 'entries': OrderedDict(), 'bytes': 0}
+
+
+def render_figure(kind, params, fingerprint, draw, figsize=(10, 6)):
+    # Returns PNG bytes; draw(fig, ax) is only called on a cache miss
+    key = hashlib.sha256(json.dumps([kind, params, fingerprint, figsize], sort_keys=True, default=str).encode("utf-8")).hexdigest()
+    state = _figure_cache_state()
+    with stage(f'render.{kind}') as labels: # Includes the computations draw() runs, which show up nested
+        with state['lock']:
+            if key in state['entries']:
+                state['entries'].move_to_end(key)
+                labels['cache'] = 'hit'
+                return state['entries'][key]
+        labels['cache'] = 'miss'
+
+        from matplotlib.figure import Figure
+        fig = Figure(figsize=figsize, dpi=FIGURE_DPI)
+        ax = fig.subplots()
+        draw(fig, ax)
+        buffer = io.BytesIO()
+        fig.savefig(buffer, format='png', bbox_inches='tight')
+        png = buffer.getvalue()
+
+    with state['lock']:
+        if key not in state['entries']:
+            state['entries'][key] = png
+            state['bytes'] += len(png)
+        while state['bytes'] > FIGURE_CACHE_BYTES and len(state['entries']) > 1:
+            _, evicted = state['entries'].popitem(last=False)
+            state['bytes'] -= len(evicted)
+    return png
+
+
+def show_figure(kind, params, fingerprint, draw, figsize=(10, 6)):
+    st.image(render_figure(kind, params, fingerprint, draw, figsize))
+
 
 # --- Page 1: Data Overview ---
-def data_overview(data): # 'data' here is app_data from global scope
+def data_overview(data): # 'data' here is a session_view of the shared app_data (or of the selected slice)
+    data = materialize(data) # The overview shows every column
     st.title("📊 1. Data Overview")
     st.write("This page provides a structured overview of the **fully preprocessed and engineered dataset** you are working with.")
 
     num_rows = st.sidebar.slider("Number of rows to preview", min_value=5, max_value=50, value=5, step=5)
 
+    # All full-scan statistics come from the precomputed profile; only the preview touches the data
+    with stage('overview.profile'):
+        profile = load_dataset_profile(data.attrs['fingerprint'], data)
+
     col1, col2 = st.columns(2)
 
     with col1:
         st.subheader("📐 Dataset Shape")
-        st.metric(label="Rows", value=data.shape[0])
-        st.metric(label="Columns", value=data.shape[1])
+        st.metric(label="Rows", value=profile['shape'][0])
+        st.metric(label="Columns", value=profile['shape'][1])
 
     with col2:
         st.subheader("🧬 Data Types")
-        buffer = io.StringIO()
-        data.info(buf=buffer)
-        s = buffer.getvalue()
-        st.text(s)
+        st.text(profile['info'])
 
     with st.expander("🔍 Preview Sample Data"):
-        st.dataframe(data.head(num_rows))
+        with stage('overview.preview'):
+            preview = data.head(num_rows)
+        st.dataframe(preview)
 
     with st.expander("📈 Summary Statistics"):
-        st.dataframe(data.describe(include='all'))
+        st.dataframe(profile['describe'])
 
     with st.expander("🚫 Missing Values Check"):
-        missing_values_summary = data.isnull().sum().rename('Missing Count').to_frame()
-        missing_values_summary['% of Total Values'] = (missing_values_summary['Missing Count'] / data.shape[0]) * 100
+        missing_values_summary = profile['missing'].rename('Missing Count').to_frame()
+        missing_values_summary['% of Total Values'] = (missing_values_summary['Missing Count'] / profile['shape'][0]) * 100
         st.dataframe(missing_values_summary[missing_values_summary['Missing Count'] > 0].sort_values(by='Missing Count', ascending=False))
         if missing_values_summary['Missing Count'].sum() == 0:
             st.success("✅ No missing values found in the processed dataset!")
@@ -129,7 +1440,7 @@ def data_overview(data): # 'data' here is app_data from global scope
             st.error("❌ Warning: Missing values are still present in the processed dataset. This should be addressed during preprocessing.")
 
     # ---- Categorical Column Distribution (Now using one-hot encoded bools) ----
-    boolean_cols = data.select_dtypes(include='bool').columns.tolist()
+    boolean_cols = list(profile['bool_counts'])
 
     if len(boolean_cols) > 0:
         st.subheader("🧮 One-Hot Encoded Feature Distribution (Boolean Counts)")
@@ -137,33 +1448,100 @@ def data_overview(data): # 'data' here is app_data from global scope
 
         selected_bool_col = st.selectbox("Select a one-hot encoded (boolean) column to visualize", boolean_cols, key="bool_dist_select")
 
-        bool_counts = data[selected_bool_col].value_counts().reset_index()
+        bool_counts = profile['bool_counts'][selected_bool_col].reset_index()
         bool_counts.columns = [selected_bool_col, 'Count']
 
-        plt.figure(figsize=(8, 5))
-        sns.barplot(data=bool_counts, x=selected_bool_col, y='Count', palette='pastel', hue=selected_bool_col, legend=False)
-        plt.title(f"Distribution of {selected_bool_col}")
-        st.pyplot(plt.gcf())
-        plt.clf()
+        def draw(fig, ax):
+            import seaborn as sns # Imported on first draw so the rest of the page renders first
+            sns.barplot(data=bool_counts, x=selected_bool_col, y='Count', palette='pastel', hue=selected_bool_col, legend=False, ax=ax)
+            ax.set_title(f"Distribution of {selected_bool_col}")
+
+        show_figure('bool_counts', {'column': selected_bool_col}, data.attrs['fingerprint'], draw, figsize=(8, 5))
     else:
         st.info("No boolean (one-hot encoded) columns found for distribution plot in this section.")
 
+    show_append_readings()
+
     st.write("---") # Separator
 
 
+# --- AGGREGATED RENDERING FOR LARGE DATA ---
+# Scatter and time-series plots are drawn from binned aggregates instead of one marker per row, so render
+# time depends on the point budget (roughly the number of pixels we can show), not on the dataset size.
+DEFAULT_POINT_BUDGET = 2000
+
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def density_grid(fingerprint, x_col, y_col, gridsize, _data):
+    # Vectorized 2-D binning of the (x, y) pairs; empty bins are left at 0 and masked when drawn
+    x = _data[x_col].to_numpy(dtype='float64', na_value=np.nan)
+    y = _data[y_col].to_numpy(dtype='float64', na_value=np.nan)
+    finite = np.isfinite(x) & np.isfinite(y)
+    counts, x_edges, y_edges = np.histogram2d(x[finite], y[finite], bins=gridsize)
+    return counts, x_edges, y_edges
+
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def resample_time_series(fingerprint, value_col, n_buckets, _data):
+    # Min/max/mean per equal-width time bucket. Rows are sorted once and each bucket is a contiguous
+    # run, so ufunc.reduceat does the aggregation without a Python loop. Empty buckets are skipped.
+    t = _data['Date'].to_numpy(dtype='datetime64[ns]').astype('int64')
+    v = _data[value_col].to_numpy(dtype='float64', na_value=np.nan)
+    valid = np.isfinite(v) & (t != np.iinfo('int64').min) # NaT is stored as int64 min
+    t, v = t[valid], v[valid]
+    if t.size == 0:
+        return None
+
+    order = np.argsort(t, kind='stable')
+    t, v = t[order], v[order]
+    edges = np.linspace(t[0], t[-1], n_buckets + 1)
+    bucket = np.clip(np.searchsorted(edges, t, side='right') - 1, 0, n_buckets - 1)
+    starts = np.flatnonzero(np.r_[True, bucket[1:] != bucket[:-1]])
+
+    counts = np.diff(np.r_[starts, t.size])
+    centers = (edges[bucket[starts]] + (edges[1] - edges[0]) / 2).astype('int64')
+    return pd.DataFrame({
+        'Date': pd.to_datetime(centers),
+        'mean': np.add.reduceat(v, starts) / counts,
+        'min': np.minimum.reduceat(v, starts),
+        'max': np.maximum.reduceat(v, starts),
+    })
+
+
 # --- Page 2: Exploratory Data Analysis (EDA) ---
-def eda(data): # 'data' here is app_data from global scope
+KEY_FEATURES_FOR_HEATMAP = [
+    'PM2.5', 'PM10', 'SO2', 'NO2', 'CO', 'O3',
+    'TEMP', 'PRES', 'DEWP', 'RAIN', 'WSPM',
+    'PM2.5_lag_1h', 'PM2.5_lag_24h',
+    'PM2.5_rolling_mean_6h', 'PM2.5_rolling_mean_24h',
+    'hour_sin', 'hour_cos', 'wd_sin', 'wd_cos',
+    'is_weekend',
+    # Add a few key one-hot encoded station/season/dayofweek if desired, e.g.:
+    # 'station_Dingling', 'season_Winter', 'day_of_week_name_Monday'
+]
+
+
+def eda(data): # 'data' here is a session_view of the shared app_data (or of the selected slice)
+    import seaborn as sns
+    from matplotlib.colors import LogNorm
+
+    # Widgets are filled from the schema; each tab then materializes only the columns it plots
+    schema = schema_of(data)
     st.title("📊 2. Exploratory Data Analysis (EDA)")
     st.write("This section provides visual insights into the dataset.")
 
     # Features (from fully processed data) - ensure these are the features used in model training if applicable
-    features_for_eda_selection = [col for col in data.columns if col not in ['pollution_category', 'PM2.5', 'Date', 'year_month']] # Exclude more columns relevant to final cleanup
-    numeric_data_for_selectboxes = data[features_for_eda_selection].select_dtypes(include=np.number).columns.tolist() # Select only numeric features
+    features_for_eda_selection = [col for col in schema.columns if col not in ['pollution_category', 'PM2.5', 'Date', 'year_month']] # Exclude more columns relevant to final cleanup
+    numeric_data_for_selectboxes = schema[features_for_eda_selection].select_dtypes(include=np.number).columns.tolist() # Select only numeric features
 
     if not numeric_data_for_selectboxes:
         st.warning("No suitable numeric columns available for EDA. Ensure your data is processed and features are selected.")
         return
 
+    fingerprint = data.attrs['fingerprint'] # Figure keys; computations are keyed by the materialized columns' fingerprint
+    point_budget = st.sidebar.number_input("Max points per chart", min_value=200, max_value=50000, value=DEFAULT_POINT_BUDGET, step=200,
+                                           help="Scatter and line charts with more rows than this are drawn from binned aggregates.")
+
     tab1, tab2, tab3, tab4, tab5 = st.tabs([
         "📉 Correlation Heatmap",
         "📊 Histogram",
@@ -177,27 +1555,22 @@ def eda(data): # 'data' here is app_data from global scope
         st.subheader("Correlation Heatmap")
         st.caption("Shows pairwise correlation between selected numeric features.")
 
-        key_features_for_heatmap = [
-            'PM2.5', 'PM10', 'SO2', 'NO2', 'CO', 'O3',
-            'TEMP', 'PRES', 'DEWP', 'RAIN', 'WSPM',
-            'PM2.5_lag_1h', 'PM2.5_lag_24h',
-            'PM2.5_rolling_mean_6h', 'PM2.5_rolling_mean_24h',
-            'hour_sin', 'hour_cos', 'wd_sin', 'wd_cos',
-            'is_weekend',
-            # Add a few key one-hot encoded station/season/dayofweek if desired, e.g.:
-            # 'station_Dingling', 'season_Winter', 'day_of_week_name_Monday'
-        ]
-        available_features_for_heatmap = [f for f in key_features_for_heatmap if f in data.columns and pd.api.types.is_numeric_dtype(data[f])]
+        available_features_for_heatmap = [f for f in KEY_FEATURES_FOR_HEATMAP if f in schema.columns and pd.api.types.is_numeric_dtype(schema[f])]
 
         if len(available_features_for_heatmap) > 1:
-            corr = data[available_features_for_heatmap].corr()
-            plt.figure(figsize=(12, 10))
-            sns.heatmap(corr, annot=True, cmap='coolwarm', fmt=".2f", linewidths=.5, cbar_kws={'shrink': .8})
-            plt.title("Selected Feature Correlation Heatmap")
-            plt.xticks(rotation=45, ha='right')
-            plt.yticks(rotation=0)
-            st.pyplot(plt.gcf())
-            plt.clf()
+            def draw(fig, ax):
+                heatmap_data = materialize(data, available_features_for_heatmap) # Only read when the figure isn't cached
+                with stage('eda.heatmap.correlation'):
+                    corr = correlation_from_moments(load_correlation_moments(heatmap_data.attrs['fingerprint'], heatmap_data),
+                                                    available_features_for_heatmap)
+                sns.heatmap(corr, annot=True, cmap='coolwarm', fmt=".2f", linewidths=.5, cbar_kws={'shrink': .8}, ax=ax)
+                ax.set_title("Selected Feature Correlation Heatmap")
+                ax.tick_params(axis='x', rotation=45)
+                for label in ax.get_xticklabels():
+                    label.set_horizontalalignment('right')
+                ax.tick_params(axis='y', rotation=0)
+
+            show_figure('correlation_heatmap', {'columns': available_features_for_heatmap}, fingerprint, draw, figsize=(12, 10))
         else:
             st.info("Not enough selected features for a correlation heatmap. Please ensure your data has sufficient numeric columns.")
 
@@ -207,11 +1580,23 @@ def eda(data): # 'data' here is app_data from global scope
         hist_col = st.selectbox("Select a column for histogram", numeric_data_for_selectboxes, key="hist")
         bins = st.slider("Number of bins", min_value=5, max_value=100, value=30)
 
-        plt.figure(figsize=(10, 6))
-        sns.histplot(data[hist_col], kde=True, bins=bins, color='orange')
-        plt.title(f"Histogram of {hist_col}")
-        st.pyplot(plt.gcf())
-        plt.clf()
+        hist_data = materialize(data, [hist_col])
+        with stage('eda.histogram.fine_counts'):
+            fine_histograms = load_fine_histograms(hist_data.attrs['fingerprint'], hist_data)
+        if hist_col not in fine_histograms:
+            st.info(f"'{hist_col}' has no finite values to plot.")
+
+        def draw(fig, ax):
+            if hist_col in fine_histograms:
+                with stage('eda.histogram.bins_kde'):
+                    edges, counts, kde_x, kde_counts = histogram_with_kde(hist_data.attrs['fingerprint'], hist_col, bins, fine_histograms)
+                ax.bar(edges[:-1], counts, width=np.diff(edges), align='edge', color='orange', alpha=0.5, edgecolor='white')
+                ax.plot(kde_x, kde_counts, color='orange', linewidth=2)
+                ax.set_xlabel(hist_col)
+                ax.set_ylabel("Count")
+            ax.set_title(f"Histogram of {hist_col}")
+
+        show_figure('histogram', {'column': hist_col, 'bins': bins}, fingerprint, draw)
 
     # Tab 3: Scatter Plot
     with tab3:
@@ -220,11 +1605,25 @@ def eda(data): # 'data' here is app_data from global scope
         y_scatter = st.selectbox("Y-axis", numeric_data_for_selectboxes, key="scatter_y")
 
         if x_scatter and y_scatter and x_scatter != y_scatter: # Ensure both selected and different
-            plt.figure(figsize=(10, 6))
-            sns.scatterplot(x=data[x_scatter], y=data[y_scatter], alpha=0.6, s=10)
-            plt.title(f"{x_scatter} vs {y_scatter}")
-            st.pyplot(plt.gcf())
-            plt.clf()
+            scatter_data = materialize(data, [x_scatter, y_scatter])
+            # Too many rows for one marker each: show row density on a grid with about point_budget cells
+            gridsize = max(int(np.sqrt(point_budget)), 10) if len(scatter_data) > point_budget else None
+
+            def draw(fig, ax):
+                if gridsize is None:
+                    sns.scatterplot(x=scatter_data[x_scatter], y=scatter_data[y_scatter], alpha=0.6, s=10, ax=ax)
+                else:
+                    with stage('eda.scatter.density_grid'):
+                        counts, x_edges, y_edges = density_grid(scatter_data.attrs['fingerprint'], x_scatter, y_scatter, gridsize, scatter_data)
+                    mesh = ax.pcolormesh(x_edges, y_edges, np.ma.masked_equal(counts.T, 0), cmap='viridis', norm=LogNorm())
+                    fig.colorbar(mesh, ax=ax, label="Rows per bin")
+                    ax.set_xlabel(x_scatter)
+                    ax.set_ylabel(y_scatter)
+                ax.set_title(f"{x_scatter} vs {y_scatter}")
+
+            if gridsize is not None:
+                st.caption(f"{len(scatter_data):,} rows binned into a {gridsize}×{gridsize} density grid.")
+            show_figure('scatter', {'x': x_scatter, 'y': y_scatter, 'gridsize': gridsize}, fingerprint, draw)
         else:
             st.info("Please select different columns for X and Y axes.")
 
@@ -232,8 +1631,8 @@ def eda(data): # 'data' here is app_data from global scope
     with tab4:
         st.subheader("Box Plot (Numeric vs. Categorical/Boolean)")
 
-        boolean_cols_for_boxplot_x = data.select_dtypes(include='bool').columns.tolist()
-        original_categorical_cols = data.select_dtypes(include=['object', 'category']).columns.tolist()
+        boolean_cols_for_boxplot_x = schema.select_dtypes(include='bool').columns.tolist()
+        original_categorical_cols = schema.select_dtypes(include=['object', 'category']).columns.tolist()
 
         cat_col_options = []
         if boolean_cols_for_boxplot_x:
@@ -246,12 +1645,13 @@ def eda(data): # 'data' here is app_data from global scope
             num_col_for_boxplot = st.selectbox("Select Numeric Column (Y-axis)", numeric_data_for_selectboxes, key="boxplot_y")
 
             if num_col_for_boxplot:
-                plt.figure(figsize=(10, 6))
-                sns.boxplot(x=data[cat_col_for_boxplot], y=data[num_col_for_boxplot])
-                plt.xticks(rotation=45)
-                plt.title(f"{num_col_for_boxplot} Distribution across {cat_col_for_boxplot}")
-                st.pyplot(plt.gcf())
-                plt.clf()
+                def draw(fig, ax):
+                    box_data = materialize(data, [cat_col_for_boxplot, num_col_for_boxplot])
+                    sns.boxplot(x=box_data[cat_col_for_boxplot], y=box_data[num_col_for_boxplot], ax=ax)
+                    ax.tick_params(axis='x', rotation=45)
+                    ax.set_title(f"{num_col_for_boxplot} Distribution across {cat_col_for_boxplot}")
+
+                show_figure('boxplot', {'x': cat_col_for_boxplot, 'y': num_col_for_boxplot}, fingerprint, draw)
             else:
                 st.info("Please select a numeric column for the Y-axis.")
         else:
@@ -261,37 +1661,1025 @@ def eda(data): # 'data' here is app_data from global scope
     # Tab 5: Line Chart (for time series)
     with tab5:
         st.subheader("Line Chart (Time Series)")
-        if 'Date' in data.columns and pd.api.types.is_datetime64_any_dtype(data['Date']):
+        if 'Date' in schema.columns and pd.api.types.is_datetime64_any_dtype(schema['Date']):
             line_col = st.selectbox("Select Numeric Column to Plot Over Time", numeric_data_for_selectboxes, key="linechart_y")
 
             if line_col:
-                plt.figure(figsize=(12, 6))
-                sns.lineplot(x=data['Date'], y=data[line_col], errorbar=None)
-                plt.title(f"{line_col} Over Time")
-                plt.xlabel("Date")
-                plt.ylabel(line_col)
-                plt.xticks(rotation=45)
-                st.pyplot(plt.gcf())
-                plt.clf()
+                series_data = materialize(data, ['Date', line_col])
+                # One mean point per time bucket, with the bucket's min-max range shaded around it
+                with stage('eda.time_series.resample'):
+                    resampled = (resample_time_series(series_data.attrs['fingerprint'], line_col, int(point_budget), series_data)
+                                 if len(series_data) > point_budget else None)
+                if resampled is not None:
+                    st.caption(f"{len(series_data):,} rows resampled into {len(resampled):,} time buckets (min / max / mean).")
+
+                def draw(fig, ax):
+                    if len(series_data) <= point_budget:
+                        sns.lineplot(x=series_data['Date'], y=series_data[line_col], errorbar=None, ax=ax)
+                    elif resampled is not None:
+                        ax.fill_between(resampled['Date'], resampled['min'], resampled['max'], alpha=0.25, linewidth=0, label="Min-max range")
+                        ax.plot(resampled['Date'], resampled['mean'], linewidth=1, label="Mean")
+                        ax.legend()
+                    ax.set_title(f"{line_col} Over Time")
+                    ax.set_xlabel("Date")
+                    ax.set_ylabel(line_col)
+                    ax.tick_params(axis='x', rotation=45)
+
+                show_figure('time_series', {'column': line_col, 'point_budget': int(point_budget)}, fingerprint, draw, figsize=(12, 6))
         else:
             st.info("Datetime column 'Date' not found or not in correct format. Ensure it's in your processed dataset for time series plots.")
 
 
+# --- TRAINED-MODEL CACHE ---
+# Fitted models are cached with their scaler, test-set predictions and metrics, keyed by everything that
+# affects them: dataset fingerprint, task, features, split, model type and hyperparameters. Widget changes
+# unrelated to modeling (or revisiting an earlier configuration) then skip model.fit() entirely.
+# Tier 1 is a small in-memory LRU shared by all sessions; tier 2 is a size-bounded folder of joblib files.
+MODEL_CACHE_MEMORY_ENTRIES = 8
+MODEL_CACHE_DISK_BYTES = 2 * 1024 ** 3
+MODEL_CACHE_DIR_NAME = "models"
+
+
+@st.cache_resource
+def _model_cache_state():
+    return {'lock': threading.Lock(), 'memory': OrderedDict()}
+
+
+def model_cache_key(fingerprint, prediction_task, selected_features, test_size_ratio, chosen_model_type, hyperparams, use_pretrained):
+    spec = {
+        'fingerprint': fingerprint,
+        'task': prediction_task,
+        'features': list(selected_features), # Order matters: it is the column order of the design matrix
+        'test_size': round(float(test_size_ratio), 6),
+        'model': chosen_model_type,
+        'hyperparams': hyperparams,
+        'pretrained': use_pretrained,
+    }
+    return hashlib.sha256(json.dumps(spec, sort_keys=True).encode("utf-8")).hexdigest()[:32]
+
+
+def _model_cache_file(cache_dir, key):
+    return os.path.join(cache_dir, MODEL_CACHE_DIR_NAME, f"{key}.joblib")
+
+
+def model_cache_get(key, cache_dir):
+    state = _model_cache_state()
+    with state['lock']:
+        if key in state['memory']:
+            state['memory'].move_to_end(key)
+            return state['memory'][key]
+
+    if cache_dir is None or not os.path.exists(_model_cache_file(cache_dir, key)):
+        return None
+    try:
+        entry = joblib.load(_model_cache_file(cache_dir, key))
+        os.utime(_model_cache_file(cache_dir, key)) # Mark as recently used for disk eviction
+    except Exception:
+        return None # Half-written or incompatible file: treat as a miss and retrain
+    _model_cache_remember(key, entry)
+    return entry
+
+
+def _model_cache_remember(key, entry):
+    state = _model_cache_state()
+    with state['lock']:
+        state['memory'][key] = entry
+        state['memory'].move_to_end(key)
+        while len(state['memory']) > MODEL_CACHE_MEMORY_ENTRIES:
+            state['memory'].popitem(last=False)
+
+
+def model_cache_put(key, entry, cache_dir, persist=True):
+    _model_cache_remember(key, entry)
+    if cache_dir is None or not persist:
+        return
+
+    model_dir = os.path.join(cache_dir, MODEL_CACHE_DIR_NAME)
+    cache_file = _model_cache_file(cache_dir, key)
+    tmp_path = f"{cache_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        os.makedirs(model_dir, exist_ok=True)
+        joblib.dump(entry, tmp_path)
+        os.replace(tmp_path, cache_file)
+    except OSError:
+        return # Read-only data folder: the memory tier still works
+
+    # Evict least recently used files until the folder fits its budget again
+    files = []
+    for name in os.listdir(model_dir):
+        if name.endswith(".joblib"):
+            path = os.path.join(model_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+    total_bytes = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total_bytes <= MODEL_CACHE_DISK_BYTES or path == cache_file:
+            break
+        try:
+            os.remove(path)
+            total_bytes -= size
+        except OSError:
+            pass
+
+
+def build_model(chosen_model_type, hyperparams):
+    from sklearn.ensemble import RandomForestRegressor, RandomForestClassifier
+    from sklearn.linear_model import LinearRegression
+    from sklearn.neighbors import KNeighborsRegressor
+    from sklearn.tree import DecisionTreeRegressor
+
+    if chosen_model_type == "Linear Regression":
+        return LinearRegression()
+    elif chosen_model_type == "Decision Tree Regressor":
+        return DecisionTreeRegressor(random_state=42)
+    elif chosen_model_type == "K-Nearest Neighbors":
+        return KNeighborsRegressor(n_neighbors=hyperparams['n_neighbors'])
+    elif chosen_model_type == "Random Forest Regressor":
+        return RandomForestRegressor(n_estimators=hyperparams['n_estimators'], random_state=42, n_jobs=-1)
+    elif chosen_model_type == "Random Forest Classifier":
+        return RandomForestClassifier(n_estimators=hyperparams['n_estimators'], random_state=42, n_jobs=-1, class_weight='balanced')
+    return None
+
+
+def compute_metrics(prediction_task, y_test, y_pred, model):
+    from sklearn.metrics import mean_squared_error, mean_absolute_error, r2_score, accuracy_score, classification_report, confusion_matrix
+
+    if prediction_task == "PM2.5 Regression":
+        return {
+            'rmse': np.sqrt(mean_squared_error(y_test, y_pred)),
+            'mae': mean_absolute_error(y_test, y_pred),
+            'r2': r2_score(y_test, y_pred),
+        }
+    return {
+        'accuracy': accuracy_score(y_test, y_pred),
+        'report': classification_report(y_test, y_pred),
+        'confusion_matrix': confusion_matrix(y_test, y_pred),
+        'classes': model.classes_ if model is not None else np.union1d(y_test, y_pred), # No single model for pooled per-station results
+    }
+
+
+# --- BACKGROUND TRAINING JOBS ---
+# New models are fitted in a shared process pool instead of the session's script thread, so a long fit
+# never freezes the page. Jobs are keyed by the model cache key: two sessions asking for the same
+# configuration share one job, and a finished job's result goes straight into the model cache from the
+# job's done callback, whether or not any session comes back for it. Each session follows the job of its
+# current configuration; a job no session follows any more (e.g. after dragging a slider past it) is cancelled.
+# Workers report progress and watch for cancellation through small files in a per-job folder. A job's inputs
+# (the design matrices) are written once into that folder and memory-mapped by the worker, so they are not
+# pickled through the executor's pipe and unpickled into another full copy in the worker.
+# loky's executor is used because it cloudpickles functions defined in this script (Streamlit runs it as
+# __main__, which the standard ProcessPoolExecutor can't pickle by reference).
+TRAINING_WORKERS = int(os.environ.get("AIRPOLLUTION_TRAINING_WORKERS", max(1, (os.cpu_count() or 2) // 2)))
+TRAINING_THREADS_PER_JOB = max(1, (os.cpu_count() or 1) // TRAINING_WORKERS) # Keeps n_jobs=-1 forests from oversubscribing
+FOREST_MODEL_TYPES = ["Random Forest Regressor", "Random Forest Classifier"]
+FOREST_TREES_PER_STEP = 25 # Progress granularity (and cancellation latency) for forests
+TRAINING_POLL_SECONDS = 1.0
+
+
+@st.cache_resource
+def _training_queue():
+    from joblib.externals.loky import ProcessPoolExecutor
+    return {
+        'executor': ProcessPoolExecutor(max_workers=TRAINING_WORKERS),
+        'jobs': {},
+        'lock': threading.Lock(),
+        'job_root': tempfile.mkdtemp(prefix="airpollution-training-"),
+    }
+
+
+def _write_job_progress(job_dir, done, total):
+    tmp_path = os.path.join(job_dir, "progress.json.tmp")
+    with open(tmp_path, 'w') as f:
+        json.dump({'done': done, 'total': total}, f)
+    os.replace(tmp_path, os.path.join(job_dir, "progress.json"))
+
+
+def _run_training_job(job_dir, prediction_task, chosen_model_type, hyperparams, X_train, y_train, X_test, y_test):
+    # Runs in a worker process. Returns the cache entry (minus the scaler) plus its stage records, or None if cancelled.
+    cancel_path = os.path.join(job_dir, "cancel")
+    stage_records = [] # Logged under the submitting session by _collect_training_job()
+    model = build_model(chosen_model_type, hyperparams)
+    if 'n_jobs' in model.get_params():
+        model.set_params(n_jobs=TRAINING_THREADS_PER_JOB)
+
+    with stage('modeling.fit', sink=stage_records, model=chosen_model_type, rows=len(X_train), where='background'):
+        if chosen_model_type in FOREST_MODEL_TYPES:
+            # Grow the forest a few trees at a time with warm_start. With a fixed random_state this builds
+            # exactly the same trees as a single fit(), but lets us report progress and stop early.
+            total = hyperparams['n_estimators']
+            model.set_params(warm_start=True)
+            _write_job_progress(job_dir, 0, total)
+            for n_trees in list(range(FOREST_TREES_PER_STEP, total, FOREST_TREES_PER_STEP)) + [total]:
+                if os.path.exists(cancel_path):
+                    return None
+                model.set_params(n_estimators=n_trees)
+                with warnings.catch_warnings():
+                    warnings.filterwarnings('ignore', message=".*not recommended for warm_start.*") # Same data every step
+                    model.fit(X_train, y_train)
+                _write_job_progress(job_dir, n_trees, total)
+            model.set_params(warm_start=False)
+        else:
+            _write_job_progress(job_dir, 0, 1)
+            model.fit(X_train, y_train)
+            _write_job_progress(job_dir, 1, 1)
+
+    if os.path.exists(cancel_path):
+        return None
+    with stage('modeling.predict', sink=stage_records, model=chosen_model_type, rows=len(X_test), where='background'):
+        y_pred = model.predict(X_test)
+    with stage('modeling.metrics', sink=stage_records, model=chosen_model_type, where='background'):
+        metrics = compute_metrics(prediction_task, y_test, y_pred, model)
+    return {'model': model, 'y_pred': y_pred, 'metrics': metrics, 'stage_records': stage_records}
+
+
+def submit_training_job(cache_key, cache_dir, scaler, prediction_task, chosen_model_type, hyperparams, X_train, y_train, X_test, y_test):
+    _submit_job(cache_key, cache_dir, {'scaler': scaler}, _run_training_job,
+                prediction_task, chosen_model_type, hyperparams, X_train, y_train, X_test, y_test)
+
+
+def _run_job_from_inputs(run_job, job_dir):
+    # Worker side of _submit_job(): the arrays in the inputs file come back as read-only memory maps
+    args = joblib.load(os.path.join(job_dir, "inputs.joblib"), mmap_mode='r')
+    return run_job(job_dir, *args)
+
+
+def _submit_job(cache_key, cache_dir, extra, run_job, *args):
+    # run_job(job_dir, *args) runs in a worker and returns the cache entry with its stage records, or None if
+    # cancelled; 'extra' (e.g. the scaler, which stays in this process) is added to the entry when it is collected
+    queue = _training_queue()
+    session, run = _session_id(), _current_run()
+    with queue['lock']:
+        existing = queue['jobs'].get(cache_key)
+        if existing is not None and not existing['abandoned']:
+            existing['followers'].add(session) # Another session already submitted this configuration
+            return
+
+    # Outside the lock, so other sessions aren't held up while the matrices are written
+    job_dir = tempfile.mkdtemp(dir=queue['job_root'])
+    joblib.dump(args, os.path.join(job_dir, "inputs.joblib")) # Uncompressed, so the worker can memory-map it
+    job = {'job_dir': job_dir, 'extra': extra, 'cache_dir': cache_dir, 'cancel_requested': False, 'abandoned': False,
+           'followers': {session}, 'submitted_by': {'session': session, 'run': run['id'], 'page': run['page']},
+           'lock': threading.Lock(), 'entry': None}
+    with queue['lock']:
+        existing = queue['jobs'].get(cache_key)
+        if existing is not None and not existing['abandoned']: # Submitted by another session in the meantime
+            existing['followers'].add(session)
+            job = None
+        else:
+            job['future'] = queue['executor'].submit(_run_job_from_inputs, run_job, job_dir)
+            queue['jobs'][cache_key] = job # Replaces an abandoned job for the same key that is still winding down
+    if job is None:
+        shutil.rmtree(job_dir, ignore_errors=True)
+        return
+    # Outside the lock: an already finished future runs the callback right here
+    job['future'].add_done_callback(lambda future: _collect_training_job(cache_key, job))
+
+
+def _collect_training_job(cache_key, job):
+    # Done callback, also called by the page if it sees the finished job first; the job lock makes the move into
+    # the model cache happen once. Returns the cache entry, or None if the job didn't produce a model.
+    # Finished and abandoned jobs are dropped; failed and cancelled ones stay until their session has reported them.
+    future = job['future']
+    with job['lock']:
+        if job['entry'] is None and not future.cancelled() and future.exception() is None and future.result() is not None:
+            entry = dict(future.result(), **job['extra'])
+            stage_records = entry.pop('stage_records', [])
+            for record in stage_records:
+                record.update(job['submitted_by'])
+            log_stage_records(stage_records)
+            model_cache_put(cache_key, entry, job['cache_dir'])
+            job['entry'] = entry
+    if job['entry'] is not None or job['abandoned']:
+        _drop_training_job(cache_key, job)
+    return job['entry']
+
+
+def _drop_training_job(cache_key, job):
+    queue = _training_queue()
+    with queue['lock']:
+        if queue['jobs'].get(cache_key) is job: # Not a newer job submitted under the same key
+            del queue['jobs'][cache_key]
+    shutil.rmtree(job['job_dir'], ignore_errors=True)
+
+
+def training_job_status(cache_key):
+    # Returns None when there is no job, otherwise a dict with 'state' (queued, running, finished, failed or
+    # cancelled), 'progress' as (done, total) and 'error' for failed jobs
+    queue = _training_queue()
+    with queue['lock']:
+        job = queue['jobs'].get(cache_key)
+    if job is None or job['abandoned']: # Being cancelled because nobody followed it; a new request resubmits
+        return None
+
+    future = job['future']
+    progress = (0, 0)
+    try:
+        with open(os.path.join(job['job_dir'], "progress.json")) as f:
+            reported = json.load(f)
+        progress = (reported['done'], reported['total'])
+    except (OSError, ValueError):
+        pass # Worker hasn't started yet
+
+    error = None
+    if future.done():
+        if future.cancelled() or job['cancel_requested']:
+            state = 'cancelled'
+        elif future.exception() is not None:
+            state, error = 'failed', future.exception()
+        else:
+            state = 'finished' if future.result() is not None else 'cancelled'
+    else:
+        state = 'running' if progress[1] else 'queued'
+    return {'state': state, 'progress': progress, 'error': error}
+
+
+def forget_training_job(cache_key):
+    queue = _training_queue()
+    with queue['lock']:
+        job = queue['jobs'].pop(cache_key, None)
+    if job is not None:
+        shutil.rmtree(job['job_dir'], ignore_errors=True)
+    return job
+
+
+def finish_training_job(cache_key, cache_dir):
+    # Returns a finished job's cache entry, whether the done callback has moved it into the model cache yet or not
+    queue = _training_queue()
+    with queue['lock']:
+        job = queue['jobs'].get(cache_key)
+    entry = _collect_training_job(cache_key, job) if job is not None else None
+    return entry if entry is not None else model_cache_get(cache_key, cache_dir)
+
+
+def _request_cancel(job):
+    try:
+        open(os.path.join(job['job_dir'], "cancel"), 'w').close() # Picked up by the worker between forest steps
+    except OSError:
+        pass # The job has just finished and its folder is gone
+    job['future'].cancel() # Succeeds only if the job hasn't started yet
+
+
+def cancel_training_job(cache_key):
+    queue = _training_queue()
+    with queue['lock']:
+        job = queue['jobs'].get(cache_key)
+        if job is None:
+            return
+        job['cancel_requested'] = True
+    _request_cancel(job)
+
+
+def follow_training_job(cache_key, slot='training_job_key'):
+    # Called with the session's current configuration on every Modeling run. The session stops following the job
+    # of its previous configuration; if no other session follows that job either, it is cancelled and dropped.
+    # Each slot (session state key) follows one job, so the global and per-station models are followed separately.
+    session = _session_id()
+    previous = st.session_state.get(slot)
+    st.session_state[slot] = cache_key
+    queue = _training_queue()
+    abandoned = None
+    with queue['lock']:
+        if cache_key in queue['jobs']:
+            queue['jobs'][cache_key]['followers'].add(session)
+        if previous is not None and previous != cache_key and previous in queue['jobs']:
+            job = queue['jobs'][previous]
+            job['followers'].discard(session)
+            if not job['followers'] and not job['future'].done():
+                job['abandoned'] = job['cancel_requested'] = True
+                abandoned = job
+    if abandoned is not None:
+        _request_cancel(abandoned) # Its done callback drops it once the worker has stopped
+
+
+def show_training_progress(cache_key, chosen_model_type, unit=None, key="cancel_training"):
+    # Only this fragment reruns while the job is in flight; once it ends, the whole page reruns to show the results
+    progress_unit = unit or ("trees" if chosen_model_type in FOREST_MODEL_TYPES else "steps")
+
+    @st.fragment(run_every=TRAINING_POLL_SECONDS)
+    def _training_progress():
+        job = training_job_status(cache_key)
+        if job is None or job['state'] not in ('queued', 'running'):
+            st.rerun()
+        done, total = job['progress']
+        if job['state'] == 'queued':
+            st.info(f"{chosen_model_type} is queued for training ({TRAINING_WORKERS} training worker(s) shared by all users)...")
+        st.progress(done / total if total else 0.0, text=f"Training {chosen_model_type} in the background: {done}/{total} {progress_unit}")
+        if st.button("✖️ Cancel training", key=key):
+            cancel_training_job(cache_key)
+            st.rerun()
+
+    _training_progress()
+
+
 # Page 3: Modeling and Prediction
+# --- DESIGN MATRIX ---
+# Models train on one C-contiguous float32 matrix filled column by column straight from the (memory-mapped)
+# data, split by row ranges (views, not copies) and standardized in place. The fitted StandardScaler covers
+# every feature, with an identity transform for the binary columns, so scaler.transform() on the raw
+# features reproduces the matrix exactly and the scaler's feature_names_in_ records the model's schema.
+# Matrices are cached per (dataset, features, split, scaler settings) and shared read-only by all sessions.
+DESIGN_MATRIX_CACHE_ENTRIES = 4
+DESIGN_CHUNK_ROWS = 100_000 # Rows per scaler update and in-place scaling step; bounds the float64 temporaries
+
+
+def features_to_standardize(data, features):
+    # Numeric features, minus the 0/1 flags that are left unscaled
+    binary = data.attrs.get('binary_columns')
+    if binary is None: # Frames without the load-time metadata
+        binary = binary_columns(data[features])
+    return [col for col in features if col not in binary and pd.api.types.is_numeric_dtype(data[col])
+            and not pd.api.types.is_bool_dtype(data[col])]
+
+
+def fill_design_matrix(data, features, rows=slice(None)):
+    # One float32 copy of the selected rows (a slice or an array of row positions) and features; nothing else
+    # is allocated along the way
+    columns = [data[col].to_numpy() for col in features] # Views of the stored columns
+    n_rows = len(range(len(data))[rows]) if isinstance(rows, slice) else len(rows)
+    X = np.empty((n_rows, len(features)), dtype='float32')
+    for j, values in enumerate(columns):
+        X[:, j] = values[rows]
+    return X
+
+
+def fit_feature_scaler(X_train, features, scaled, scaler_params=()):
+    # StandardScaler fitted chunk by chunk on the training rows, with an identity transform for unscaled columns
+    from sklearn.preprocessing import StandardScaler
+
+    unscaled = [j for j, col in enumerate(features) if col not in scaled]
+    scaler = StandardScaler(**dict(scaler_params))
+    for start in range(0, len(X_train), DESIGN_CHUNK_ROWS):
+        scaler.partial_fit(X_train[start:start + DESIGN_CHUNK_ROWS])
+    if scaler.mean_ is not None:
+        scaler.mean_[unscaled] = 0.0
+    if scaler.scale_ is not None:
+        scaler.var_[unscaled] = 1.0
+        scaler.scale_[unscaled] = 1.0
+    scaler.feature_names_in_ = np.asarray(features, dtype=object)
+    return scaler
+
+
+def scale_in_place(X, scaler):
+    # Same result as scaler.transform(X), without the float64 copy of the whole matrix
+    mean = scaler.mean_.astype('float32') if scaler.with_mean else None
+    scale = scaler.scale_.astype('float32') if scaler.with_std else None
+    for start in range(0, len(X), DESIGN_CHUNK_ROWS):
+        block = X[start:start + DESIGN_CHUNK_ROWS]
+        if mean is not None:
+            block -= mean
+        if scale is not None:
+            block /= scale
+    return X
+
+
+@st.cache_resource(max_entries=DESIGN_MATRIX_CACHE_ENTRIES, show_spinner="Building the design matrix...")
+def build_design_matrix(fingerprint, selected_features, split_point, scaler_params, _data):
+    features = list(selected_features)
+    X = fill_design_matrix(_data, features)
+    scaled = features_to_standardize(_data, features)
+    scaler = fit_feature_scaler(X[:split_point], features, scaled, scaler_params) # Statistics from the training rows only
+    scale_in_place(X, scaler)
+    X.flags.writeable = False # Shared by every session
+
+    return {'X_train': X[:split_point], 'X_test': X[split_point:], 'features': features, 'scaled': scaled, 'scaler': scaler}
+
+
+# --- NEAREST-NEIGHBOUR INDEX ---
+# K-Nearest Neighbors fits one KNeighborsRegressor (its KD/Ball tree) per design matrix and queries the
+# KNN_MAX_NEIGHBORS nearest training rows of every test row once, in parallel chunks. Both are kept in the
+# model cache (memory and disk), so moving the knn_n slider only averages the first k neighbours' targets.
+# Building the index is the expensive part, so the Modeling page runs it as a background training job.
+# Predictions match a fresh KNeighborsRegressor(n_neighbors=k) up to the order of exactly tied distances.
+KNN_MAX_NEIGHBORS = 20 # Upper end of the knn_n slider
+KNN_QUERY_CHUNK_ROWS = 20_000
+
+
+def build_knn_index(X_train, y_train, X_test, n_jobs=-1, job_dir=None):
+    # Given a job_dir (in a background job), reports progress per query chunk and returns None once cancelled
+    starts = range(0, len(X_test), KNN_QUERY_CHUNK_ROWS)
+    if job_dir is not None:
+        _write_job_progress(job_dir, 0, len(starts))
+    base = build_model("K-Nearest Neighbors", {'n_neighbors': min(KNN_MAX_NEIGHBORS, len(X_train))}).fit(X_train, y_train)
+    # Tree queries release the GIL, so threads share the index instead of copying it into processes
+    chunks = joblib.Parallel(n_jobs=n_jobs, prefer="threads", return_as="generator")(
+        joblib.delayed(base.kneighbors)(X_test[start:start + KNN_QUERY_CHUNK_ROWS], return_distance=False)
+        for start in starts)
+    neighbors = []
+    for chunk in chunks:
+        neighbors.append(chunk)
+        if job_dir is not None:
+            _write_job_progress(job_dir, len(neighbors), len(starts))
+            if os.path.exists(os.path.join(job_dir, "cancel")):
+                return None # Closing the generator stops the chunks that haven't started
+    neighbors = np.vstack(neighbors) if neighbors else np.empty((0, base.n_neighbors), dtype=np.intp)
+    index_dtype = 'int32' if len(X_train) < 2 ** 31 else 'int64'
+    return {'model': base, 'neighbors': neighbors.astype(index_dtype)}
+
+
+def knn_neighbor_index(index_key, cache_dir, X_train, y_train, X_test):
+    # Synchronous build, for when the page doesn't train in the background
+    index = model_cache_get(index_key, cache_dir)
+    if index is not None:
+        return index
+
+    with st.spinner("Building the nearest-neighbour index..."):
+        index = build_knn_index(X_train, y_train, X_test)
+    model_cache_put(index_key, index, cache_dir)
+    return index
+
+
+def _run_knn_index_job(job_dir, X_train, y_train, X_test):
+    # Runs in a worker process. Returns the index plus its stage records, or None if cancelled.
+    stage_records = []
+    with stage('modeling.knn_index', sink=stage_records, rows=len(X_test), where='background'):
+        index = build_knn_index(X_train, y_train, X_test, n_jobs=TRAINING_THREADS_PER_JOB, job_dir=job_dir)
+    return None if index is None else dict(index, stage_records=stage_records)
+
+
+def submit_knn_index_job(index_key, cache_dir, X_train, y_train, X_test):
+    _submit_job(index_key, cache_dir, {}, _run_knn_index_job, X_train, y_train, X_test)
+
+
+def knn_index_key(fingerprint, prediction_task, selected_features, test_size_ratio, scaler_params):
+    # One index per design matrix, shared by every k
+    return model_cache_key(fingerprint, prediction_task, selected_features, test_size_ratio,
+                           "K-Nearest Neighbors index", {'max_neighbors': KNN_MAX_NEIGHBORS, 'scaler': scaler_params}, False)
+
+
+def knn_from_index(index, y_train, n_neighbors):
+    # Returns (model, test predictions) for one k; the model is a shallow copy sharing the fitted tree
+    k = min(n_neighbors, index['neighbors'].shape[1])
+    y_pred = np.asarray(y_train, dtype='float64')[index['neighbors'][:, :k]].mean(axis=1)
+    model = copy.copy(index['model'])
+    model.set_params(n_neighbors=k)
+    return model, y_pred
+
+
+# --- TIME-SERIES CROSS-VALIDATION AND HYPERPARAMETER SEARCH ---
+# Candidates are scored with expanding-window CV on the training part of the chronological split (the test
+# set stays held out). Fold matrices are scaled once per fold and shared by every candidate, and each worker
+# task covers one fold for all candidates: forests are grown once with warm_start and scored at every
+# candidate tree count, and KNN answers every k from a single k_max neighbour query.
+CV_DEFAULT_FOLDS = 5
+HALVING_FACTOR = 3 # Successive halving keeps the best 1/HALVING_FACTOR candidates each round
+SEARCH_GRIDS = {
+    "K-Nearest Neighbors": ('n_neighbors', "knn_n", list(range(1, 21))),
+    "Random Forest Regressor": ('n_estimators', "rfr_n", list(range(50, 501, 50))),
+    "Random Forest Classifier": ('n_estimators', "rfc_n", list(range(50, 501, 50))),
+}
+
+
+@st.cache_resource(max_entries=4, show_spinner="Preparing cross-validation folds...")
+def time_series_folds(fingerprint, selected_features, target_variable, split_point, n_splits, _data):
+    # Expanding windows: fold i trains on everything before its validation block. Each fold gets its own
+    # StandardScaler fitted on its training window only, so no validation statistics leak into the scaling.
+    from sklearn.model_selection import TimeSeriesSplit
+    from sklearn.preprocessing import StandardScaler
+
+    features = list(selected_features)
+    features_to_scale = features_to_standardize(_data, features)
+    scale_idx = [features.index(col) for col in features_to_scale]
+    X_all = fill_design_matrix(_data, features, slice(None, split_point))
+    y_all = _data[target_variable].to_numpy()[:split_point]
+
+    folds = []
+    for train_idx, valid_idx in TimeSeriesSplit(n_splits=n_splits).split(X_all):
+        X_fold_train, X_fold_valid = X_all[train_idx], X_all[valid_idx] # Fancy indexing copies, so scale in place
+        if scale_idx:
+            scaler = StandardScaler().fit(X_fold_train[:, scale_idx])
+            X_fold_train[:, scale_idx] = scaler.transform(X_fold_train[:, scale_idx])
+            X_fold_valid[:, scale_idx] = scaler.transform(X_fold_valid[:, scale_idx])
+        folds.append((X_fold_train, y_all[train_idx], X_fold_valid, y_all[valid_idx]))
+    return folds
+
+
+def _fold_score(prediction_task, y_valid, y_pred):
+    # Higher is better for both tasks
+    from sklearn.metrics import mean_squared_error, accuracy_score
+
+    if prediction_task == "PM2.5 Regression":
+        return -np.sqrt(mean_squared_error(y_valid, y_pred))
+    return accuracy_score(y_valid, y_pred)
+
+
+def _score_fold(prediction_task, chosen_model_type, param_values, fold, n_threads=1):
+    # Runs in a worker: scores every candidate value on one fold, sharing the expensive part between them.
+    # n_threads is this fold's share of the cores, used by the forest fits and the neighbour query.
+    X_fold_train, y_fold_train, X_fold_valid, y_fold_valid = fold
+    scores = {}
+    if chosen_model_type in FOREST_MODEL_TYPES:
+        model = build_model(chosen_model_type, {'n_estimators': min(param_values)}).set_params(warm_start=True, n_jobs=n_threads)
+        for n_trees in sorted(param_values):
+            model.set_params(n_estimators=n_trees)
+            with warnings.catch_warnings():
+                warnings.filterwarnings('ignore', message=".*not recommended for warm_start.*")
+                model.fit(X_fold_train, y_fold_train)
+            scores[n_trees] = _fold_score(prediction_task, y_fold_valid, model.predict(X_fold_valid))
+    elif chosen_model_type == "K-Nearest Neighbors":
+        k_max = min(max(param_values), len(X_fold_train))
+        model = build_model(chosen_model_type, {'n_neighbors': k_max}).set_params(n_jobs=n_threads).fit(X_fold_train, y_fold_train)
+        _, neighbors = model.kneighbors(X_fold_valid) # Sorted by distance
+        neighbor_targets = np.asarray(y_fold_train, dtype='float64')[neighbors]
+        running_means = np.cumsum(neighbor_targets, axis=1) / np.arange(1, k_max + 1) # Column k-1 = uniform k-NN prediction
+        for k in param_values:
+            scores[k] = _fold_score(prediction_task, y_fold_valid, running_means[:, min(k, k_max) - 1])
+    else:
+        model = build_model(chosen_model_type, {}).fit(X_fold_train, y_fold_train)
+        scores[None] = _fold_score(prediction_task, y_fold_valid, model.predict(X_fold_valid))
+    return scores
+
+
+def _evaluate_candidates(prediction_task, chosen_model_type, param_values, folds, fold_ids, n_jobs):
+    # One task per fold, since the candidates of a fold share their work (warm-started trees, one k_max query).
+    # With fewer folds than cores, each task gets an even share of the spare cores as threads.
+    n_cores = joblib.effective_n_jobs(n_jobs)
+    n_threads = max(1, n_cores // len(fold_ids))
+    results = joblib.Parallel(n_jobs=min(n_cores, len(fold_ids)))(
+        joblib.delayed(_score_fold)(prediction_task, chosen_model_type, param_values, folds[i], n_threads) for i in fold_ids)
+    return {(value, i): score for i, fold_scores in zip(fold_ids, results) for value, score in fold_scores.items()}
+
+
+def run_hyperparameter_search(prediction_task, chosen_model_type, param_values, folds, strategy="Grid", n_jobs=-1):
+    # Returns one row per candidate: mean/std CV score and how many folds it was scored on
+    fold_ids = list(range(len(folds)))
+    if strategy == "Grid" or len(param_values) <= 1:
+        scores = _evaluate_candidates(prediction_task, chosen_model_type, param_values, folds, fold_ids, n_jobs)
+    else:
+        # Successive halving: the early folds (short training windows) are the cheap resource. Every round
+        # scores the survivors on more folds and keeps the best 1/HALVING_FACTOR; the rounds continue until the
+        # survivors (possibly one candidate) have been scored on all folds, so the winner's score is a full-CV score.
+        scores = {}
+        survivors = list(param_values)
+        n_folds = max(1, len(folds) // HALVING_FACTOR ** int(np.ceil(np.log(len(param_values)) / np.log(HALVING_FACTOR))))
+        while True:
+            needed = [i for i in fold_ids[:n_folds] if any((value, i) not in scores for value in survivors)]
+            if needed:
+                scores.update(_evaluate_candidates(prediction_task, chosen_model_type, survivors, folds, needed, n_jobs))
+            if n_folds == len(folds):
+                break
+            means = {value: np.mean([scores[(value, i)] for i in fold_ids[:n_folds]]) for value in survivors}
+            survivors = sorted(survivors, key=means.get, reverse=True)[:max(1, int(np.ceil(len(survivors) / HALVING_FACTOR)))]
+            n_folds = min(len(folds), n_folds * HALVING_FACTOR)
+
+    rows = []
+    for value in param_values:
+        fold_scores = [scores[(value, i)] for i in fold_ids if (value, i) in scores]
+        rows.append({'value': value, 'mean_score': np.mean(fold_scores), 'std_score': np.std(fold_scores), 'folds': len(fold_scores)})
+    # Candidates dropped early were scored on fewer folds, so rank by folds first
+    return pd.DataFrame(rows).sort_values(['folds', 'mean_score'], ascending=False).reset_index(drop=True)
+
+
+def show_hyperparameter_search(data, prediction_task, chosen_model_type, selected_features, target_variable, split_point):
+    with st.expander("🔎 Time-Series Cross-Validation & Hyperparameter Search"):
+        st.write("Scores candidates with expanding-window cross-validation on the training set, using all CPU cores. "
+                 "The test set is not used.")
+        param_name, slider_key, grid = SEARCH_GRIDS.get(chosen_model_type, (None, None, [None]))
+        col1, col2 = st.columns(2)
+        n_splits = col1.number_input("CV folds", min_value=2, max_value=10, value=CV_DEFAULT_FOLDS, step=1, key="cv_folds")
+        strategy = col2.radio("Search strategy", ["Grid", "Successive halving"], key="cv_strategy", horizontal=True,
+                              disabled=param_name is None)
+        if param_name is not None:
+            param_values = st.multiselect(f"Candidate values for {param_name}", grid, default=grid, key=f"cv_grid_{slider_key}")
+        else:
+            param_values = [None]
+            st.info(f"{chosen_model_type} has no tuned hyperparameters here; the search reports its CV score.")
+
+        search_key = (data.attrs['fingerprint'], prediction_task, chosen_model_type, tuple(selected_features),
+                      split_point, int(n_splits), strategy, tuple(param_values))
+        if st.button("Run search", key="cv_run", disabled=not param_values):
+            with stage('modeling.cv_folds', folds=int(n_splits)):
+                folds = time_series_folds(data.attrs['fingerprint'], tuple(selected_features), target_variable,
+                                          split_point, int(n_splits), data)
+            with st.spinner(f"Cross-validating {len(param_values)} candidate(s) on {len(folds)} folds..."), \
+                    stage('modeling.cv_search', model=chosen_model_type, strategy=strategy, candidates=len(param_values)):
+                results = run_hyperparameter_search(prediction_task, chosen_model_type, param_values, folds, strategy)
+            st.session_state['cv_results'] = {'key': search_key, 'results': results}
+
+        stored = st.session_state.get('cv_results')
+        if stored is None or stored['key'] != search_key:
+            return
+        results = stored['results']
+        score_label = "CV RMSE" if prediction_task == "PM2.5 Regression" else "CV Accuracy"
+        shown = results.rename(columns={'value': param_name or 'model', 'mean_score': score_label, 'std_score': 'Std', 'folds': 'Folds'})
+        if prediction_task == "PM2.5 Regression":
+            shown[score_label] = -shown[score_label] # Scores are negated RMSE so that higher is better
+        st.dataframe(shown)
+
+        if param_name is not None:
+            best = int(results['value'].iloc[0]) # Not results.iloc[0]: a row mixing ints and floats is all floats
+            st.write(f"Best {param_name}: **{best}**")
+            # on_click runs before the next script run, while the slider's value may still be changed
+            st.button(f"Use {param_name} = {best}", key="cv_apply",
+                      on_click=lambda: st.session_state.update({slider_key: best}))
+
+
+# --- PER-STATION MODELS ---
+# Besides the global model, the selected model type can be trained once per station. Each station's rows keep
+# their time order and get their own chronological split and scaler (fitted on that station's training rows
+# only). All stations are trained as one background training job (see BACKGROUND TRAINING JOBS), so the page
+# stays responsive and shows per-station progress. Within its worker the job trains TRAINING_THREADS_PER_JOB
+# stations at a time on threads, largest first so the longest fits start early, with one-core-per-station forests.
+# The scalers, models, predictions and metrics of every station form one bundle, kept in the model cache and
+# saved as a single joblib file.
+PER_STATION_MIN_ROWS = 50 # Stations with fewer rows are skipped: too few for a train/test split
+PER_STATION_BUNDLE_VERSION = 1
+POOLED_STATIONS_LABEL = "All stations (pooled)"
+
+
+@st.cache_resource(max_entries=8)
+def station_row_positions(fingerprint, _data):
+    # Row positions of each station's rows, in data (chronological) order
+    labels = station_labels(_data).reset_index(drop=True)
+    return {station: rows for station, rows in sorted(labels.groupby(labels, sort=False).indices.items())}
+
+
+def _train_station_model(prediction_task, chosen_model_type, hyperparams, features, scaled, station, X, y, split):
+    # Runs in a worker: scaler, model, test predictions and metrics for one station. Returns them with the stage records.
+    stage_records = []
+    if not X.flags.writeable:
+        X = X.copy() # The job's inputs are read-only memory maps; this station's copy is scaled in place
+    scaler = fit_feature_scaler(X[:split], features, scaled)
+    scale_in_place(X, scaler)
+
+    if chosen_model_type == "K-Nearest Neighbors":
+        hyperparams = dict(hyperparams, n_neighbors=min(hyperparams['n_neighbors'], split))
+    model = build_model(chosen_model_type, hyperparams)
+    if 'n_jobs' in model.get_params():
+        model.set_params(n_jobs=1) # One station per core
+    with stage('modeling.station.fit', sink=stage_records, station=station, rows=split, where='worker'):
+        model.fit(X[:split], y[:split])
+    with stage('modeling.station.predict', sink=stage_records, station=station, rows=len(X) - split, where='worker'):
+        y_pred = model.predict(X[split:])
+    with stage('modeling.station.metrics', sink=stage_records, station=station, where='worker'):
+        metrics = compute_metrics(prediction_task, y[split:], y_pred, model)
+    return {'station': station, 'scaler': scaler, 'model': model, 'y_pred': y_pred, 'metrics': metrics,
+            'train_rows': split, 'test_rows': len(X) - split, 'stage_records': stage_records}
+
+
+def per_station_tasks(data, selected_features, target_variable, test_size_ratio):
+    # Returns one (station, X, y, split) task per station with enough rows, largest first, and the skipped stations.
+    # The tasks' float32 matrices are written to the job's inputs file, like the global model's X_train.
+    features = list(selected_features)
+    y_all = data[target_variable].to_numpy()
+    positions = station_row_positions(data.attrs['fingerprint'], data)
+    stations = sorted((station for station, rows in positions.items() if len(rows) >= PER_STATION_MIN_ROWS),
+                      key=lambda station: len(positions[station]), reverse=True)
+    tasks = [(station, fill_design_matrix(data, features, positions[station]), y_all[positions[station]],
+              int(len(positions[station]) * (1 - test_size_ratio))) for station in stations]
+    return tasks, sorted(station for station in positions if station not in stations)
+
+
+def _run_per_station_job(job_dir, prediction_task, chosen_model_type, hyperparams, features, scaled, target_variable,
+                         test_size_ratio, tasks, skipped):
+    # Runs in a worker process. Returns the per-station bundle plus its stage records, or None if cancelled.
+    cancel_path = os.path.join(job_dir, "cancel")
+    stage_records, results = [], []
+    _write_job_progress(job_dir, 0, len(tasks))
+    with stage('modeling.per_station', sink=stage_records, model=chosen_model_type, stations=len(tasks), where='background'):
+        # Threads, not processes: the job keeps to its TRAINING_THREADS_PER_JOB share of the cores
+        finished = joblib.Parallel(n_jobs=TRAINING_THREADS_PER_JOB, prefer='threads', return_as='generator_unordered')(
+            joblib.delayed(_train_station_model)(prediction_task, chosen_model_type, hyperparams, features, scaled, *task)
+            for task in tasks)
+        for result in finished:
+            stage_records.extend(result.pop('stage_records'))
+            results.append(result)
+            _write_job_progress(job_dir, len(results), len(tasks))
+            if os.path.exists(cancel_path):
+                return None # Closing the generator stops the stations that haven't started
+
+    results = sorted(results, key=lambda result: result['station'])
+    y_tests = {station: y[split:] for station, _, y, split in tasks}
+    y_test_all = np.concatenate([y_tests[r['station']] for r in results]) if results else np.empty(0)
+    y_pred_all = np.concatenate([r['y_pred'] for r in results]) if results else np.empty(0)
+    return {
+        'version': PER_STATION_BUNDLE_VERSION,
+        'task': prediction_task,
+        'model_type': chosen_model_type,
+        'hyperparams': hyperparams,
+        'features': features,
+        'target': target_variable,
+        'test_size': test_size_ratio,
+        'stations': {result.pop('station'): result for result in results},
+        'skipped': skipped,
+        'pooled_metrics': compute_metrics(prediction_task, y_test_all, y_pred_all, None) if results else None,
+        'stage_records': stage_records,
+    }
+
+
+def submit_per_station_job(bundle_key, cache_dir, data, prediction_task, chosen_model_type, hyperparams, selected_features,
+                           target_variable, test_size_ratio):
+    with stage('modeling.per_station_tasks', features=len(selected_features)):
+        tasks, skipped = per_station_tasks(data, selected_features, target_variable, test_size_ratio)
+    _submit_job(bundle_key, cache_dir, {}, _run_per_station_job, prediction_task, chosen_model_type, hyperparams,
+                list(selected_features), features_to_standardize(data, list(selected_features)), target_variable,
+                test_size_ratio, tasks, skipped)
+
+
+def per_station_table(bundle):
+    # One row per station (plus the pooled test rows of all of them) with the task's error metrics
+    entries = [(station, entry['train_rows'], entry['test_rows'], entry['metrics']) for station, entry in bundle['stations'].items()]
+    if bundle['pooled_metrics'] is not None:
+        entries.append((POOLED_STATIONS_LABEL, sum(e[1] for e in entries), sum(e[2] for e in entries), bundle['pooled_metrics']))
+    rows = []
+    for station, train_rows, test_rows, metrics in entries:
+        row = {'Station': station, 'Train rows': train_rows, 'Test rows': test_rows}
+        if bundle['task'] == "PM2.5 Regression":
+            row.update({'RMSE': metrics['rmse'], 'MAE': metrics['mae'], 'R²': metrics['r2']})
+        else:
+            row['Accuracy'] = metrics['accuracy']
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def show_per_station_models(data, prediction_task, chosen_model_type, hyperparams, selected_features, target_variable, test_size_ratio):
+    with st.expander("🏙️ Per-Station Models"):
+        st.write(f"Trains a separate {chosen_model_type} for every station, in the background on the shared training workers. Each station gets "
+                 f"its own chronological split ({test_size_ratio:.0%} test) and StandardScaler; pre-trained models are not used.")
+        positions = station_row_positions(data.attrs['fingerprint'], data)
+        if len(positions) < 2:
+            st.info("The selected data covers a single station, so the model above is already a per-station model.")
+            return
+
+        cache_dir = data.attrs.get('cache_dir')
+        bundle_key = model_cache_key(data.attrs['fingerprint'], prediction_task, selected_features, test_size_ratio,
+                                     f"{chosen_model_type} per station", hyperparams, False)
+        follow_training_job(bundle_key, slot='per_station_job_key')
+        if not (st.button(f"Train {len(positions)} per-station models", key="per_station_run") or st.session_state.get('per_station_key') == bundle_key):
+            return
+        st.session_state['per_station_key'] = bundle_key
+        with stage('modeling.model_cache_get', scope='per_station') as labels:
+            bundle = model_cache_get(bundle_key, cache_dir)
+            labels['cache'] = 'miss' if bundle is None else 'hit'
+
+        job = training_job_status(bundle_key) if bundle is None else None
+        if job is not None and job['state'] == 'finished':
+            bundle = finish_training_job(bundle_key, cache_dir)
+        elif job is not None and job['state'] in ('queued', 'running'):
+            show_training_progress(bundle_key, f"{chosen_model_type} per station", unit="stations", key="per_station_cancel")
+            return
+        elif job is not None: # Failed or cancelled: the button above trains again
+            forget_training_job(bundle_key)
+            del st.session_state['per_station_key']
+            if job['state'] == 'failed':
+                st.error(f"Per-station training failed: {job['error']}")
+            else:
+                st.warning("Per-station training was cancelled.")
+            return
+        elif bundle is None:
+            bundle = model_cache_get(bundle_key, cache_dir) # Its done callback may have collected it since the lookup above
+        if bundle is None:
+            submit_per_station_job(bundle_key, cache_dir, data, prediction_task, chosen_model_type, hyperparams,
+                                   selected_features, target_variable, test_size_ratio)
+            show_training_progress(bundle_key, f"{chosen_model_type} per station", unit="stations", key="per_station_cancel")
+            return
+
+        st.dataframe(per_station_table(bundle), hide_index=True)
+        if bundle['skipped']:
+            st.caption(f"Skipped (fewer than {PER_STATION_MIN_ROWS} rows): {', '.join(bundle['skipped'])}")
+
+        if st.button("💾 Save Per-Station Bundle", key="per_station_save"):
+            bundle_filename = f"{chosen_model_type.lower().replace(' ', '_')}_per_station.joblib"
+            joblib.dump(bundle, bundle_filename)
+            st.success(f"{len(bundle['stations'])} station models and scalers saved as {bundle_filename}")
+            with open(bundle_filename, 'rb') as f:
+                st.download_button("Download Per-Station Bundle", f, file_name=bundle_filename, mime="application/octet-stream")
+
+
+# --- LAZY EXPORTS ---
+# Downloads are built only when their button is clicked (Streamlit calls the data callable then, on its own
+# thread), so nothing is built on reruns. The file is written chunk by chunk into a temporary file: CSV through a
+# text/gzip stream and Parquet one row group per chunk, so only one chunk exists as a DataFrame at a time.
+# This is not streaming to the browser: Streamlit reads the finished file into bytes in its in-memory media
+# store, so each export is held in memory whole for as long as the download link lives. At roughly the
+# EXPORT_ROW_BYTES sizes below, the full 12-station dataset (~420k rows) comes to about 60 MB as Parquet and
+# 115 MB as CSV for the slice export; exports well past a few hundred MB should be narrowed by station or date.
+EXPORT_CHUNK_ROWS = 100_000
+EXPORT_FORMATS = { # Label: (file extension, MIME type)
+    "Parquet": ('parquet', 'application/vnd.apache.parquet'),
+    "CSV (gzip)": ('csv.gz', 'application/gzip'),
+    "CSV": ('csv', 'text/csv'),
+}
+EXPORT_ROW_BYTES = {'parquet': 140, 'csv.gz': 125, 'csv': 275} # Measured per slice-export row with the default features
+
+
+def export_size_label(n_rows, extension):
+    # Rough in-memory size of an export, for the download button's help text
+    size_mb = n_rows * EXPORT_ROW_BYTES[extension] / 1024**2
+    return f"about {size_mb:,.0f} MB" if size_mb >= 1 else "under 1 MB"
+
+
+def write_export(chunks, extension):
+    # Writes an iterable of DataFrames (index included) to a temporary file and returns it rewound
+    out = tempfile.TemporaryFile()
+    if extension == 'parquet':
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        writer = None
+        try:
+            for chunk in chunks:
+                table = pa.Table.from_pandas(chunk, preserve_index=True)
+                if writer is None:
+                    writer = pq.ParquetWriter(out, table.schema)
+                else:
+                    table = table.cast(writer.schema) # Chunks whose object columns came out differently
+                writer.write_table(table)
+        finally:
+            if writer is not None:
+                writer.close() # Leaves `out` open
+    else:
+        binary = gzip.GzipFile(fileobj=out, mode='wb', compresslevel=6) if extension == 'csv.gz' else out
+        text = io.TextIOWrapper(binary, encoding='utf-8', newline='')
+        for chunk_no, chunk in enumerate(chunks):
+            chunk.to_csv(text, header=chunk_no == 0)
+        text.flush()
+        text.detach()
+        if binary is not out:
+            binary.close() # Writes the gzip trailer; `out` stays open
+    out.seek(0)
+    return out
+
+
+def _prediction_frame(prediction_task, dates, actual, predicted, extra=()):
+    frame = pd.DataFrame(dict(extra), index=pd.DatetimeIndex(dates, name='Date'))
+    frame['Actual'] = actual
+    frame['Predicted'] = predicted
+    if prediction_task == "PM2.5 Regression":
+        frame['Residual'] = frame['Actual'] - frame['Predicted']
+    else:
+        frame['Correct'] = frame['Actual'] == frame['Predicted'] # Residuals don't apply to class labels
+    return frame
+
+
+def test_prediction_chunks(prediction_task, dates, y_test, y_pred):
+    y_test = np.asarray(y_test)
+    for start in range(0, max(len(y_test), 1), EXPORT_CHUNK_ROWS): # Always one frame, so empty exports keep their columns
+        rows = slice(start, start + EXPORT_CHUNK_ROWS)
+        yield _prediction_frame(prediction_task, dates[rows], y_test[rows], y_pred[rows])
+
+
+def slice_prediction_chunks(data, prediction_task, features, target_variable, split_point, scaler, model, y_pred):
+    # Every row of the filtered slice: station, raw features, actual, predicted and residual. Test rows reuse the
+    # stored predictions; training rows are scaled and predicted one chunk at a time.
+    dates = data['Date'].to_numpy()
+    y_all = data[target_variable].to_numpy()
+    for start in range(0, max(len(data), 1), EXPORT_CHUNK_ROWS):
+        stop = min(start + EXPORT_CHUNK_ROWS, len(data))
+        train_stop = min(max(split_point, start), stop)
+        predicted = np.empty(stop - start, dtype=np.asarray(y_pred).dtype)
+        if train_stop > start:
+            X = scale_in_place(fill_design_matrix(data, features, slice(start, train_stop)), scaler)
+            if hasattr(model, 'feature_names_in_'): # Pre-trained models were fitted on DataFrames
+                X = pd.DataFrame(X, columns=features, copy=False)
+            predicted[:train_stop - start] = model.predict(X)
+        predicted[train_stop - start:] = y_pred[train_stop - split_point:stop - split_point]
+
+        chunk = data.iloc[start:stop]
+        extra = {'station': station_labels(chunk).to_numpy(), **{col: chunk[col].to_numpy() for col in features},
+                 'Split': np.where(np.arange(start, stop) < split_point, 'train', 'test')}
+        yield _prediction_frame(prediction_task, dates[start:stop], y_all[start:stop], predicted, extra)
+
+
+DEFAULT_MODEL_FEATURES = ['PM2.5_lag_1h', 'PM10', 'TEMP', 'WSPM', 'NO2', 'CO', 'O3', 'PM2.5_rolling_mean_6h', 'hour_sin', 'is_weekend']
+MODEL_OPTIONS = {
+    "PM2.5 Regression": ["Linear Regression", "Decision Tree Regressor", "K-Nearest Neighbors", "Random Forest Regressor"],
+    "AQI Classification": ["Random Forest Classifier"],
+}
+
+
+def scaler_settings(use_pretrained_model):
+    # Returns (StandardScaler parameters, whether they come from the pre-trained scaler)
+    from sklearn.base import clone
+    from sklearn.preprocessing import StandardScaler
+
+    trained_scaler = None
+    if use_pretrained_model:
+        with stage('modeling.load_pretrained', artifact='scaler'):
+            trained_scaler = load_pretrained_artifact(PRETRAINED_SCALER_FILE, "Scaling")
+    if trained_scaler is not None:
+        # Refit with the pre-trained scaler's settings; the loaded scaler is shared by every session
+        return tuple(sorted(clone(trained_scaler).get_params().items())), True
+    return tuple(sorted(StandardScaler().get_params().items())), False
+
+
 def modeling_and_prediction(data):
     st.title("🤖 3. Modeling and Prediction")
     st.write("Here you can train and evaluate different machine learning models for air quality prediction.")
 
-    global trained_reg_model, trained_scaler, trained_clf_model
+    import seaborn as sns
 
     st.subheader("1. Prediction Task & Model Loading")
 
     prediction_task = st.radio("Choose Prediction Task:", ["PM2.5 Regression", "AQI Classification"])
 
+    # Only checks the files exist; the artifacts themselves are loaded below, once they are actually used
     use_pretrained_model = False
-    if prediction_task == "PM2.5 Regression" and trained_reg_model is not None:
+    if prediction_task == "PM2.5 Regression" and pretrained_artifact_available(PRETRAINED_REGRESSION_FILE):
         use_pretrained_model = st.checkbox("Use Pre-trained Regression Model (if available)", value=True)
-    elif prediction_task == "AQI Classification" and trained_clf_model is not None:
+    elif prediction_task == "AQI Classification" and pretrained_artifact_available(PRETRAINED_CLASSIFICATION_FILE):
         use_pretrained_model = st.checkbox("Use Pre-trained Classification Model (if available)", value=True)
     else:
         st.warning("No pre-trained model found for this task. A new model will be trained.")
@@ -314,183 +2702,272 @@ def modeling_and_prediction(data):
 
     st.write(f"Selected Target Variable: **{target_variable}**")
 
-    default_selected_features = [f for f in ['PM2.5_lag_1h', 'PM10', 'TEMP', 'WSPM', 'NO2', 'CO', 'O3', 'PM2.5_rolling_mean_6h', 'hour_sin', 'is_weekend'] if f in potential_features]
+    default_selected_features = [f for f in DEFAULT_MODEL_FEATURES if f in potential_features]
     selected_features = st.multiselect("🧮 Select Feature Variables", potential_features, default=default_selected_features)
 
     if not selected_features:
         st.warning("Please select at least one feature variable.")
         return
 
-    X = data[selected_features]
+    # Partitioned storage reads only these columns (the station one-hots are needed by the per-station models)
+    station_columns = [col for col in data.columns if col.startswith('station_') and col not in selected_features]
+    data = materialize(data, selected_features + [target_variable] + station_columns)
     y = data[target_variable]
 
     st.subheader("3. Data Splitting (Chronological)")
     test_size_ratio = st.slider("Test Set Size (e.g., 0.2 for 20%)", min_value=0.1, max_value=0.5, value=0.2, step=0.05)
 
-    split_point = int(len(X) * (1 - test_size_ratio))
-    X_train, X_test = X.iloc[:split_point], X.iloc[split_point:]
+    # Features are only materialized (once, as float32) by build_design_matrix() when a model has to be fitted
+    split_point = int(len(data) * (1 - test_size_ratio))
     y_train, y_test = y.iloc[:split_point], y.iloc[split_point:]
 
-    st.write(f"Train set shape: {X_train.shape}")
-    st.write(f"Test set shape: {X_test.shape}")
+    st.write(f"Train set shape: {(split_point, len(selected_features))}")
+    st.write(f"Test set shape: {(len(data) - split_point, len(selected_features))}")
 
     st.subheader("4. Feature Scaling")
     st.write("Numerical features will be scaled using StandardScaler.")
-
-    numerical_features_to_scale = X_train.select_dtypes(include=np.number).columns.tolist()
-    features_to_scale = [col for col in numerical_features_to_scale if not (X_train[col].nunique() <= 2 and X_train[col].isin([0, 1]).all())]
-
-    X_train_scaled = X_train.copy()
-    X_test_scaled = X_test.copy()
-
-    if use_pretrained_model and trained_scaler is not None:
-        scaler = trained_scaler
-        st.info("Using pre-trained StandardScaler.")
-    else:
-        scaler = StandardScaler()
-        st.info("Fitting and using new StandardScaler.")
-
-    X_train_scaled[features_to_scale] = scaler.fit_transform(X_train[features_to_scale])
-    X_test_scaled[features_to_scale] = scaler.transform(X_test[features_to_scale])
-
-    st.success("Features scaled successfully!")
+    scaling_status = st.container() # Filled in below, once we know whether this configuration is already cached
 
     st.subheader("5. Model Selection & Training")
 
-    model = None
+    hyperparams = {}
 
     if prediction_task == "PM2.5 Regression":
-        model_options = ["Linear Regression", "Decision Tree Regressor", "K-Nearest Neighbors", "Random Forest Regressor"]
-        chosen_model_type = st.selectbox("Choose a Regression Model", model_options)
+        chosen_model_type = st.selectbox("Choose a Regression Model", MODEL_OPTIONS["PM2.5 Regression"])
 
-        if chosen_model_type == "Linear Regression":
-            model = LinearRegression()
-        elif chosen_model_type == "Decision Tree Regressor":
-            model = DecisionTreeRegressor(random_state=42)
-        elif chosen_model_type == "K-Nearest Neighbors":
-            n_neighbors_knn = st.slider("KNN: Number of Neighbors", min_value=1, max_value=20, value=5, step=1, key="knn_n")
-            model = KNeighborsRegressor(n_neighbors=n_neighbors_knn)
+        if chosen_model_type == "K-Nearest Neighbors":
+            st.session_state.setdefault("knn_n", 5) # Default set through session state, which the CV search can also update
+            hyperparams['n_neighbors'] = st.slider("KNN: Number of Neighbors", min_value=1, max_value=20, step=1, key="knn_n")
         elif chosen_model_type == "Random Forest Regressor":
-            n_estimators_rfr = st.slider("RFR: Number of Trees", min_value=50, max_value=500, value=100, step=50, key="rfr_n")
-            model = RandomForestRegressor(n_estimators=n_estimators_rfr, random_state=42, n_jobs=-1)
+            st.session_state.setdefault("rfr_n", 100)
+            hyperparams['n_estimators'] = st.slider("RFR: Number of Trees", min_value=50, max_value=500, step=50, key="rfr_n")
 
     else: # AQI Classification
-        model_options = ["Random Forest Classifier"]
-        chosen_model_type = st.selectbox("Choose a Classification Model", model_options)
+        chosen_model_type = st.selectbox("Choose a Classification Model", MODEL_OPTIONS["AQI Classification"])
 
         if chosen_model_type == "Random Forest Classifier":
-            n_estimators_rfc = st.slider("RFC: Number of Trees", min_value=50, max_value=500, value=100, step=50, key="rfc_n")
-            model = RandomForestClassifier(n_estimators=n_estimators_rfc, random_state=42, n_jobs=-1, class_weight='balanced')
+            st.session_state.setdefault("rfc_n", 100)
+            hyperparams['n_estimators'] = st.slider("RFC: Number of Trees", min_value=50, max_value=500, step=50, key="rfc_n")
+
+    show_hyperparameter_search(data, prediction_task, chosen_model_type, selected_features, target_variable, split_point)
+    show_per_station_models(data, prediction_task, chosen_model_type, hyperparams, selected_features, target_variable, test_size_ratio)
 
+    # A pre-trained model is only used when it matches the selected task and model type
+    pretrained_model = None
+    trained_reg_model = trained_clf_model = None
     if use_pretrained_model:
+        with stage('modeling.load_pretrained', artifact='model'):
+            if prediction_task == "PM2.5 Regression":
+                trained_reg_model = load_pretrained_artifact(PRETRAINED_REGRESSION_FILE, "Regression model")
+            else:
+                trained_clf_model = load_pretrained_artifact(PRETRAINED_CLASSIFICATION_FILE, "Classification model")
+
         if prediction_task == "PM2.5 Regression" and trained_reg_model is not None:
             if chosen_model_type == "Linear Regression":
-                model = trained_reg_model
-                st.info(f"Using pre-trained {chosen_model_type} model.")
+                pretrained_model = trained_reg_model
             else:
                 st.warning(f"Pre-trained model type ({type(trained_reg_model).__name__}) does not match selected '{chosen_model_type}'. Training new model.")
-                if model is not None: model.fit(X_train_scaled, y_train)
         elif prediction_task == "AQI Classification" and trained_clf_model is not None:
             if chosen_model_type == "Random Forest Classifier":
-                model = trained_clf_model
-                st.info(f"Using pre-trained {chosen_model_type} model.")
+                pretrained_model = trained_clf_model
             else:
                 st.warning(f"Pre-trained model type ({type(trained_clf_model).__name__}) does not match selected '{chosen_model_type}'. Training new model.")
-                if model is not None: model.fit(X_train_scaled, y_train)
         else:
             st.warning("Pre-trained model not found or does not match task/type. Training a new model.")
-            if model is not None: model.fit(X_train_scaled, y_train)
     else:
         st.write("Training a new model based on selected parameters...")
-        if model is not None: model.fit(X_train_scaled, y_train)
 
-    if model is None:
-        st.error("Model could not be instantiated or loaded. Please check your selections and file paths.")
-        return
+    cache_dir = data.attrs.get('cache_dir')
+    cache_key = model_cache_key(data.attrs['fingerprint'], prediction_task, selected_features, test_size_ratio,
+                                chosen_model_type, hyperparams, pretrained_model is not None)
+    # KNN's background job builds the neighbour index shared by every k, so moving the k slider keeps following it
+    job_key = cache_key
+    if chosen_model_type == "K-Nearest Neighbors":
+        index_key = knn_index_key(data.attrs['fingerprint'], prediction_task, selected_features, test_size_ratio,
+                                  scaler_settings(use_pretrained_model)[0])
+        job_key = index_key
+    follow_training_job(job_key)
+    with stage('modeling.model_cache_get') as labels:
+        cached = model_cache_get(cache_key, cache_dir)
+        labels['cache'] = 'miss' if cached is None else 'hit'
+
+    train_in_background = pretrained_model is None and st.checkbox("⏳ Train in the background (keeps the page responsive)", value=True, key="train_in_background")
+
+    if cached is None and train_in_background:
+        job = training_job_status(job_key)
+        if job is not None and job['state'] == 'finished':
+            finished = finish_training_job(job_key, cache_dir)
+            if job_key == cache_key: # A KNN index is picked up from the model cache below
+                cached = finished
+        elif job is None:
+            cached = model_cache_get(cache_key, cache_dir) # Its done callback may have collected it since the lookup above
+        elif job is not None and job['state'] in ('queued', 'running'):
+            scaling_status.info("Features were scaled when the training job was submitted.")
+            show_training_progress(job_key, chosen_model_type, unit="query chunks" if job_key != cache_key else None)
+            return
+        elif job is not None: # Failed or cancelled: don't resubmit until the user asks
+            forget_training_job(job_key)
+            st.session_state['training_hold'] = {'key': job_key, 'state': job['state'], 'error': str(job['error'])}
+
+        hold = st.session_state.get('training_hold')
+        if cached is None and hold is not None and hold['key'] == job_key:
+            if hold['state'] == 'failed':
+                st.error(f"Background training failed: {hold['error']}")
+            else:
+                st.warning("Training was cancelled.")
+            if st.button("🔁 Train again", key="retrain"):
+                del st.session_state['training_hold']
+                st.rerun()
+            return
+
+    if cached is not None:
+        scaler, model, y_pred, metrics = cached['scaler'], cached['model'], cached['y_pred'], cached['metrics']
+        scaling_status.info("Reusing the StandardScaler fitted for this configuration.")
+        st.info(f"Loaded the fitted {chosen_model_type} model, its predictions and metrics from the model cache.")
+    else:
+        scaler_params, pretrained_scaler = scaler_settings(use_pretrained_model)
+        scaling_status.info("Using pre-trained StandardScaler." if pretrained_scaler else "Fitting and using new StandardScaler.")
+
+        with stage('modeling.design_matrix', features=len(selected_features)):
+            design = build_design_matrix(data.attrs['fingerprint'], tuple(selected_features), split_point, scaler_params, data)
+        scaler = design['scaler']
+        X_train_scaled, X_test_scaled = design['X_train'], design['X_test']
+
+        scaling_status.success("Features scaled successfully!")
+
+        y_pred = None
+        if pretrained_model is not None:
+            model = pretrained_model
+            # Pre-trained models were fitted on DataFrames; a zero-copy frame keeps their feature-name check happy
+            X_test_scaled = pd.DataFrame(X_test_scaled, columns=selected_features, copy=False)
+            st.info(f"Using pre-trained {chosen_model_type} model.")
+        elif chosen_model_type == "K-Nearest Neighbors":
+            if train_in_background and model_cache_get(index_key, cache_dir) is None:
+                submit_knn_index_job(index_key, cache_dir, X_train_scaled, y_train, X_test_scaled)
+                show_training_progress(index_key, chosen_model_type, unit="query chunks")
+                return
+            with stage('modeling.knn_index'):
+                index = knn_neighbor_index(index_key, cache_dir, X_train_scaled, y_train, X_test_scaled)
+            with stage('modeling.predict', model=chosen_model_type):
+                model, y_pred = knn_from_index(index, y_train, hyperparams['n_neighbors'])
+        else:
+            model = build_model(chosen_model_type, hyperparams)
+            if model is not None and train_in_background:
+                submit_training_job(cache_key, cache_dir, scaler, prediction_task, chosen_model_type, hyperparams,
+                                    X_train_scaled, y_train, X_test_scaled, y_test)
+                show_training_progress(cache_key, chosen_model_type)
+                return
+            if model is not None:
+                with stage('modeling.fit', model=chosen_model_type, rows=len(X_train_scaled)):
+                    model.fit(X_train_scaled, y_train)
+
+        if model is None:
+            st.error("Model could not be instantiated or loaded. Please check your selections and file paths.")
+            return
+
+        if y_pred is None:
+            with stage('modeling.predict', model=chosen_model_type, rows=len(X_test_scaled)):
+                y_pred = model.predict(X_test_scaled)
+        with stage('modeling.metrics', model=chosen_model_type):
+            metrics = compute_metrics(prediction_task, y_test, y_pred, model)
+
+        # Pre-trained models already live on disk, so only newly fitted ones go to the disk tier.
+        # KNN models are rebuilt from the persisted index in milliseconds, so they stay in memory too.
+        with stage('modeling.model_cache_put'):
+            model_cache_put(cache_key, {'scaler': scaler, 'model': model, 'y_pred': y_pred, 'metrics': metrics},
+                            cache_dir, persist=pretrained_model is None and chosen_model_type != "K-Nearest Neighbors")
 
     st.success("Model training/loading complete!")
 
-    y_pred = model.predict(X_test_scaled)
-
     st.subheader("6. Model Performance Evaluation")
 
     if prediction_task == "PM2.5 Regression":
-        rmse = np.sqrt(mean_squared_error(y_test, y_pred))
-        mae = mean_absolute_error(y_test, y_pred)
-        r2 = r2_score(y_test, y_pred)
-
-        st.metric("RMSE", f"{rmse:.2f}")
-        st.metric("MAE", f"{mae:.2f}")
-        st.metric("R² Score", f"{r2:.2f}")
+        st.metric("RMSE", f"{metrics['rmse']:.2f}")
+        st.metric("MAE", f"{metrics['mae']:.2f}")
+        st.metric("R² Score", f"{metrics['r2']:.2f}")
 
+        # Model plots are keyed by the model cache key, which pins down y_test and y_pred
         st.subheader("7. Predicted vs Actual Plot (Full Test Set)")
-        plt.figure(figsize=(10, 6))
-        sns.scatterplot(x=y_test, y=y_pred, alpha=0.6, s=10)
-        plt.xlabel("Actual PM2.5")
-        plt.ylabel("Predicted PM2.5")
-        plt.title(f"Actual vs Predicted PM2.5 ({chosen_model_type})")
-        plt.grid(True)
-        st.pyplot(plt.gcf())
-        plt.clf()
+        def draw_scatter(fig, ax):
+            sns.scatterplot(x=y_test, y=y_pred, alpha=0.6, s=10, ax=ax)
+            ax.set_xlabel("Actual PM2.5")
+            ax.set_ylabel("Predicted PM2.5")
+            ax.set_title(f"Actual vs Predicted PM2.5 ({chosen_model_type})")
+            ax.grid(True)
+
+        show_figure('predicted_vs_actual', {'model': chosen_model_type}, cache_key, draw_scatter)
 
         st.subheader("8. Regression Line Plot (Actual vs Predicted)")
-        plt.figure(figsize=(10, 6))
-        sns.regplot(x=y_test, y=y_pred, scatter_kws={'alpha':0.3, 's':10}, line_kws={'color':'red'})
-        plt.xlabel("Actual PM2.5")
-        plt.ylabel("Predicted PM2.5")
-        plt.title(f"Regression Line ({chosen_model_type})")
-        plt.grid(True)
-        st.pyplot(plt.gcf())
-        plt.clf()
+        def draw_regression_line(fig, ax):
+            sns.regplot(x=y_test, y=y_pred, scatter_kws={'alpha':0.3, 's':10}, line_kws={'color':'red'}, ax=ax)
+            ax.set_xlabel("Actual PM2.5")
+            ax.set_ylabel("Predicted PM2.5")
+            ax.set_title(f"Regression Line ({chosen_model_type})")
+            ax.grid(True)
+
+        show_figure('regression_line', {'model': chosen_model_type}, cache_key, draw_regression_line)
 
     else: # AQI Classification
-        accuracy = accuracy_score(y_test, y_pred)
-        st.metric("Accuracy", f"{accuracy:.4f}")
+        st.metric("Accuracy", f"{metrics['accuracy']:.4f}")
 
         st.subheader("Classification Report")
-        st.text(classification_report(y_test, y_pred))
+        st.text(metrics['report'])
 
         st.subheader("Confusion Matrix")
-        cm = confusion_matrix(y_test, y_pred)
-        plt.figure(figsize=(8, 6))
-        sns.heatmap(cm, annot=True, fmt='d', cmap='Blues',
-                    xticklabels=model.classes_, yticklabels=model.classes_)
-        plt.title(f'Confusion Matrix ({chosen_model_type})')
-        plt.xlabel('Predicted Label')
-        plt.ylabel('True Label')
-        st.pyplot(plt.gcf())
-        plt.clf()
+        def draw_confusion_matrix(fig, ax):
+            sns.heatmap(metrics['confusion_matrix'], annot=True, fmt='d', cmap='Blues',
+                        xticklabels=metrics['classes'], yticklabels=metrics['classes'], ax=ax)
+            ax.set_title(f'Confusion Matrix ({chosen_model_type})')
+            ax.set_xlabel('Predicted Label')
+            ax.set_ylabel('True Label')
+
+        show_figure('confusion_matrix', {'model': chosen_model_type}, cache_key, draw_confusion_matrix, figsize=(8, 6))
 
 
     st.subheader("9. Feature Importance")
     if hasattr(model, 'feature_importances_') and chosen_model_type not in ["Linear Regression", "K-Nearest Neighbors"]:
         importance = model.feature_importances_
         feature_importance_df = pd.DataFrame({
-            'Feature': X.columns,
+            'Feature': selected_features,
             'Importance': importance
         }).sort_values(by='Importance', ascending=False)
         st.dataframe(feature_importance_df)
 
-        plt.figure(figsize=(10, min(len(feature_importance_df.head(15))*0.6, 10)))
-        sns.barplot(x='Importance', y='Feature', data=feature_importance_df.head(15), palette='viridis')
-        plt.title("Top 15 Feature Importance")
-        st.pyplot(plt.gcf())
-        plt.clf()
+        def draw_importance(fig, ax):
+            sns.barplot(x='Importance', y='Feature', data=feature_importance_df.head(15), palette='viridis', ax=ax)
+            ax.set_title("Top 15 Feature Importance")
+
+        show_figure('feature_importance', {'model': chosen_model_type}, cache_key, draw_importance,
+                    figsize=(10, min(len(feature_importance_df.head(15))*0.6, 10)))
     elif chosen_model_type == "Linear Regression":
         st.subheader("9. Feature Coefficients (Linear Regression)")
         if hasattr(model, 'coef_'):
-            coef_df = pd.DataFrame({'Feature': X.columns, 'Coefficient': model.coef_}).sort_values(by='Coefficient', ascending=False)
+            coef_df = pd.DataFrame({'Feature': selected_features, 'Coefficient': model.coef_}).sort_values(by='Coefficient', ascending=False)
             st.dataframe(coef_df)
-            plt.figure(figsize=(10, min(len(coef_df)*0.6, 10)))
-            sns.barplot(x='Coefficient', y='Feature', data=coef_df.head(15), palette='coolwarm')
-            plt.title("Top 15 Feature Coefficients")
-            st.pyplot(plt.gcf())
-            plt.clf()
+            def draw_coefficients(fig, ax):
+                sns.barplot(x='Coefficient', y='Feature', data=coef_df.head(15), palette='coolwarm', ax=ax)
+                ax.set_title("Top 15 Feature Coefficients")
+
+            show_figure('feature_coefficients', {'model': chosen_model_type}, cache_key, draw_coefficients,
+                        figsize=(10, min(len(coef_df)*0.6, 10)))
 
     st.subheader("10. Download Results & Model")
-    results_df = pd.DataFrame({"Actual": y_test, "Predicted": y_pred})
-    csv_data_predictions = results_df.to_csv(index=False).encode("utf-8")
-    st.download_button("📥 Download Predictions CSV", csv_data_predictions, file_name="predictions.csv", mime="text/csv")
+    # Exports are written only when a download button is clicked; on_click='ignore' skips the rerun it would cause.
+    # The finished file is still held in memory by Streamlit, hence the size estimate on the slice export.
+    export_format = st.radio("Export format", list(EXPORT_FORMATS), horizontal=True, key="export_format")
+    extension, mime = EXPORT_FORMATS[export_format]
+    dates = data['Date'].to_numpy()
+    col1, col2 = st.columns(2)
+    col1.download_button("📥 Download Test-Set Predictions",
+                         lambda: write_export(test_prediction_chunks(prediction_task, dates[split_point:], y_test, y_pred), extension),
+                         file_name=f"predictions.{extension}", mime=mime, on_click='ignore', key="export_predictions")
+    col2.download_button("📥 Download Filtered Slice with Predictions",
+                         lambda: write_export(slice_prediction_chunks(data, prediction_task, selected_features, target_variable,
+                                                                      split_point, scaler, model, y_pred), extension),
+                         file_name=f"slice_predictions.{extension}", mime=mime, on_click='ignore', key="export_slice",
+                         help="Every row of the selected stations and dates, with the station, the raw features, actual, "
+                              "predicted and residual values and whether the row was in the training or test split. "
+                              f"Built in memory when clicked: {export_size_label(len(data), extension)} for this slice.")
 
     if st.button("💾 Save Trained Model & Scaler"):
         model_filename = f"{chosen_model_type.lower().replace(' ', '_')}_model.pkl"
@@ -510,14 +2987,32 @@ def modeling_and_prediction(data):
 
 def main():
     st.set_page_config(page_title="Beijing Air Pollution Analysis App", layout="wide")
-    data = load_data()
     st.sidebar.title("Navigation")
     page = st.sidebar.radio("Go to", ["Data Overview", "EDA", "Modeling and Prediction"])
-    if page == "Data Overview":
-        data_overview(data)
-    elif page == "EDA":
-        eda(data)
-    elif page == "Modeling and Prediction":
-        modeling_and_prediction(data)
-    if __name__ == "__main__":
-      main()
\ No newline at end of file
+    _current_run()['page'] = page
+
+    try:
+        if STORAGE_MODE == "partitioned":
+            stations, date_range = select_data_slice(app_store['stations'], app_store['date_range'], *default_partitioned_slice(app_store))
+            data = PartitionedSlice(app_store, stations, date_range)
+        else:
+            all_stations = list(in_memory_stations(app_data.attrs['fingerprint'], app_data))
+            full_date_range = in_memory_date_range(app_data.attrs['fingerprint'], app_data)
+            stations, date_range = select_data_slice(all_stations, full_date_range)
+            if stations == tuple(all_stations) and date_range == full_date_range:
+                data = session_view(app_data) # No filter: every session shares the one frame
+            else:
+                with stage('load.slice_filter'):
+                    data = session_view(filter_in_memory(app_data.attrs['fingerprint'], stations, date_range, app_data))
+        if page == "Data Overview":
+            data_overview(data)
+        elif page == "EDA":
+            eda(data)
+        elif page == "Modeling and Prediction":
+            modeling_and_prediction(data)
+        show_diagnostics_panel()
+    finally:
+        finish_stage_run() # Also after st.rerun() / st.stop(), so no run's stages are lost
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
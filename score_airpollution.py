@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+"""score_airpollution.py
+
+Headless scoring for the Beijing air pollution models, without opening the Streamlit app.
+
+Loads the same artifacts that the app loads on demand with load_pretrained_artifact()
+(linear_regression_model.pkl, standard_scaler.pkl and random_forest_clf_model.pkl), once at startup, then either:
+
+    # Bulk mode: score a CSV or Parquet file in vectorized chunks
+    python score_airpollution.py batch hourly_feed.parquet --output predictions.parquet
+
+    # Service mode: local HTTP endpoint that micro-batches concurrent requests into single predict() calls
+    python score_airpollution.py serve --port 8765
+    curl -X POST localhost:8765/predict -d '{"rows": [{"PM10": 80, "TEMP": 3.1, ...}]}'
+
+Both modes report throughput and p50/p99 latency.
+"""
+
+import argparse
+import json
+import os
+import queue
+import signal
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import joblib
+import numpy as np
+import pandas as pd
+
+
+# Same default location (and AIRPOLLUTION_DATA_DIR override) as the app (GOOGLE_DRIVE_BASE_PATH in new_airpollution_app_py.py)
+DEFAULT_ARTIFACTS_DIR = os.environ.get("AIRPOLLUTION_DATA_DIR", "/content/drive/MyDrive/data sets/Merged cities/")
+MODEL_FILES = {
+    'regression': 'linear_regression_model.pkl',
+    'classification': 'random_forest_clf_model.pkl',
+}
+SCALER_FILE = 'standard_scaler.pkl'
+
+
+# --- ARTIFACTS ---
+
+def load_artifacts(artifacts_dir, task):
+    model = joblib.load(os.path.join(artifacts_dir, MODEL_FILES[task]))
+    try:
+        scaler = joblib.load(os.path.join(artifacts_dir, SCALER_FILE))
+    except FileNotFoundError:
+        scaler = None # Model was trained on unscaled features
+
+    # The fitted artifacts remember their column names. The model's columns (when fitted on a DataFrame) are the
+    # features; the scaler's are the columns it transforms. Scalers saved by the app cover every feature, with an
+    # identity transform for binary columns; older ones list only the standardized subset.
+    features = getattr(model, 'feature_names_in_', None)
+    if features is None and scaler is not None:
+        features = getattr(scaler, 'feature_names_in_', None)
+    if features is None:
+        raise ValueError(f"{MODEL_FILES[task]} has no feature names; re-save it from a model fitted on a DataFrame.")
+    scaled = list(getattr(scaler, 'feature_names_in_', [])) if scaler is not None else []
+    return {'model': model, 'scaler': scaler, 'features': list(features), 'scaled': scaled}
+
+
+def predict_frame(artifacts, frame):
+    # One vectorized scale + predict over the whole frame
+    missing = [col for col in artifacts['features'] + artifacts['scaled'] if col not in frame.columns]
+    if missing:
+        raise ValueError(f"Input is missing feature columns: {sorted(set(missing))}")
+    X = frame[artifacts['features']].astype('float64')
+    if artifacts['scaled']:
+        X[artifacts['scaled']] = artifacts['scaler'].transform(frame[artifacts['scaled']].astype('float64'))
+    return artifacts['model'].predict(X)
+
+
+def latency_summary(latencies_s, rows, elapsed_s):
+    latencies_ms = np.asarray(latencies_s, dtype='float64') * 1000
+    return {
+        'rows': int(rows),
+        'elapsed_s': round(elapsed_s, 3),
+        'throughput_rows_per_s': round(rows / elapsed_s, 1) if elapsed_s > 0 else None,
+        'p50_ms': round(float(np.percentile(latencies_ms, 50)), 3) if latencies_ms.size else None,
+        'p99_ms': round(float(np.percentile(latencies_ms, 99)), 3) if latencies_ms.size else None,
+    }
+
+
+# --- BULK MODE ---
+
+def _iter_input_chunks(input_path, columns, chunk_rows):
+    if input_path.endswith(('.parquet', '.pq')):
+        import pyarrow.parquet as pq
+        parquet_file = pq.ParquetFile(input_path)
+        available = [col for col in columns if col in parquet_file.schema_arrow.names]
+        for batch in parquet_file.iter_batches(batch_size=chunk_rows, columns=available):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(input_path, usecols=lambda col: col in columns, chunksize=chunk_rows)
+
+
+def score_file(artifacts, input_path, output_path, chunk_rows=100_000, keep_columns=()):
+    # Only the feature columns (plus any pass-through columns) are read from the input
+    needed = set(artifacts['features']) | set(artifacts['scaled']) | set(keep_columns)
+    writer = None
+    header = True
+    rows = 0
+    latencies = []
+    start = time.perf_counter()
+
+    try:
+        for chunk in _iter_input_chunks(input_path, needed, chunk_rows):
+            chunk_start = time.perf_counter()
+            predictions = predict_frame(artifacts, chunk)
+            latencies.append(time.perf_counter() - chunk_start)
+
+            out = chunk[[col for col in keep_columns if col in chunk.columns]].copy()
+            out['Predicted'] = predictions
+            if output_path.endswith(('.parquet', '.pq')):
+                import pyarrow as pa
+                import pyarrow.parquet as pq
+                table = pa.Table.from_pandas(out, preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(output_path, table.schema)
+                writer.write_table(table)
+            else:
+                out.to_csv(output_path, mode='w' if header else 'a', header=header, index=False)
+                header = False
+            rows += len(chunk)
+    finally:
+        if writer is not None:
+            writer.close()
+
+    summary = latency_summary(latencies, rows, time.perf_counter() - start)
+    summary.update({'mode': 'batch', 'chunks': len(latencies), 'chunk_rows': chunk_rows, 'latency': 'per chunk'})
+    return summary
+
+
+# --- SERVICE MODE ---
+
+class MicroBatcher:
+    # Collects concurrent requests for up to max_wait_ms (or max_batch rows) and scores them with one predict()
+
+    def __init__(self, artifacts, max_batch=512, max_wait_ms=5.0):
+        self.artifacts = artifacts
+        self.max_batch = max_batch
+        self.max_wait_s = max_wait_ms / 1000
+        self.pending = queue.Queue()
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=100_000) # Per-request latency, seconds
+        self.rows = 0
+        self.batches = 0
+        self.started = None # First request; throughput is measured from here rather than from startup
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def predict(self, frame):
+        request = {'frame': frame, 'done': threading.Event(), 'start': time.perf_counter()}
+        with self.lock:
+            if self.started is None:
+                self.started = request['start']
+        self.pending.put(request)
+        request['done'].wait()
+        if 'error' in request:
+            raise request['error']
+        return request['result']
+
+    def _run(self):
+        while True:
+            batch = [self.pending.get()]
+            n_rows = len(batch[0]['frame'])
+            deadline = time.perf_counter() + self.max_wait_s
+            while n_rows < self.max_batch:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self.pending.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                batch.append(request)
+                n_rows += len(request['frame'])
+            self._score(batch)
+
+    def _score(self, batch):
+        try:
+            predictions = predict_frame(self.artifacts, pd.concat([r['frame'] for r in batch], ignore_index=True))
+        except Exception:
+            # One bad request shouldn't fail its neighbours: fall back to scoring each request on its own
+            for request in batch:
+                try:
+                    request['result'] = predict_frame(self.artifacts, request['frame'])
+                except Exception as e:
+                    request['error'] = e
+                self._finish(request)
+            return
+
+        offset = 0
+        for request in batch:
+            n = len(request['frame'])
+            request['result'] = predictions[offset:offset + n]
+            offset += n
+            self._finish(request)
+        with self.lock:
+            self.batches += 1
+
+    def _finish(self, request):
+        with self.lock:
+            self.latencies.append(time.perf_counter() - request['start'])
+            self.rows += len(request['frame'])
+        request['done'].set()
+
+    def stats(self):
+        with self.lock:
+            elapsed = time.perf_counter() - self.started if self.started is not None else 0.0
+            summary = latency_summary(list(self.latencies), self.rows, elapsed)
+            summary.update({'mode': 'serve', 'requests': len(self.latencies), 'batches': self.batches, 'latency': 'per request'})
+        return summary
+
+
+class ScoringServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256 # The default backlog of 5 resets connections under bursts of concurrent clients
+
+
+def make_handler(batcher):
+    class ScoringHandler(BaseHTTPRequestHandler):
+        def _send_json(self, status, payload):
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == "/stats":
+                self._send_json(200, batcher.stats())
+            elif self.path == "/health":
+                self._send_json(200, {'status': 'ok', 'features': batcher.artifacts['features']})
+            else:
+                self._send_json(404, {'error': 'not found'})
+
+        def do_POST(self):
+            if self.path != "/predict":
+                self._send_json(404, {'error': 'not found'})
+                return
+            try:
+                payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                rows = payload['rows'] if isinstance(payload, dict) and 'rows' in payload else payload
+                frame = pd.DataFrame(rows if isinstance(rows, list) else [rows])
+                predictions = batcher.predict(frame)
+            except (ValueError, KeyError, TypeError) as e:
+                self._send_json(400, {'error': str(e)})
+                return
+            self._send_json(200, {'predictions': np.asarray(predictions).tolist()})
+
+        def log_message(self, format, *args):
+            pass # Keep the console for the stats summary
+
+    return ScoringHandler
+
+
+def serve(artifacts, host, port, max_batch, max_wait_ms):
+    batcher = MicroBatcher(artifacts, max_batch=max_batch, max_wait_ms=max_wait_ms)
+    server = ScoringServer((host, port), make_handler(batcher))
+    # SIGTERM (e.g. from a process supervisor) stops the server cleanly too, so the final stats still get printed
+    signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=server.shutdown).start())
+    print(f"Scoring {len(artifacts['features'])} features on http://{host}:{port}/predict (stats at /stats). Ctrl+C to stop.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(json.dumps(batcher.stats()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Score hourly air quality feeds with the app's trained models.")
+    parser.add_argument("--artifacts-dir", default=DEFAULT_ARTIFACTS_DIR, help="Folder holding the .pkl artifacts.")
+    parser.add_argument("--task", choices=sorted(MODEL_FILES), default='regression',
+                        help="regression = PM2.5 (linear_regression_model.pkl), classification = AQI (random_forest_clf_model.pkl).")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    batch_parser = commands.add_parser('batch', help="Score a CSV or Parquet file in chunks.")
+    batch_parser.add_argument("input")
+    batch_parser.add_argument("--output", required=True, help="Output .csv or .parquet file.")
+    batch_parser.add_argument("--chunk-rows", type=int, default=100_000)
+    batch_parser.add_argument("--keep", default="Date", help="Comma-separated input columns copied to the output.")
+
+    serve_parser = commands.add_parser('serve', help="Run a local HTTP scoring endpoint.")
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=8765)
+    serve_parser.add_argument("--max-batch", type=int, default=512, help="Most rows scored in one predict() call.")
+    serve_parser.add_argument("--max-wait-ms", type=float, default=5.0, help="How long to wait for more requests to batch.")
+
+    args = parser.parse_args()
+    artifacts = load_artifacts(args.artifacts_dir, args.task)
+
+    if args.command == 'batch':
+        keep_columns = [col for col in args.keep.split(",") if col]
+        print(json.dumps(score_file(artifacts, args.input, args.output, args.chunk_rows, keep_columns)))
+    else:
+        serve(artifacts, args.host, args.port, args.max_batch, args.max_wait_ms)
+
+
+if __name__ == "__main__":
+    main()